@@ -396,6 +396,26 @@ DEFAULT_THEME = "earth"
 # The default number of records to pull from the server as a page
 DEFAULT_PAGESIZE = 100
 
+# Number of seconds the record count of a grid report is cached
+GRID_COUNT_CACHE_TIMEOUT = 60
+
+# Unfiltered grid reports on tables with more records than this threshold
+# display the estimated number of records from the database statistics
+GRID_COUNT_ESTIMATE_THRESHOLD = 1000000
+
+# Custom SQL reports run on a pool of at most SQL_REPORT_POOLSIZE database
+# connections per process, and are cancelled after SQL_REPORT_TIMEOUT seconds.
+# The pages of a custom report are cached for SQL_REPORT_CACHE_TIMEOUT seconds,
+# or until a task such as a plan run finishes.
+SQL_REPORT_POOLSIZE = 4
+SQL_REPORT_TIMEOUT = 300
+SQL_REPORT_CACHE_TIMEOUT = 300
+
+# The results of asynchronous dashboard widgets are cached for
+# WIDGET_CACHE_TIMEOUT seconds, or until the data changes: when a task such
+# as a plan run finishes or when an edit is saved.
+WIDGET_CACHE_TIMEOUT = 3600
+
 # Configuration of the default dashboard
 DEFAULT_DASHBOARD = [
     {
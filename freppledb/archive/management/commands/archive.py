@@ -15,10 +15,10 @@
 # License along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 
-from datetime import datetime
+from datetime import datetime, timedelta
 from dateutil.parser import parse
 
-from django.db import DEFAULT_DB_ALIAS, connections
+from django.db import DEFAULT_DB_ALIAS, connections, transaction
 from django.core.management.base import BaseCommand
 
 from freppledb import VERSION
@@ -54,9 +54,7 @@ class Command(BaseCommand):
         verbosity = int(options["verbosity"])
         with connections[database].cursor() as cursor:
             try:
-                now = parse(
-                    Parameter.objects.using(database).get(name="currentdate").value
-                )
+                now = parse(Parameter.getValue("currentdate", database))
             except Exception:
                 now = datetime.now()
 
@@ -102,9 +100,7 @@ class Command(BaseCommand):
                     for s in snapshots:
                         if verbosity > 0:
                             print("Deleting archive", s)
-                        cursor.execute(
-                            "delete from ax_manager where snapshot_date = %s", (s,)
-                        )
+                        ArchiveManager.dropSnapshot(cursor, s)
                 else:
                     # We already have a snapshot for this period
                     if verbosity > 0:
@@ -115,111 +111,179 @@ class Command(BaseCommand):
 
             if verbosity > 0:
                 print("Creating history archive snapshot", now)
-            mgr = ArchiveManager(
-                snapshot_date=now,
-                total_records=0,
-                buffer_records=0,
-                demand_records=0,
-                operationplan_records=0,
-            )
-            mgr.save(using=database)
+            with transaction.atomic(using=database):
+                self.createSnapshot(cursor, database, now)
 
-            # Archiving buffer table
-            cursor.execute(
-                """
-                insert into ax_buffer (item, location, onhand, batch, cost, safetystock, snapshot_date_id)
-                select operationplanmaterial.item_id,
+            # Delete archived data we don't need any longer
+            self.pruneSnapshots(cursor, database, now, verbosity)
+
+    def createSnapshot(self, cursor, database, now):
+        mgr = ArchiveManager(
+            snapshot_date=now,
+            total_records=0,
+            buffer_records=0,
+            demand_records=0,
+            operationplan_records=0,
+        )
+        mgr.save(using=database)
+
+        # Resolve the safety stock of all buffers at the snapshot date.
+        # Order of preference: the "SS for <item> @ <location>" calendar, the
+        # minimum calendar of the buffer and the minimum field of the buffer.
+        cursor.execute(
+            """
+            create temporary table ax_safetystock on commit drop as
+            with bucket as (
+              select distinct on (calendar_id) calendar_id, value
+              from calendarbucket
+              where %s >= startdate and %s < enddate
+              order by calendar_id, priority
+              )
+            select
+              buffer.item_id, buffer.location_id, buffer.batch,
+              coalesce(
+                ss_bucket.value, ss_calendar.defaultvalue,
+                min_bucket.value, min_calendar.defaultvalue,
+                buffer.minimum
+                ) as safetystock
+            from buffer
+            left outer join calendar ss_calendar
+              on ss_calendar.name = 'SS for ' || buffer.item_id || ' @ ' || buffer.location_id
+            left outer join bucket ss_bucket
+              on ss_bucket.calendar_id = ss_calendar.name
+            left outer join calendar min_calendar
+              on min_calendar.name = buffer.minimum_calendar_id
+            left outer join bucket min_bucket
+              on min_bucket.calendar_id = min_calendar.name
+            """,
+            (now, now),
+        )
+
+        # Archiving buffer table: last onhand per item, location and batch
+        buffer_records = self.loadPartition(
+            cursor,
+            "ax_buffer",
+            now,
+            """
+            insert into %s
+              (item, location, onhand, batch, cost, safetystock, snapshot_date_id)
+            select
+              onhand.item_id, onhand.location_id, onhand.onhand, onhand.batch,
+              item.cost, ax_safetystock.safetystock, %%s
+            from (
+              select
+                operationplanmaterial.item_id,
                 operationplanmaterial.location_id,
                 operationplanmaterial.onhand,
                 operationplan.batch,
-                item.cost,
-                (select safetystock from
-                    (
-                    select 1 as priority, coalesce(
-                      (select value from calendarbucket
-                       where calendar_id = 'SS for '||operationplanmaterial.item_id||' @ '||operationplanmaterial.location_id
-                       and '%s' >= startdate and '%s' < enddate
-                       order by priority limit 1),
-                      (select defaultvalue from calendar where name = 'SS for '||operationplanmaterial.item_id||' @ '||operationplanmaterial.location_id)
-                      ) as safetystock
-                    union all
-                    select 2 as priority, coalesce(
-                      (select value
-                       from calendarbucket
-                       where calendar_id = buffer.minimum_calendar_id
-                       and '%s' >= startdate
-                       and '%s' < enddate
-                       order by priority limit 1),
-                      (select defaultvalue
-                       from calendar
-                       where name = buffer.minimum_calendar_id
-                      )
-                    ) as safetystock
-                    union all
-                    select 3 as priority, buffer.minimum
-                    ) t
-                    where t.safetystock is not null
-                    order by priority
-                    limit 1) safetystock,
-                    '%s'
-                from operationplanmaterial
-                inner join operationplan on operationplan.reference = operationplanmaterial.operationplan_id
-                left outer join buffer on buffer.item_id = operationplanmaterial.item_id
-                and buffer.location_id = operationplanmaterial.location_id
-                and buffer.batch is not distinct from operationplan.batch
-                inner join item on item.name = buffer.item_id
-                where flowdate <= '%s'
-                and not exists (select 1 from operationplanmaterial opm
-                inner join operationplan op on op.reference = opm.operationplan_id
-                where operationplanmaterial.item_id = opm.item_id
-                and operationplanmaterial.location_id = opm.location_id
-                and op.batch is not distinct from operationplan.batch
-                and operationplanmaterial.id != opm.id
-                and opm.flowdate <= '%s'
-                and opm.flowdate > operationplanmaterial.flowdate
-                and opm.onhand < operationplanmaterial.onhand)
-                """
-                % ((now,) * 7)
-            )
-            buffer_records = cursor.rowcount
+                row_number() over (
+                  partition by
+                    operationplanmaterial.item_id,
+                    operationplanmaterial.location_id,
+                    operationplan.batch
+                  order by operationplanmaterial.flowdate desc, operationplanmaterial.id desc
+                  ) as rownum
+              from operationplanmaterial
+              inner join operationplan
+                on operationplan.reference = operationplanmaterial.operationplan_id
+              where operationplanmaterial.flowdate <= %%s
+              ) onhand
+            inner join item on item.name = onhand.item_id
+            left outer join ax_safetystock
+              on ax_safetystock.item_id = onhand.item_id
+              and ax_safetystock.location_id = onhand.location_id
+              and ax_safetystock.batch is not distinct from onhand.batch
+            where onhand.rownum = 1
+            """,
+            (now, now),
+        )
 
-            # Archiving demand table
-            cursor.execute(
-                """
-                insert into ax_demand (name, item, location, customer, cost, due, status, priority, quantity,
-                                      deliverydate, quantityplanned, snapshot_date_id)
-                select demand.name, demand.item_id, demand.location_id, demand.customer_id, item.cost,
-                demand.due, demand.status, demand.priority, demand.quantity, operationplan.enddate, operationplan.quantity, '%s'
-                from demand
-                inner join item on demand.item_id = item.name
-                left outer join operationplan on operationplan.demand_id = demand.name
-                where demand.status in ('open', 'quote')
-                """
-                % (now,)
-            )
-            demand_records = cursor.rowcount
+        # Archiving demand table
+        demand_records = self.loadPartition(
+            cursor,
+            "ax_demand",
+            now,
+            """
+            insert into %s
+              (name, item, location, customer, cost, due, status, priority, quantity,
+              deliverydate, quantityplanned, snapshot_date_id)
+            select
+              demand.name, demand.item_id, demand.location_id, demand.customer_id,
+              item.cost, demand.due, demand.status, demand.priority, demand.quantity,
+              operationplan.enddate, operationplan.quantity, %%s
+            from demand
+            inner join item on demand.item_id = item.name
+            left outer join operationplan on operationplan.demand_id = demand.name
+            where demand.status in ('open', 'quote')
+            """,
+            (now,),
+        )
 
-            # Archiving POs
-            cursor.execute(
-                """
-                insert into ax_operationplan
-                (reference, status, type, quantity, startdate, enddate, item, supplier, location, item_cost, itemsupplier_cost, snapshot_date_id)
-                select op.reference, op.status, op.type, op.quantity, op.startdate, op.enddate, op.item_id, op.supplier_id, op.location_id,
-                item.cost, itemsupplier.cost, '%s'
-                from operationplan op
-                inner join item on op.item_id = item.name
-                left outer join itemsupplier on itemsupplier.item_id = op.item_id and itemsupplier.supplier_id = op.supplier_id
-                where
-                op.type = 'PO' and op.status in ('confirmed','approved')
-                """
-                % (now,)
-            )
-            operationplan_records = cursor.rowcount
+        # Archiving POs
+        operationplan_records = self.loadPartition(
+            cursor,
+            "ax_operationplan",
+            now,
+            """
+            insert into %s
+              (reference, status, type, quantity, startdate, enddate, item, supplier,
+              location, item_cost, itemsupplier_cost, snapshot_date_id)
+            select
+              op.reference, op.status, op.type, op.quantity, op.startdate, op.enddate,
+              op.item_id, op.supplier_id, op.location_id, item.cost, itemsupplier.cost, %%s
+            from operationplan op
+            inner join item on op.item_id = item.name
+            left outer join itemsupplier
+              on itemsupplier.item_id = op.item_id
+              and itemsupplier.supplier_id = op.supplier_id
+            where op.type = 'PO' and op.status in ('confirmed','approved')
+            """,
+            (now,),
+        )
+
+        mgr.buffer_records = buffer_records
+        mgr.demand_records = demand_records
+        mgr.operationplan_records = operationplan_records
+        mgr.total_records = buffer_records + demand_records + operationplan_records
+        mgr.save(using=database)
 
-            mgr.buffer_records = buffer_records
-            mgr.demand_records = demand_records
-            mgr.operationplan_records = operationplan_records
-            mgr.total_records = buffer_records + demand_records + operationplan_records
-            mgr.save(using=database)
+    def loadPartition(self, cursor, table, now, sql, params):
+        """
+        Bulk loads the snapshot in a new, standalone table which is attached
+        as a partition afterwards. This avoids maintaining the indexes and
+        routing the records through the partitioned table during the load.
+        When the archive tables aren't partitioned, the records are inserted
+        in the table directly.
+        """
+        if not ArchiveManager.isPartitioned(cursor):
+            cursor.execute(sql % table, params)
+            return cursor.rowcount
+        partition = ArchiveManager.partitionName(table, now)
+        cursor.execute(
+            "create table %s (like %s including defaults)" % (partition, table)
+        )
+        cursor.execute(sql % partition, params)
+        cnt = cursor.rowcount
+        cursor.execute(
+            "alter table %s attach partition %s for values in (%%s)"
+            % (table, partition),
+            (now,),
+        )
+        return cnt
 
-            # TODO Deleted archived data we don't need to any longer
+    def pruneSnapshots(self, cursor, database, now, verbosity):
+        try:
+            retention = float(Parameter.getValue("archive.retention", database, 0))
+        except ValueError:
+            retention = 0
+        if retention <= 0:
+            return
+        cursor.execute(
+            "select snapshot_date from ax_manager where snapshot_date < %s",
+            (now - timedelta(days=retention),),
+        )
+        for s in [r[0] for r in cursor.fetchall()]:
+            if verbosity > 0:
+                print("Deleting archive", s)
+            with transaction.atomic(using=database):
+                ArchiveManager.dropSnapshot(cursor, s)
@@ -0,0 +1,81 @@
+#
+# Copyright (C) 2020 by frePPLe bv
+#
+# This library is free software; you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero
+# General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+from django.db import migrations, connections
+
+
+# Indexed columns of the archive tables, besides the snapshot date
+indexes = {
+    "ax_buffer": ("item", "location"),
+    "ax_demand": ("item", "location", "customer"),
+    "ax_operationplan": ("type", "item", "destination", "name"),
+}
+
+
+def partitionTables(apps, schema_editor):
+    if schema_editor.connection.pg_version < 110000:
+        # Partitioned tables with a primary key, foreign keys and attached
+        # partitions require PostgreSQL 11. Older versions keep plain tables.
+        return
+    with connections[schema_editor.connection.alias].cursor() as cursor:
+        cursor.execute("select snapshot_date from ax_manager")
+        snapshots = [r[0] for r in cursor.fetchall()]
+        for table, columns in indexes.items():
+            cursor.execute("alter table %s rename to %s_old" % (table, table))
+            cursor.execute(
+                """
+                create table %s (like %s_old including defaults)
+                partition by list (snapshot_date_id)
+                """
+                % (table, table)
+            )
+            cursor.execute("alter sequence %s_id_seq owned by %s.id" % (table, table))
+            cursor.execute(
+                "alter table %s add primary key (id, snapshot_date_id)" % table
+            )
+            cursor.execute(
+                """
+                alter table %s
+                add foreign key (snapshot_date_id)
+                references ax_manager (snapshot_date)
+                on delete cascade
+                deferrable initially deferred
+                """
+                % table
+            )
+            for s in snapshots:
+                partition = "%s_%s" % (table, s.strftime("%Y%m%d%H%M%S%f"))
+                cursor.execute(
+                    "create table %s partition of %s for values in (%%s)"
+                    % (partition, table),
+                    (s,),
+                )
+                cursor.execute(
+                    "insert into %s select * from %s_old where snapshot_date_id = %%s"
+                    % (partition, table),
+                    (s,),
+                )
+            cursor.execute("drop table %s_old" % table)
+            for col in columns + ("snapshot_date_id",):
+                cursor.execute(
+                    "create index %s_%s_idx on %s (%s)" % (table, col, table, col)
+                )
+
+
+class Migration(migrations.Migration):
+    dependencies = [("archive", "0002_cascade_delete")]
+    operations = [migrations.RunPython(partitionTables)]
@@ -34,12 +34,53 @@ class ArchiveManager(models.Model):
     demand_records = models.IntegerField("demand_records")
     operationplan_records = models.IntegerField("operationplan_records")
 
+    # Tables with archived data. Each snapshot is stored in its own partition.
+    archived_tables = ("ax_buffer", "ax_demand", "ax_operationplan")
+
     class Meta:
         db_table = "ax_manager"
         verbose_name = "archive manager"
         verbose_name_plural = "archive managers"
         ordering = ["snapshot_date"]
 
+    @staticmethod
+    def partitionName(table, snapshot_date):
+        return "%s_%s" % (table, snapshot_date.strftime("%Y%m%d%H%M%S%f"))
+
+    @classmethod
+    def isPartitioned(cls, cursor):
+        """
+        Returns whether the archived tables are partitioned on the snapshot
+        date. Databases created on PostgreSQL 10 or older use plain tables.
+        """
+        cursor.execute(
+            "select relkind = 'p' from pg_class where relname = %s",
+            (cls.archived_tables[0],),
+        )
+        rec = cursor.fetchone()
+        return bool(rec and rec[0])
+
+    @classmethod
+    def dropSnapshot(cls, cursor, snapshot_date):
+        """
+        Removes a snapshot by dropping its partitions, which is a lot cheaper
+        than deleting the archived records.
+        """
+        partitioned = cls.isPartitioned(cursor)
+        for table in cls.archived_tables:
+            if partitioned:
+                cursor.execute(
+                    "drop table if exists %s" % cls.partitionName(table, snapshot_date)
+                )
+            else:
+                cursor.execute(
+                    "delete from %s where snapshot_date_id = %%s" % table,
+                    (snapshot_date,),
+                )
+        cursor.execute(
+            "delete from ax_manager where snapshot_date = %s", (snapshot_date,)
+        )
+
 
 class ArchivedModel(models.Model):
     """
@@ -25,7 +25,7 @@ from rest_framework_bulk import ListBulkCreateUpdateDestroyAPIView
 from django_filters.rest_framework import DjangoFilterBackend
 from rest_framework import permissions
 
-from freppledb.common.models import User
+from freppledb.common.models import User, bulkSave
 from freppledb.common.auth import getWebserviceAuthorization
 
 
@@ -95,6 +95,14 @@ class frePPleListCreateAPIView(ListBulkCreateUpdateDestroyAPIView):
         kwargs["partial"] = True
         return super().get_serializer(*args, **kwargs)
 
+    def perform_create(self, serializer):
+        with bulkSave(self.get_queryset().model, self.request.database):
+            serializer.save()
+
+    def perform_update(self, serializer):
+        with bulkSave(self.get_queryset().model, self.request.database):
+            serializer.save()
+
     def allow_bulk_destroy(self, qs, filtered):
         # Safety check to prevent deleting all records in the database table
         if qs.count() > filtered.count():
@@ -20,6 +20,7 @@ import os
 from django.apps import AppConfig
 from django.conf import settings
 from django.core.exceptions import ImproperlyConfigured
+from django.db.models.signals import post_delete, post_save
 from django.utils.autoreload import autoreload_started
 
 
@@ -32,7 +33,11 @@ class CommonConfig(AppConfig):
     verbose_name = "common"
 
     def ready(self):
+        from freppledb.common.middleware import markDataChanged
+
         autoreload_started.connect(watchDjangoSettings)
+        post_save.connect(markDataChanged, dispatch_uid="common_planversion_save")
+        post_delete.connect(markDataChanged, dispatch_uid="common_planversion_delete")
 
         # Validate all required modules are activated
         missing = []
@@ -26,10 +26,9 @@ from django.contrib.auth.models import Permission
 from django.core.validators import validate_email
 from django.core.exceptions import ValidationError
 from django.db import DEFAULT_DB_ALIAS
-from django.db.models import Q
 from django.http import HttpResponse
 
-from freppledb.common.models import User, Scenario
+from freppledb.common.models import User, ScenarioCache
 
 import logging
 
@@ -50,27 +49,9 @@ class MultiDBBackend(ModelBackend):
 
     @staticmethod
     def getScenarios(user):
-        # Populate a dictionary with scenarios in which the user is active, and
+        # Populate a list with scenarios in which the user is active, and
         # whether he's a superuser in them.
-        user.scenarios = []
-        for db in Scenario.objects.using(DEFAULT_DB_ALIAS).filter(
-            Q(status="In use") | Q(name=DEFAULT_DB_ALIAS)
-        ):
-            if not db.description:
-                db.description = db.name
-            if db.name == DEFAULT_DB_ALIAS:
-                if user.is_active:
-                    db.is_superuser = user.is_superuser
-                    user.scenarios.append(db)
-            else:
-                try:
-                    user2 = User.objects.using(db.name).get(username=user.username)
-                    if user2.is_active:
-                        db.is_superuser = user2.is_superuser
-                        user.scenarios.append(db)
-                except Exception:
-                    # Silently ignore errors. Eg user doesn't exist in scenario
-                    pass
+        user.scenarios = ScenarioCache.getUserScenarios(user)
 
     def authenticate(self, request, username=None, password=None):
         try:
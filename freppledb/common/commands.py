@@ -15,14 +15,20 @@
 # License along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 
-from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from decimal import Decimal
 import io
 from importlib import import_module
+import json
 from operator import attrgetter
 import os
+import struct
 import sys
 import logging
-from threading import Thread
+from threading import get_ident, Lock, Thread
+from time import mktime
 
 
 if __name__ == "__main__":
@@ -41,9 +47,11 @@ if __name__ == "__main__":
     django.setup()
 
 from django.conf import settings
-from django.db import DEFAULT_DB_ALIAS
+from django.db import connections, DEFAULT_DB_ALIAS
+from django.db.backends.signals import connection_created
 from django.utils.encoding import force_text
 
+from freppledb.common.models import Parameter
 from freppledb.execute.models import Task
 
 logger = logging.getLogger(__name__)
@@ -106,6 +114,376 @@ class CopyFromGenerator(io.TextIOBase):
         return "".join(line)
 
 
+def copy_text_line(record):
+    """
+    Formats a tuple of python values as a line for a text COPY command,
+    using \\v as the field separator.
+    """
+    return (
+        "\v".join(
+            "\\N" if v is None else clean_value(v) if isinstance(v, str) else str(v)
+            for v in record
+        )
+        + "\n"
+    )
+
+
+_int16 = struct.Struct("!h")
+_int32 = struct.Struct("!i")
+_int64 = struct.Struct("!q")
+_numeric_header = struct.Struct("!ihhhh")
+_numeric_nan = _numeric_header.pack(8, 0, 0, -16384, 0)
+_numeric_structs = {}
+_numeric_cache = {}
+_null = _int32.pack(-1)
+
+# Ordinal of the PostgreSQL epoch 2000-01-01
+_pg_epoch = 730120
+
+# Cache with the UTC offset of every hour of the local time zone
+_utcoffsets = {}
+
+
+def _binary_text(value):
+    b = value.encode("utf-8")
+    return _int32.pack(len(b)) + b
+
+
+def _binary_jsonb(value):
+    b = value.encode("utf-8")
+    return _int32.pack(len(b) + 1) + b"\x01" + b
+
+
+def _binary_integer(value):
+    return b"\x00\x00\x00\x04" + _int32.pack(value)
+
+
+def _binary_timestamp(value):
+    if not isinstance(value, datetime):
+        value = datetime(value.year, value.month, value.day)
+    if value.tzinfo:
+        offset = value.utcoffset() // timedelta(seconds=1)
+    else:
+        # Naive datetimes are in the local time zone, which django configures
+        # to be the same as the time zone of the database session.
+        # Daylight saving time changes happen on the hour, so we only need to
+        # compute the UTC offset once for every hour.
+        key = (value.year, value.month, value.day, value.hour)
+        offset = _utcoffsets.get(key, None)
+        if offset is None:
+            hour = datetime(*key)
+            t = mktime(hour.timetuple())
+            if datetime.fromtimestamp(t + 3600) == hour:
+                # An ambiguous hour is interpreted as standard time, as PostgreSQL does
+                t += 3600
+            offset = int((hour - datetime(1970, 1, 1)) // timedelta(seconds=1) - t)
+            _utcoffsets[key] = offset
+    return b"\x00\x00\x00\x08" + _int64.pack(
+        (
+            (value.toordinal() - _pg_epoch) * 86400
+            + value.hour * 3600
+            + value.minute * 60
+            + value.second
+            - offset
+        )
+        * 1000000
+        + value.microsecond
+    )
+
+
+def _binary_numeric_groups(groups, weight, sign, dscale):
+    while groups and not groups[-1]:
+        groups.pop()
+    st = _numeric_structs.get(len(groups), None)
+    if not st:
+        st = struct.Struct("!ihhhh%dh" % len(groups))
+        _numeric_structs[len(groups)] = st
+    return st.pack(8 + 2 * len(groups), len(groups), weight, sign, dscale, *groups)
+
+
+def _binary_numeric_digits(n, weight, sign, dscale):
+    # Convert a positive integer to base-10000 digits
+    groups = []
+    while n:
+        n, g = divmod(n, 10000)
+        groups.append(g)
+    if not groups:
+        return _binary_numeric_groups(groups, 0, sign, dscale)
+    groups.reverse()
+    return _binary_numeric_groups(groups, weight + len(groups) - 1, sign, dscale)
+
+
+def _binary_numeric(value):
+    # Plan data has many repeating values, so we cache the encoded results
+    result = _numeric_cache.get(value, None)
+    if result:
+        return result
+    if isinstance(value, float):
+        if value != value:
+            return _numeric_nan
+        elif -10000000 < value < 10000000:
+            # Fast path for floats with up to 8 decimals
+            n = round(value * 100000000)
+            if n < 0:
+                n = -n
+                sign = 0x4000
+            else:
+                sign = 0
+            hi, lo = divmod(n, 100000000)
+            g0, g1 = divmod(hi, 10000)
+            g2, g3 = divmod(lo, 10000)
+            if g0:
+                groups = [g0, g1, g2, g3]
+            elif g1:
+                groups = [g1, g2, g3]
+            elif g2:
+                groups = [g2, g3]
+            else:
+                groups = [g3]
+            dscale = 8 if lo else 0
+            while lo and not lo % 10:
+                lo //= 10
+                dscale -= 1
+            result = _binary_numeric_groups(
+                groups, len(groups) - 3 if n else 0, sign, dscale
+            )
+        else:
+            value = Decimal(repr(value))
+    elif isinstance(value, int):
+        if value < 0:
+            result = _binary_numeric_digits(-value, 0, 0x4000, 0)
+        else:
+            result = _binary_numeric_digits(value, 0, 0, 0)
+    elif not isinstance(value, Decimal):
+        value = Decimal(value)
+    if not result:
+        sign, digits, exp = value.as_tuple()
+        n = int("".join(str(d) for d in digits) or "0")
+        if exp > 0:
+            n *= 10 ** exp
+            exp = 0
+        dscale = -exp
+        # Align the scale on a multiple of 4 digits
+        pad = (4 - dscale % 4) % 4
+        result = _binary_numeric_digits(
+            n * 10 ** pad, -(dscale + pad) // 4, 0x4000 if sign else 0, dscale
+        )
+    if len(_numeric_cache) > 100000:
+        _numeric_cache.clear()
+    _numeric_cache[value] = result
+    return result
+
+
+class CopyBinaryGenerator(io.RawIOBase):
+    """
+    File-like object to handle exporting data to PostgreSQL over a
+    binary copy command.
+
+    The iterator yields tuples of python values, which are encoded with
+    the PostgreSQL binary format of the column types passed as argument.
+    Supported column types are text, integer, numeric, timestamp (with
+    time zone), json and jsonb.
+    """
+
+    encoders = {
+        "text": _binary_text,
+        "integer": _binary_integer,
+        "numeric": _binary_numeric,
+        "timestamp": _binary_timestamp,
+        "json": _binary_text,
+        "jsonb": _binary_jsonb,
+    }
+
+    def __init__(self, itr, types):
+        self._iter = itr
+        self._encoders = [self.encoders[t] for t in types]
+        self._fieldcount = _int16.pack(len(types))
+        # Header: signature, flags field and header extension length
+        self._buff = bytearray(b"PGCOPY\n\xff\r\n\x00" + b"\x00" * 8)
+        self._done = False
+
+    def readable(self):
+        return True
+
+    def _fill(self, n):
+        buff = self._buff
+        encoders = self._encoders
+        while not self._done and (n is None or n < 0 or len(buff) < n):
+            try:
+                rec = next(self._iter)
+            except StopIteration:
+                # File trailer
+                buff += b"\xff\xff"
+                self._done = True
+                break
+            buff += self._fieldcount
+            buff += b"".join(
+                [_null if val is None else enc(val) for enc, val in zip(encoders, rec)]
+            )
+
+    def read(self, n=None):
+        self._fill(n)
+        if n is None or n < 0 or n >= len(self._buff):
+            ret = bytes(self._buff)
+            self._buff.clear()
+        else:
+            ret = bytes(self._buff[:n])
+            del self._buff[:n]
+        return ret
+
+
+def copy_records(cursor, table, columns, types, records, binary=True, size=1024 * 256):
+    """
+    Copies an iterable of tuples into a table.
+    The data is sent in the PostgreSQL binary format, or as \\v-separated text
+    when the binary argument is false.
+    """
+    if binary:
+        cursor.copy_expert(
+            "copy %s (%s) from stdin with (format binary)" % (table, ",".join(columns)),
+            CopyBinaryGenerator(iter(records), types),
+            size=size,
+        )
+    else:
+        cursor.copy_from(
+            CopyFromGenerator(copy_text_line(r) for r in records),
+            table,
+            columns=columns,
+            size=1024,
+            sep="\v",
+        )
+
+
+class QueryPrefetcher:
+    """
+    Executes queries in a pool of threads, each with its own database
+    connection, and keeps the result until a planning task asks for it.
+    """
+
+    def __init__(self, database=DEFAULT_DB_ALIAS, threads=4):
+        self.database = database
+        self.executor = ThreadPoolExecutor(max_workers=threads)
+        self.futures = {}
+
+    def _fetch(self, sql):
+        try:
+            with connections[self.database].cursor() as cursor:
+                cursor.execute(sql)
+                return cursor.fetchall()
+        finally:
+            connections[self.database].close()
+
+    def submit(self, sql):
+        if sql not in self.futures:
+            self.futures[sql] = self.executor.submit(self._fetch, sql)
+
+    def get(self, sql):
+        f = self.futures.pop(sql, None)
+        return f.result() if f else None
+
+    def shutdown(self):
+        for f in self.futures.values():
+            f.cancel()
+        self.executor.shutdown(wait=True)
+        self.futures = {}
+
+
+class PlanTaskBenchmark:
+    """
+    Measures the wall time, peak memory and number of SQL statements of
+    every step of the plan generation.
+
+    The measurements are activated with the environment variable
+    FREPPLE_BENCHMARK, which contains the name of a file to which a JSON
+    record is appended for every step. The number of SQL statements only
+    counts the statements executed with a Django cursor: data sent with a
+    COPY command isn't included.
+    """
+
+    filename = None
+    lock = Lock()
+
+    # Number of SQL statements executed by each thread
+    statements = {}
+
+    @classmethod
+    def start(cls):
+        cls.filename = os.environ.get("FREPPLE_BENCHMARK", None)
+        if not cls.filename:
+            return
+        for conn in connections.all():
+            cls._connectionCreated(None, conn)
+        connection_created.connect(
+            cls._connectionCreated, dispatch_uid="common_plantaskbenchmark"
+        )
+
+    @classmethod
+    def _connectionCreated(cls, sender, connection, **kwargs):
+        if cls._countStatement not in connection.execute_wrappers:
+            connection.execute_wrappers.append(cls._countStatement)
+
+    @classmethod
+    def _countStatement(cls, execute, sql, params, many, context):
+        ident = get_ident()
+        cls.statements[ident] = cls.statements.get(ident, 0) + 1
+        return execute(sql, params, many, context)
+
+    @staticmethod
+    def _peakMemory():
+        """
+        Returns the peak resident memory of the process in bytes.
+        """
+        try:
+            import resource
+
+            rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            # Linux reports kilobytes, macOS reports bytes
+            return rss if sys.platform == "darwin" else rss * 1024
+        except Exception:
+            # Not available on Windows
+            return None
+
+    @classmethod
+    @contextmanager
+    def measure(cls, step):
+        if not cls.filename:
+            yield
+            return
+        # A parallel group counts the statements of all its threads
+        parallel = isinstance(step, PlanTaskParallel)
+        ident = get_ident()
+        statements = (
+            sum(cls.statements.values()) if parallel else cls.statements.get(ident, 0)
+        )
+        start = datetime.now()
+        status = "Failed"
+        try:
+            yield
+            status = "Done"
+        finally:
+            record = {
+                "sequence": str(step.sequence),
+                "step": step.step,
+                "thread": step.thread,
+                "description": force_text(step.description),
+                "parallel": parallel,
+                "start": start.strftime("%Y-%m-%d %H:%M:%S"),
+                "seconds": (datetime.now() - start).total_seconds(),
+                "peak_memory": cls._peakMemory(),
+                "statements": (
+                    sum(cls.statements.values())
+                    if parallel
+                    else cls.statements.get(ident, 0)
+                )
+                - statements,
+                "status": status,
+            }
+            with cls.lock:
+                with open(cls.filename, "a") as f:
+                    f.write(json.dumps(record))
+                    f.write("\n")
+
+
 class PlanTask:
     """
     Base class for steps in the plan generation process
@@ -117,6 +495,13 @@ class PlanTask:
     label = None
     export = False
 
+    # Sequence numbers of the steps whose database updates this task reads.
+    # When a task declares its dependencies, the queries returned by its
+    # getQueries method are executed in the background as soon as those
+    # steps are finished. The default None means the task depends on all
+    # steps before it, and nothing is fetched upfront.
+    dependencies = None
+
     # Fields for internal use
     task = None
     thread = "main"
@@ -131,6 +516,30 @@ class PlanTask:
     def run(cls, **kwargs):
         logger.warning("Warning: PlanTask doesn't implement the run method")
 
+    @classmethod
+    def getQueries(cls, **kwargs):
+        """
+        Returns the list of queries this task will read with the fetch method.
+        """
+        return []
+
+    @staticmethod
+    def _query(sql, database):
+        with connections[database].chunked_cursor() as cursor:
+            cursor.execute(sql)
+            for rec in cursor:
+                yield rec
+
+    @classmethod
+    def fetch(cls, sql, database=DEFAULT_DB_ALIAS):
+        """
+        Returns the records of a query. When the query was already executed
+        in the background, its result is returned without a database roundtrip.
+        """
+        prefetcher = PlanTaskRegistry.reg.prefetcher
+        rows = prefetcher.get(sql) if prefetcher else None
+        return cls._query(sql, database) if rows is None else rows
+
     @classmethod
     def display(cls, indentlevel=0, **kwargs):
         logger.info(
@@ -158,6 +567,7 @@ class PlanTaskSequence(PlanTask):
     """
 
     export = True
+    prefetcher = None
 
     def __init__(self):
         self.steps = []
@@ -177,6 +587,24 @@ class PlanTaskSequence(PlanTask):
                 total += s.weight
         return total
 
+    def prefetch(self, finished, scheduled):
+        """
+        Submits the queries of all tasks whose dependencies are finished.
+        """
+        active = [s.step for s in self.steps if s.weight is not None and s.weight > 0]
+        for s in self.steps:
+            if (
+                s.dependencies is None
+                or s.step in scheduled
+                or s.weight is None
+                or s.weight <= 0
+            ):
+                continue
+            if all(d in finished or d not in active for d in s.dependencies):
+                scheduled.add(s.step)
+                for sql in s.getQueries(**PlanTaskRegistry.getArguments()):
+                    self.prefetcher.submit(sql)
+
     def run(self, database=DEFAULT_DB_ALIAS, **kwargs):
         # Collect the list of tasks
         task_weight = self.getWeight(**PlanTaskRegistry.getArguments())
@@ -184,8 +612,12 @@ class PlanTaskSequence(PlanTask):
             task_weight = 1
 
         # Execute all tasks in the list
+        finished = set()
+        scheduled = set()
         try:
             progress = 0
+            if self.prefetcher:
+                self.prefetch(finished, scheduled)
             for step in self.steps:
                 if step.weight is None or step.weight <= 0:
                     continue
@@ -217,7 +649,8 @@ class PlanTaskSequence(PlanTask):
                         )
                     )
                 step.timestamp = self.timestamp
-                step.run(**PlanTaskRegistry.getArguments())
+                with PlanTaskBenchmark.measure(step):
+                    step.run(**PlanTaskRegistry.getArguments())
                 logger.info(
                     "Finished '%s' at %s %s"
                     % (
@@ -227,6 +660,9 @@ class PlanTaskSequence(PlanTask):
                     )
                 )
                 progress += step.weight
+                finished.add(step.step)
+                if self.prefetcher:
+                    self.prefetch(finished, scheduled)
 
             # Final task status
             if self.task:
@@ -485,7 +921,19 @@ class PlanTaskRegistry:
         cls.arguments = {"database": database, "export": export, "cluster": cluster}
         cls.arguments.update(kwargs)
         cls.reg.timestamp = datetime.now().replace(microsecond=0)
-        cls.reg.run(**cls.arguments)
+        PlanTaskBenchmark.start()
+        try:
+            threads = int(Parameter.getValue("plan.loadthreads", database, "4"))
+        except ValueError:
+            threads = 0
+        if threads > 0 and not export:
+            cls.reg.prefetcher = QueryPrefetcher(database=database, threads=threads)
+        try:
+            cls.reg.run(**cls.arguments)
+        finally:
+            if cls.reg.prefetcher:
+                cls.reg.prefetcher.shutdown()
+                cls.reg.prefetcher = None
         if export:
             logger.info("Finished export at %s" % datetime.now().strftime("%H:%M:%S"))
         else:
@@ -15,17 +15,23 @@
 # License along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 
+import hashlib
 from importlib import import_module
 import logging
 
 from django.conf import settings
 from django.contrib.auth.models import Permission
 from django.contrib.contenttypes.models import ContentType
+from django.core.cache import cache
 from django.http import (
+    HttpResponse,
     HttpResponseNotAllowed,
     HttpResponseForbidden,
     HttpResponseServerError,
 )
+from django.utils.translation import get_language
+
+from freppledb.execute.models import PlanVersion
 
 logger = logging.getLogger(__name__)
 
@@ -50,6 +56,8 @@ class Dashboard:
       client browser.
       It should return HTML content for synchronous widgets.
       It should return a Django response object for asynchronous widgets.
+    - The response of asynchronous widgets is cached until the data changes,
+      unless the class attribute 'cacheable' is false.
   """
 
     __registry__ = {}
@@ -91,7 +99,20 @@ class Dashboard:
                 return HttpResponseServerError("This widget is synchronous")
             if not w.has_permission(request.user):
                 return HttpResponseForbidden()
-            return w.render(request)
+            if not w.cacheable:
+                return w.render(request)
+            key = cls.getCacheKey(request, w)
+            result = cache.get(key, None)
+            if result:
+                return HttpResponse(result[0], content_type=result[1])
+            response = w.render(request)
+            if response.status_code == 200 and not response.streaming:
+                cache.set(
+                    key,
+                    (response.content, response["Content-Type"]),
+                    timeout=getattr(settings, "WIDGET_CACHE_TIMEOUT", 3600),
+                )
+            return response
         except Exception as e:
             logger.error("Exception rendering widget %s: %s" % (w.name, e))
             if settings.DEBUG:
@@ -99,6 +120,39 @@ class Dashboard:
             else:
                 return HttpResponseServerError("Server error")
 
+    @staticmethod
+    def getCacheKey(request, widget):
+        """
+        Returns the cache key for the response of an asynchronous widget.
+        It includes the version of the data, so results become obsolete when
+        a task such as a plan run finishes or when an edit is saved.
+        The user preferences for the reporting horizon are part of the key,
+        since many widgets display data within that horizon.
+        """
+        user = request.user
+        return "widget_%s_%s" % (
+            request.database,
+            hashlib.md5(
+                (
+                    "%s%s%r%s%r"
+                    % (
+                        PlanVersion.getVersion(request.database),
+                        widget.name,
+                        sorted(request.GET.lists()),
+                        get_language(),
+                        (
+                            getattr(user, "horizonbuckets", None),
+                            getattr(user, "horizonstart", None),
+                            getattr(user, "horizonend", None),
+                            getattr(user, "horizontype", None),
+                            getattr(user, "horizonlength", None),
+                            getattr(user, "horizonunit", None),
+                        ),
+                    )
+                ).encode("utf-8")
+            ).hexdigest(),
+        )
+
     @classmethod
     def createWidgetPermissions(cls, app):
         # Registered all permissions defined by dashboard widgets
@@ -142,6 +196,8 @@ class Widget:
       It returns a HTTPResponse object for asynchronous widgets.
     - Class attribute 'url' optionally defines a url to a report with a more
       complete content than can be displayed in the dashboard widget.
+    - Class attribute 'cacheable' can be set to false for asynchronous widgets
+      that display more than the data in the database.
   """
 
     name = "Undefined"
@@ -151,6 +207,7 @@ class Widget:
     url = None  # URL opened when the header is clicked
     exporturl = False  # Enable or disable a download icon
     args = ""  # Arguments passed in the url for asynchronous widgets
+    cacheable = True  # Cache the response of asynchronous widgets
     javascript = ""  # Javascript called for rendering the widget
 
     def __init__(self, **options):
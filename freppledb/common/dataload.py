@@ -17,13 +17,15 @@
 
 from datetime import timedelta, datetime
 from decimal import Decimal
+from io import StringIO
 from logging import INFO, ERROR, WARNING, DEBUG
 
 from django import forms
 from django.contrib.admin.models import LogEntry, CHANGE, ADDITION
 from django.contrib.contenttypes.models import ContentType
 from django.core.validators import EMPTY_VALUES
-from django.db import DEFAULT_DB_ALIAS
+from django.db import connections, models, transaction, DEFAULT_DB_ALIAS
+from django.db.models import Q
 from django.db.models.fields import (
     IntegerField,
     AutoField,
@@ -45,6 +47,12 @@ from django.utils.translation import gettext_lazy as _
 from django.utils.encoding import force_text
 from django.utils.text import get_text_list
 
+from freppledb.common.models import AuditModel, bulkSave, bulkSaveFinish
+from freppledb.execute.models import PlanVersion
+
+# Number of records validated and saved together in the bulk upload mode
+UPLOAD_BATCH_SIZE = 1000
+
 
 def parseExcelWorksheet(model, data, user=None, database=DEFAULT_DB_ALIAS, ping=False):
     class MappedRow:
@@ -273,6 +281,235 @@ def _parseData(model, data, rowmapper, user, database, ping):
         else:
             return f.formfield(localize=True)
 
+    def processBatch(batch):
+        """
+        Validates and saves a list of data rows.
+        In bulk mode, the existing records and foreign keys are retrieved with
+        a single query for the complete batch, and the valid records are
+        written with a COPY statement into a staging table, merged into the
+        model table with a single statement.
+        """
+        nonlocal errors, changed, added, admin_log, pingcounter
+
+        if bulk:
+            existing = prefetchRecords(
+                model, batch, rowWrapper, has_pk_field, natural_key, database
+            )
+            prefetchForeignKeys(UploadForm, batch, rowWrapper)
+            pending = {}
+            saved = []
+
+        for rownumber, row in batch:
+            rowWrapper.setData(row)
+            try:
+                # Step 1: Send a ping-alive message to make the upload interruptable
+                if ping:
+                    pingcounter += 1
+                    if pingcounter >= 100:
+                        pingcounter = 0
+                        yield (DEBUG, rownumber, None, None, None)
+
+                # Step 2: Fill the form with data, either updating an existing
+                # instance or creating a new one.
+                if bulk and (has_pk_field or natural_key):
+                    # Look up the record among the ones retrieved for the batch
+                    try:
+                        key = getRecordKey(model, rowWrapper, has_pk_field, natural_key)
+                    except Exception:
+                        key = None
+                    it = pending.get(key, None) if key is not None else None
+                    if it is None and key is not None:
+                        it = existing.get(key, None)
+                    if it is model.MultipleObjectsReturned:
+                        yield (
+                            ERROR,
+                            rownumber,
+                            None,
+                            None,
+                            force_text(_("Key fields not unique")),
+                        )
+                        continue
+                    form = (
+                        UploadForm(rowWrapper, instance=it)
+                        if it
+                        else UploadForm(rowWrapper)
+                    )
+                elif has_pk_field:
+                    # A primary key is part of the input fields
+                    try:
+                        # Try to find an existing record with the same primary key
+                        it = (
+                            model.objects.using(database)
+                            .only(*fields)
+                            .get(pk=rowWrapper[model._meta.pk.name])
+                        )
+                        form = UploadForm(rowWrapper, instance=it)
+                    except model.DoesNotExist:
+                        form = UploadForm(rowWrapper)
+                        it = None
+                elif natural_key:
+                    # A natural key exists for this model
+                    try:
+                        # Build the natural key
+                        key = []
+                        for x in natural_key:
+                            key.append(rowWrapper.get(x, None))
+                        # Try to find an existing record using the natural key
+                        it = model.objects.get_by_natural_key(*key)
+                        form = UploadForm(rowWrapper, instance=it)
+                    except model.DoesNotExist:
+                        form = UploadForm(rowWrapper)
+                        it = None
+                    except model.MultipleObjectsReturned:
+                        yield (
+                            ERROR,
+                            rownumber,
+                            None,
+                            None,
+                            force_text(_("Key fields not unique")),
+                        )
+                        continue
+                else:
+                    # No primary key required for this model
+                    form = UploadForm(rowWrapper)
+                    it = None
+
+                # Step 3: Validate the form and model, and save to the database
+                if form.has_changed():
+                    if form.is_valid():
+                        # Save the form
+                        obj = form.save(commit=False)
+                        if bulk:
+                            # Saved at the end of the batch
+                            saved.append((rownumber, obj, it, form.changed_data))
+                            if has_pk_field or natural_key:
+                                try:
+                                    pending[
+                                        getRecordKey(
+                                            model,
+                                            obj,
+                                            has_pk_field,
+                                            natural_key,
+                                            instance=True,
+                                        )
+                                    ] = obj
+                                except Exception:
+                                    pass
+                            if not it and obj.pk is not None:
+                                # Add the new object in the cache of available keys
+                                for x in selfReferencing:
+                                    if x.cache is not None:
+                                        x.cache.setdefault(obj.pk, obj)
+                                    elif x.prefetched is not None:
+                                        x.prefetched.setdefault(obj.pk, obj)
+                            continue
+                        # Some models postpone the updates of related
+                        # records till all rows are saved
+                        with bulkSave(model, database, deferred):
+                            if it:
+                                changed += 1
+                                obj.save(using=database, force_update=True)
+                            else:
+                                added += 1
+                                obj.save(using=database, force_insert=True)
+                            # Add the new object in the cache of available keys
+                            for x in selfReferencing:
+                                if x.cache is not None and obj.pk not in x.cache:
+                                    x.cache[obj.pk] = obj
+                        if user:
+                            admin_log.append(
+                                LogEntry(
+                                    user_id=user.id,
+                                    content_type_id=content_type_id,
+                                    object_id=obj.pk,
+                                    object_repr=force_text(obj)[:200],
+                                    action_flag=it and CHANGE or ADDITION,
+                                    change_message="Changed %s."
+                                    % get_text_list(form.changed_data, "and"),
+                                )
+                            )
+                            if len(admin_log) > 100:
+                                LogEntry.objects.all().using(database).bulk_create(
+                                    admin_log
+                                )
+                                admin_log = []
+                    else:
+                        # Validation fails
+                        for error in form.non_field_errors():
+                            errors += 1
+                            yield (ERROR, rownumber, None, None, error)
+                        for field in form:
+                            for error in field.errors:
+                                errors += 1
+                                yield (
+                                    ERROR,
+                                    rownumber,
+                                    field.name,
+                                    rowWrapper[field.name],
+                                    error,
+                                )
+
+            except Exception as e:
+                errors += 1
+                yield (ERROR, None, None, None, "Exception during upload: %s" % e)
+
+        # Write all valid records of the batch with a single statement. When
+        # that fails, we save the records one by one to report the failing rows.
+        if bulk and saved:
+            try:
+                saveRecords(
+                    model,
+                    [(obj, it, changed_data) for r, obj, it, changed_data in saved],
+                    [i for i in headers if i],
+                    database,
+                )
+            except Exception:
+                pending = saved
+                saved = []
+                done = set()
+                for rownumber, obj, it, changed_data in pending:
+                    if id(obj) not in done:
+                        sid = transaction.savepoint(using=database)
+                        try:
+                            if it:
+                                obj.save(using=database, force_update=True)
+                            else:
+                                obj.save(using=database, force_insert=True)
+                            transaction.savepoint_commit(sid)
+                        except Exception as e:
+                            transaction.savepoint_rollback(sid)
+                            errors += 1
+                            yield (
+                                ERROR,
+                                rownumber,
+                                None,
+                                None,
+                                "Exception during upload: %s" % e,
+                            )
+                            continue
+                        done.add(id(obj))
+                    saved.append((rownumber, obj, it, changed_data))
+            for rownumber, obj, it, changed_data in saved:
+                if it:
+                    changed += 1
+                else:
+                    added += 1
+                if user:
+                    admin_log.append(
+                        LogEntry(
+                            user_id=user.id,
+                            content_type_id=content_type_id,
+                            object_id=obj.pk,
+                            object_repr=force_text(obj)[:200],
+                            action_flag=it and CHANGE or ADDITION,
+                            change_message="Changed %s."
+                            % get_text_list(changed_data, "and"),
+                        )
+                    )
+            if len(admin_log) > 100:
+                LogEntry.objects.all().using(database).bulk_create(admin_log)
+                admin_log = []
+
     # Initialize
     headers = []
     rownumber = 0
@@ -282,6 +519,8 @@ def _parseData(model, data, rowmapper, user, database, ping):
     content_type_id = ContentType.objects.get_for_model(model).pk
     admin_log = []
 
+    deferred = set()
+
     # Call the beforeUpload method if it is defined
     if hasattr(model, "beforeUpload"):
         model.beforeUpload(database)
@@ -291,6 +530,8 @@ def _parseData(model, data, rowmapper, user, database, ping):
     has_pk_field = False
     processed_header = False
     rowWrapper = rowmapper()
+    batch = []
+    bulk = False
     for row in data:
 
         rownumber += 1
@@ -409,109 +650,28 @@ def _parseData(model, data, rowmapper, user, database, ping):
                 ):
                     natural_key = model.natural_key
 
+            # Models without custom saving logic are validated and saved in batches
+            bulk = bulkUploadAllowed(model, natural_key)
+
         # Case 3: Process a data row
         else:
-            try:
-                # Step 1: Send a ping-alive message to make the upload interruptable
-                if ping:
-                    pingcounter += 1
-                    if pingcounter >= 100:
-                        pingcounter = 0
-                        yield (DEBUG, rownumber, None, None, None)
+            batch.append((rownumber, row))
+            if len(batch) >= (UPLOAD_BATCH_SIZE if bulk else 1):
+                for msg in processBatch(batch):
+                    yield msg
+                batch = []
 
-                # Step 2: Fill the form with data, either updating an existing
-                # instance or creating a new one.
-                if has_pk_field:
-                    # A primary key is part of the input fields
-                    try:
-                        # Try to find an existing record with the same primary key
-                        it = (
-                            model.objects.using(database)
-                            .only(*fields)
-                            .get(pk=rowWrapper[model._meta.pk.name])
-                        )
-                        form = UploadForm(rowWrapper, instance=it)
-                    except model.DoesNotExist:
-                        form = UploadForm(rowWrapper)
-                        it = None
-                elif natural_key:
-                    # A natural key exists for this model
-                    try:
-                        # Build the natural key
-                        key = []
-                        for x in natural_key:
-                            key.append(rowWrapper.get(x, None))
-                        # Try to find an existing record using the natural key
-                        it = model.objects.get_by_natural_key(*key)
-                        form = UploadForm(rowWrapper, instance=it)
-                    except model.DoesNotExist:
-                        form = UploadForm(rowWrapper)
-                        it = None
-                    except model.MultipleObjectsReturned:
-                        yield (
-                            ERROR,
-                            rownumber,
-                            None,
-                            None,
-                            force_text(_("Key fields not unique")),
-                        )
-                        continue
-                else:
-                    # No primary key required for this model
-                    form = UploadForm(rowWrapper)
-                    it = None
+    # Process the remaining rows
+    if batch:
+        for msg in processBatch(batch):
+            yield msg
 
-                # Step 3: Validate the form and model, and save to the database
-                if form.has_changed():
-                    if form.is_valid():
-                        # Save the form
-                        obj = form.save(commit=False)
-                        if it:
-                            changed += 1
-                            obj.save(using=database, force_update=True)
-                        else:
-                            added += 1
-                            obj.save(using=database, force_insert=True)
-                            # Add the new object in the cache of available keys
-                            for x in selfReferencing:
-                                if x.cache is not None and obj.pk not in x.cache:
-                                    x.cache[obj.pk] = obj
-                        if user:
-                            admin_log.append(
-                                LogEntry(
-                                    user_id=user.id,
-                                    content_type_id=content_type_id,
-                                    object_id=obj.pk,
-                                    object_repr=force_text(obj)[:200],
-                                    action_flag=it and CHANGE or ADDITION,
-                                    change_message="Changed %s."
-                                    % get_text_list(form.changed_data, "and"),
-                                )
-                            )
-                            if len(admin_log) > 100:
-                                LogEntry.objects.all().using(database).bulk_create(
-                                    admin_log
-                                )
-                                admin_log = []
-                    else:
-                        # Validation fails
-                        for error in form.non_field_errors():
-                            errors += 1
-                            yield (ERROR, rownumber, None, None, error)
-                        for field in form:
-                            for error in field.errors:
-                                errors += 1
-                                yield (
-                                    ERROR,
-                                    rownumber,
-                                    field.name,
-                                    rowWrapper[field.name],
-                                    error,
-                                )
+    # Update the records related to the saved ones
+    bulkSaveFinish(model, deferred, database)
 
-            except Exception as e:
-                errors += 1
-                yield (ERROR, None, None, None, "Exception during upload: %s" % e)
+    # Invalidate the results computed from the old data
+    if changed or added:
+        PlanVersion.changed(database)
 
     # Save remaining admin log entries
     LogEntry.objects.all().using(database).bulk_create(admin_log)
@@ -534,6 +694,228 @@ def _parseData(model, data, rowmapper, user, database, ping):
     )
 
 
+def bulkUploadAllowed(model, natural_key):
+    """
+    Models without any custom logic in their save method can be uploaded
+    in batches, bypassing the save method of the individual records.
+    """
+    if model.save not in (models.Model.save, AuditModel.save):
+        return False
+    if hasattr(model, "getModelForm"):
+        return False
+    if model._meta.proxy or model._meta.parents:
+        return False
+    if natural_key:
+        for f in natural_key:
+            try:
+                if not model._meta.get_field(f).concrete:
+                    return False
+            except Exception:
+                return False
+    return True
+
+
+def _keyValue(field, value):
+    """
+    Normalizes a value for a key field, such that the values read from the
+    data file and from the database can be compared.
+    """
+    if value is None:
+        return None
+    if isinstance(value, models.Model):
+        value = value.pk
+    if field.is_relation:
+        field = field.target_field
+    return field.to_python(value)
+
+
+def getRecordKey(model, data, has_pk_field, natural_key, instance=False):
+    """
+    Returns the key to look up a record, either from a data row or
+    from a model instance.
+    """
+    if has_pk_field:
+        pk = model._meta.pk
+        return _keyValue(pk, data.pk if instance else data[pk.name])
+    key = []
+    for x in natural_key:
+        field = model._meta.get_field(x)
+        if instance:
+            key.append(_keyValue(field, getattr(data, field.attname)))
+        else:
+            key.append(_keyValue(field, data.get(x, None)))
+    return tuple(key)
+
+
+def prefetchRecords(model, batch, rowWrapper, has_pk_field, natural_key, database):
+    """
+    Retrieves the existing records for a batch of data rows with a single query.
+    The result is a dictionary with the key of the record as key. When a
+    natural key matches multiple records, the dictionary value is the
+    MultipleObjectsReturned exception class.
+    """
+    if not has_pk_field and not natural_key:
+        return {}
+    keys = set()
+    for rownumber, row in batch:
+        rowWrapper.setData(row)
+        try:
+            keys.add(getRecordKey(model, rowWrapper, has_pk_field, natural_key))
+        except Exception:
+            # Invalid keys will be reported during the validation
+            pass
+    if not keys:
+        return {}
+    if has_pk_field:
+        return model.objects.using(database).in_bulk([k for k in keys if k is not None])
+    field = model._meta.get_field(natural_key[0])
+    values = {k[0] for k in keys if k[0] is not None}
+    flt = Q(**{"%s__in" % field.attname: values})
+    if None in {k[0] for k in keys}:
+        flt |= Q(**{"%s__isnull" % field.attname: True})
+    result = {}
+    for obj in model.objects.using(database).filter(flt):
+        key = getRecordKey(model, obj, False, natural_key, instance=True)
+        if key not in keys:
+            continue
+        elif key in result:
+            result[key] = model.MultipleObjectsReturned
+        else:
+            result[key] = obj
+    return result
+
+
+def prefetchForeignKeys(form, batch, rowWrapper):
+    """
+    Retrieves the referenced records for a batch of data rows with a single
+    query per foreign key field.
+    """
+    for name, field in form.base_fields.items():
+        if isinstance(field, BulkForeignKeyFormField):
+            values = []
+            for rownumber, row in batch:
+                rowWrapper.setData(row)
+                values.append(rowWrapper.get(name, None))
+            field.prefetch(values)
+
+
+def _copyValue(value):
+    """
+    Formats a value for a COPY command in text format.
+    """
+    if value is None:
+        return "\\N"
+    elif isinstance(value, bool):
+        return "t" if value else "f"
+    elif isinstance(value, timedelta):
+        return "%s seconds" % value.total_seconds()
+    else:
+        return (
+            str(value)
+            .replace("\\", "\\\\")
+            .replace("\n", "\\n")
+            .replace("\r", "\\r")
+            .replace("\t", "\\t")
+        )
+
+
+def saveRecords(model, saved, headers, database):
+    """
+    Saves a list of validated model instances with a single statement.
+    The records are copied into a staging table, and then inserted in the
+    table of the model. Existing records only get the uploaded fields
+    updated.
+    """
+    # A record can be updated multiple times in a batch
+    objs = list({id(obj): obj for obj, it, changed_data in saved}.values())
+
+    meta = model._meta
+    pk = meta.pk
+    connection = connections[database]
+    qn = connection.ops.quote_name
+    staging = "tmp_upload_%s" % meta.db_table
+    columns = [f for f in meta.concrete_fields]
+    updated = [
+        f.column
+        for f in columns
+        if not f.primary_key and (f in headers or getattr(f, "auto_now", False))
+    ]
+    if issubclass(model, AuditModel):
+        now = datetime.now()
+        for obj in objs:
+            obj.lastmodified = now
+        if "lastmodified" not in updated:
+            updated.append("lastmodified")
+
+    with transaction.atomic(using=database):
+        with connection.cursor() as cursor:
+
+            # Allocate the primary keys of new records
+            if isinstance(pk, AutoField):
+                new = [obj for obj in objs if obj.pk is None]
+                if new:
+                    cursor.execute(
+                        "select nextval(pg_get_serial_sequence(%%s, %%s)) "
+                        "from generate_series(1, %s)" % len(new),
+                        (meta.db_table, pk.column),
+                    )
+                    for obj, rec in zip(new, cursor.fetchall()):
+                        obj.pk = rec[0]
+
+            # Copy the records into a staging table
+            data = StringIO()
+            for obj in objs:
+                data.write(
+                    "\t".join(
+                        _copyValue(
+                            f.get_db_prep_save(
+                                f.pre_save(obj, obj._state.adding), connection
+                            )
+                        )
+                        for f in columns
+                    )
+                )
+                data.write("\n")
+            data.seek(0)
+            cursor.execute(
+                "create temporary table %s as select %s from %s with no data"
+                % (
+                    staging,
+                    ",".join(qn(f.column) for f in columns),
+                    qn(meta.db_table),
+                )
+            )
+            cursor.copy_expert(
+                "copy %s (%s) from stdin"
+                % (staging, ",".join(qn(f.column) for f in columns)),
+                data,
+            )
+
+            # Insert new records and update existing ones
+            cursor.execute(
+                """
+                insert into %s (%s)
+                select %s from %s
+                on conflict (%s) do %s
+                """
+                % (
+                    qn(meta.db_table),
+                    ",".join(qn(f.column) for f in columns),
+                    ",".join(qn(f.column) for f in columns),
+                    staging,
+                    qn(pk.column),
+                    "update set %s"
+                    % ",".join("%s = excluded.%s" % (qn(c), qn(c)) for c in updated)
+                    if updated
+                    else "nothing",
+                )
+            )
+            cursor.execute("drop table %s" % staging)
+    for obj in objs:
+        obj._state.adding = False
+        obj._state.db = database
+
+
 class BulkForeignKeyFormField(forms.fields.Field):
     def __init__(
         self,
@@ -556,6 +938,7 @@ class BulkForeignKeyFormField(forms.fields.Field):
 
         # Build a cache with the list of values - as long as it reasonable fits in memory
         self.model = field.remote_field.model
+        self.prefetched = None
         field.remote_field.parent_link = (
             True
         )  # A trick to disable the model validation on foreign keys!
@@ -582,6 +965,13 @@ class BulkForeignKeyFormField(forms.fields.Field):
                     )
                 )
         else:
+            if self.prefetched is not None:
+                try:
+                    obj = self.prefetched.get(self.model._meta.pk.to_python(value))
+                except Exception:
+                    obj = None
+                if obj is not None:
+                    return obj
             try:
                 return self.queryset.get(pk=value)
             except self.model.DoesNotExist:
@@ -591,5 +981,22 @@ class BulkForeignKeyFormField(forms.fields.Field):
                     )
                 )
 
+    def prefetch(self, values):
+        """
+        Retrieves the records for a list of values with a single query,
+        when the model is too big to be cached completely.
+        """
+        if self.cache is not None:
+            return
+        keys = set()
+        for value in values:
+            if value in EMPTY_VALUES:
+                continue
+            try:
+                keys.add(self.model._meta.pk.to_python(value))
+            except Exception:
+                pass
+        self.prefetched = self.queryset.in_bulk(list(keys)) if keys else {}
+
     def has_changed(self, initial, data):
         return initial != data
@@ -27,12 +27,12 @@ from django.contrib.auth.models import AnonymousUser
 from django.middleware.locale import LocaleMiddleware as DjangoLocaleMiddleware
 from django.utils import translation
 from django.db import DEFAULT_DB_ALIAS
-from django.db.models import Q
 from django.http import HttpResponseNotFound
 from django.http.response import HttpResponseForbidden
 
 from freppledb.common.auth import MultiDBBackend
-from freppledb.common.models import Scenario, User
+from freppledb.common.models import AuditModel, Scenario, ScenarioCache, User
+from freppledb.execute.models import PlanVersion
 
 import logging
 
@@ -141,6 +141,35 @@ class LocaleMiddleware(DjangoLocaleMiddleware):
         return response
 
 
+def markDataChanged(sender, instance, **kwargs):
+    """
+    Used as a post_save and post_delete signal handler.
+    Records the database of an edited record on the current request, such
+    that the version of the data is incremented only once per request.
+    """
+    request = getattr(_thread_locals, "request", None)
+    if not request or not isinstance(instance, AuditModel):
+        return
+    database = kwargs.get("using", None) or instance._state.db or DEFAULT_DB_ALIAS
+    if hasattr(request, "datachanged"):
+        request.datachanged.add(database)
+    else:
+        request.datachanged = {database}
+
+
+def updatePlanVersion(request):
+    """
+    Increments the version of the data after a request that edited records,
+    which invalidates the cached dashboard widgets.
+    This runs before a streaming response is generated. Code saving data while
+    the content is streamed, like the data upload, calls PlanVersion.changed
+    itself.
+    """
+    for database in getattr(request, "datachanged", ()):
+        PlanVersion.changed(database)
+    request.datachanged = set()
+
+
 def resetRequest(**kwargs):
     """
     Used as a request_finished signal handler.
@@ -148,9 +177,22 @@ def resetRequest(**kwargs):
     setattr(_thread_locals, "request", None)
 
 
-# Initialize the URL parsing middleware
-for i in settings.DATABASES:
-    settings.DATABASES[i]["regexp"] = re.compile("^/%s/" % i)
+# Initialize the URL parsing middleware: a single regular expression matches
+# the scenario prefix of a path. Longer names go first for names that are a
+# prefix of another one.
+scenarioPrefix = re.compile(
+    "^/(%s)/"
+    % "|".join(re.escape(i) for i in sorted(settings.DATABASES, key=len, reverse=True))
+)
+
+
+def getScenarioFromPath(path):
+    """
+    Returns the name of the database of a URL path, or None when the path
+    doesn't start with a scenario prefix.
+    """
+    match = scenarioPrefix.match(path)
+    return match.group(1) if match else None
 
 
 class MultiDBMiddleware:
@@ -181,26 +223,28 @@ class MultiDBMiddleware:
             request.user = auth.get_user(request)
         if not hasattr(request.user, "scenarios"):
             # A scenario list is not available on the request
-            for i in settings.DATABASES:
-                try:
-                    if settings.DATABASES[i]["regexp"].match(request.path):
-                        scenario = Scenario.objects.using(DEFAULT_DB_ALIAS).get(name=i)
-                        if scenario.status != "In use":
-                            return HttpResponseNotFound("Scenario not in use")
-                        request.prefix = "/%s" % i
-                        request.path_info = request.path_info[len(request.prefix) :]
-                        request.path = request.path[len(request.prefix) :]
-                        request.database = i
-                        if hasattr(request.user, "_state"):
-                            request.user._state.db = i.name
-                        response = self.get_response(request)
-                        if not response.streaming:
-                            # Note: Streaming response get the request field cleared in the
-                            # request_finished signal handler
-                            setattr(_thread_locals, "request", None)
-                        return response
-                except Exception:
-                    pass
+            name = getScenarioFromPath(request.path)
+            try:
+                scenario = ScenarioCache.getScenario(name) if name else None
+            except Exception:
+                # Eg when the default database has not been initialized yet
+                scenario = None
+            if scenario:
+                if scenario.status != "In use":
+                    return HttpResponseNotFound("Scenario not in use")
+                request.prefix = "/%s" % name
+                request.path_info = request.path_info[len(request.prefix) :]
+                request.path = request.path[len(request.prefix) :]
+                request.database = name
+                if hasattr(request.user, "_state"):
+                    request.user._state.db = name
+                response = self.get_response(request)
+                updatePlanVersion(request)
+                if not response.streaming:
+                    # Note: Streaming response get the request field cleared in the
+                    # request_finished signal handler
+                    setattr(_thread_locals, "request", None)
+                return response
             request.prefix = ""
             request.database = DEFAULT_DB_ALIAS
             if hasattr(request.user, "_state"):
@@ -209,28 +253,27 @@ class MultiDBMiddleware:
             # A list of scenarios is already available
             if request.user.is_anonymous:
                 return self.get_response(request)
+            name = getScenarioFromPath(request.path)
             default_scenario = None
             for i in request.user.scenarios:
                 if i.name == DEFAULT_DB_ALIAS:
                     default_scenario = i
-                try:
-                    if settings.DATABASES[i.name]["regexp"].match(request.path):
-                        request.prefix = "/%s" % i.name
-                        request.path_info = request.path_info[len(request.prefix) :]
-                        request.path = request.path[len(request.prefix) :]
-                        request.database = i.name
-                        request.scenario = i
-                        if hasattr(request.user, "_state"):
-                            request.user._state.db = i.name
-                        request.user.is_superuser = i.is_superuser
-                        response = self.get_response(request)
-                        if not response.streaming:
-                            # Note: Streaming response get the request field cleared in the
-                            # request_finished signal handler
-                            setattr(_thread_locals, "request", None)
-                        return response
-                except Exception:
-                    pass
+                if i.name == name:
+                    request.prefix = "/%s" % i.name
+                    request.path_info = request.path_info[len(request.prefix) :]
+                    request.path = request.path[len(request.prefix) :]
+                    request.database = i.name
+                    request.scenario = i
+                    if hasattr(request.user, "_state"):
+                        request.user._state.db = i.name
+                    request.user.is_superuser = i.is_superuser
+                    response = self.get_response(request)
+                    updatePlanVersion(request)
+                    if not response.streaming:
+                        # Note: Streaming response get the request field cleared in the
+                        # request_finished signal handler
+                        setattr(_thread_locals, "request", None)
+                    return response
             request.prefix = ""
             request.database = DEFAULT_DB_ALIAS
             if hasattr(request.user, "_state"):
@@ -240,6 +283,7 @@ class MultiDBMiddleware:
             else:
                 request.scenario = Scenario(name=DEFAULT_DB_ALIAS)
         response = self.get_response(request)
+        updatePlanVersion(request)
         if not response.streaming:
             # Note: Streaming response get the request field cleared in the
             # request_finished signal handler
@@ -265,27 +309,7 @@ class AutoLoginAsAdminUser:
                 user = User.objects.get(username="admin")
                 user.backend = settings.AUTHENTICATION_BACKENDS[0]
                 login(request, user)
-                request.user.scenarios = []
-                for db in Scenario.objects.using(DEFAULT_DB_ALIAS).filter(
-                    Q(status="In use") | Q(name=DEFAULT_DB_ALIAS)
-                ):
-                    if not db.description:
-                        db.description = db.name
-                    if db.name == DEFAULT_DB_ALIAS:
-                        if request.user.is_active:
-                            db.is_superuser = request.user.is_superuser
-                            request.user.scenarios.append(db)
-                    else:
-                        try:
-                            user2 = User.objects.using(db.name).get(
-                                username=request.user.username
-                            )
-                            if user2.is_active:
-                                db.is_superuser = user2.is_superuser
-                                request.user.scenarios.append(db)
-                        except Exception:
-                            # Silently ignore errors. Eg user doesn't exist in scenario
-                            pass
+                MultiDBBackend.getScenarios(request.user)
             except User.DoesNotExist:
                 pass
         return self.get_response(request)
@@ -0,0 +1,58 @@
+#
+# Copyright (C) 2020 by frePPLe bv
+#
+# This library is free software; you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero
+# General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [("common", "0019_scenario_url")]
+
+    operations = [
+        migrations.RunSQL(
+            """
+            create or replace function common_parameter_notify() returns trigger as $$
+            declare
+              pname varchar;
+            begin
+              if tg_op = 'DELETE' then
+                pname := old.name;
+              elsif tg_op in ('INSERT', 'UPDATE') then
+                pname := new.name;
+              end if;
+              -- The heartbeat of the worker changes every few seconds
+              if pname is distinct from 'Worker alive' then
+                perform pg_notify('frepple_parameter', '');
+              end if;
+              return null;
+            end;
+            $$ language plpgsql;
+
+            create trigger common_parameter_notify
+            after insert or update or delete on common_parameter
+            for each row execute procedure common_parameter_notify();
+
+            create trigger common_parameter_truncate
+            after truncate on common_parameter
+            for each statement execute procedure common_parameter_notify();
+            """,
+            """
+            drop trigger common_parameter_truncate on common_parameter;
+            drop trigger common_parameter_notify on common_parameter;
+            drop function common_parameter_notify();
+            """,
+        )
+    ]
@@ -0,0 +1,43 @@
+#
+# Copyright (C) 2020 by frePPLe bv
+#
+# This library is free software; you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero
+# General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [("common", "0020_parameter_notify")]
+
+    operations = [
+        migrations.RunSQL(
+            """
+            create or replace function common_scenario_notify() returns trigger as $$
+            begin
+              perform pg_notify('frepple_scenario', '');
+              return null;
+            end;
+            $$ language plpgsql;
+
+            create trigger common_scenario_notify
+            after insert or update or delete or truncate on common_scenario
+            for each statement execute procedure common_scenario_notify();
+            """,
+            """
+            drop trigger common_scenario_notify on common_scenario;
+            drop function common_scenario_notify();
+            """,
+        )
+    ]
@@ -14,10 +14,16 @@
 # You should have received a copy of the GNU Affero General Public
 # License along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
+from contextlib import contextmanager
+from copy import copy
 from datetime import datetime
 import json
 import logging
+import os
+from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
 from psycopg2.extras import execute_batch
+from threading import Lock, local
+import time
 
 from django.conf import settings
 from django.contrib.admin.utils import quote
@@ -59,31 +65,254 @@ class HierarchyModel(models.Model):
         on_delete=models.SET_NULL,
     )
 
+    # Nodes saved in a deferHierarchy block, per thread, database and table
+    _pendingHierarchy = local()
+
+    @classmethod
+    def _getPendingNodes(cls, database):
+        return getattr(cls._pendingHierarchy, "blocks", {}).get(
+            (database, cls._meta.db_table), None
+        )
+
+    @classmethod
+    @contextmanager
+    def deferHierarchy(cls, database=DEFAULT_DB_ALIAS, pending=None):
+        """
+        Context manager to save many nodes at once. The first node that is
+        added or moved updates the nested set incrementally. Rather than
+        doing the same for every other node, the next ones are marked and the
+        hierarchy is rebuilt once when leaving the block.
+        When a set is passed as argument, the names of the added and moved
+        nodes are added to it, and the caller needs to call rebuildHierarchy.
+        """
+        if cls._getPendingNodes(database) is not None:
+            # Nested block
+            yield
+            return
+        if not hasattr(cls._pendingHierarchy, "blocks"):
+            cls._pendingHierarchy.blocks = {}
+        key = (database, cls._meta.db_table)
+        nodes = set() if pending is None else pending
+        cls._pendingHierarchy.blocks[key] = nodes
+        try:
+            yield
+        finally:
+            del cls._pendingHierarchy.blocks[key]
+        if pending is None and nodes:
+            cls.rebuildHierarchy(database)
+
     def save(self, *args, **kwargs):
-        # Trigger recalculation of the hieracrhy.
-        # TODO this triggers the recalculation in too many cases, including a lot
-        # of changes which don't require it. Alternative solution is to use the
-        # pre-save signal which has more information.
+        update_fields = kwargs.get("update_fields", None)
+        if update_fields is not None and "owner" not in update_fields:
+            # The hierarchy isn't affected
+            super().save(*args, **kwargs)
+            return
+
+        database = kwargs.get("using", None) or self._state.db or DEFAULT_DB_ALIAS
+        pending = self._getPendingNodes(database)
+        # Only the first node added or moved in a deferHierarchy block is
+        # positioned incrementally
+        defer = bool(pending)
+        with transaction.atomic(using=database):
+            # Retrieve the current position of the node in the hierarchy
+            old = (
+                self.__class__.objects.using(database)
+                .filter(pk=self.pk)
+                .values_list("owner", "lft", "rght", "lvl")
+                .first()
+            )
+            moved = not old or old[0] != self.owner_id
+            if old and not (moved and defer):
+                self.lft, self.rght, self.lvl = old[1:]
+            else:
+                self.lft = None
+                self.rght = None
+                self.lvl = None
+
+            # Call the real save() method
+            super().save(*args, **kwargs)
+
+            # Move the node and its children to their new position in the hierarchy
+            if moved:
+                if pending is not None:
+                    pending.add(self.pk)
+                if not defer:
+                    self.moveNode(old, database)
+
+    def moveNode(self, old, database):
+        """
+        Incremental maintenance of the nested set of the hierarchy when a node
+        is added or gets a new owner.
+        Only the nodes between the old and new position of the subtree get
+        renumbered. When the incremental update isn't possible the node is
+        marked for a full rebuild of the hierarchy.
+        """
+        cls = self.__class__
+        table = connections[database].ops.quote_name(cls._meta.db_table)
+        with connections[database].cursor() as cursor:
+            # Block concurrent changes to the hierarchy
+            cursor.execute("lock table %s in share row exclusive mode" % table)
+
+            if (
+                self.owner_id == self.pk
+                or cls.objects.using(database)
+                .filter(lft__isnull=True)
+                .exclude(pk=self.pk)
+                .exists()
+            ):
+                # The hierarchy is invalid or needs a full rebuild anyway
+                self.markNode(database)
+                return
+
+            # Find the new position: as last child of the owner, or at the end
+            if self.owner_id:
+                parent = (
+                    cls.objects.using(database)
+                    .filter(pk=self.owner_id)
+                    .values_list("lft", "rght", "lvl")
+                    .first()
+                )
+                if not parent or parent[0] is None:
+                    self.markNode(database)
+                    return
+                pos = parent[1]
+                level = parent[2] + 1
+            else:
+                cursor.execute("select coalesce(max(rght), 0) from %s" % table)
+                pos = cursor.fetchone()[0] + 1
+                level = 0
+
+            if not old or old[1] is None:
+                # A new node is only inserted when it has no children yet
+                if cls.objects.using(database).filter(owner=self.pk).exists():
+                    self.markNode(database)
+                    return
+                cursor.execute(
+                    """
+                    update %s set
+                      lft = case when lft >= %%s then lft + 2 else lft end,
+                      rght = rght + 2
+                    where rght >= %%s
+                    """
+                    % table,
+                    (pos, pos),
+                )
+                self.lft = pos
+                self.rght = pos + 1
+                self.lvl = level
+            else:
+                left, right, lvl = old[1:]
+                width = right - left + 1
+                if left < pos <= right:
+                    # The new owner is a child of the node
+                    self.markNode(database)
+                    return
+                if pos > right:
+                    # Move to the right: shift the nodes in between to the left
+                    low, high = right + 1, pos - 1
+                    delta_subtree, delta_other = pos - right - 1, -width
+                else:
+                    # Move to the left: shift the nodes in between to the right
+                    low, high = pos, left - 1
+                    delta_subtree, delta_other = pos - left, width
+                cursor.execute(
+                    """
+                    update %s set
+                      lft = case
+                        when lft between %%s and %%s then lft + %%s
+                        when lft between %%s and %%s then lft + %%s
+                        else lft end,
+                      rght = case
+                        when rght between %%s and %%s then rght + %%s
+                        when rght between %%s and %%s then rght + %%s
+                        else rght end,
+                      lvl = case
+                        when lft between %%s and %%s then lvl + %%s
+                        else lvl end
+                    where lft between %%s and %%s or rght between %%s and %%s
+                    """
+                    % table,
+                    (
+                        left,
+                        right,
+                        delta_subtree,
+                        low,
+                        high,
+                        delta_other,
+                        left,
+                        right,
+                        delta_subtree,
+                        low,
+                        high,
+                        delta_other,
+                        left,
+                        right,
+                        level - lvl,
+                        min(left, low),
+                        max(right, high),
+                        min(left, low),
+                        max(right, high),
+                    ),
+                )
+                self.lft = left + delta_subtree
+                self.rght = right + delta_subtree
+                self.lvl = level
+                return
+            cursor.execute(
+                "update %s set lft=%%s, rght=%%s, lvl=%%s where name = %%s" % table,
+                (self.lft, self.rght, self.lvl, self.pk),
+            )
+
+    def markNode(self, database):
+        """
+        Marks the node such that the hierarchy gets rebuilt when it's used.
+        """
         self.lft = None
         self.rght = None
         self.lvl = None
-
-        # Call the real save() method
-        super().save(*args, **kwargs)
+        self.__class__.objects.using(database).filter(pk=self.pk).update(
+            lft=None, rght=None, lvl=None
+        )
 
     def delete(self, *args, **kwargs):
-        try:
-            # Update an arbitrary other object to trigger recalculation of the hierarchy
-            obj = self.__class__.objects.using(self._state.db).exclude(pk=self.pk)[0]
-            obj.lft = None
-            obj.rght = None
-            obj.lvl = None
-            obj.save(update_fields=["lft", "rght", "lvl"], using=self._state.db)
-        except Exception:
-            # Failure can happen when eg we delete the last record
-            pass
-        # Call the real delete() method
-        super().delete(*args, **kwargs)
+        cls = self.__class__
+        database = kwargs.get("using", None) or self._state.db or DEFAULT_DB_ALIAS
+        table = connections[database].ops.quote_name(cls._meta.db_table)
+        with transaction.atomic(using=database):
+            with connections[database].cursor() as cursor:
+                # Block concurrent changes to the hierarchy
+                cursor.execute("lock table %s in share row exclusive mode" % table)
+                old = (
+                    cls.objects.using(database)
+                    .filter(pk=self.pk)
+                    .values_list("lft", "rght")
+                    .first()
+                )
+                if cls.objects.using(database).filter(owner=self.pk).exists():
+                    # The children of the node are moved to the top of the
+                    # hierarchy, which requires a full rebuild
+                    cls.objects.using(database).filter(owner=self.pk).update(
+                        lft=None, rght=None, lvl=None
+                    )
+                    old = None
+
+                # Call the real delete() method
+                super().delete(*args, **kwargs)
+
+                # Close the gap left by the node in the nested set
+                if old and old[0] is not None and old[1] is not None:
+                    left, right = old
+                    width = right - left + 1
+                    cursor.execute(
+                        """
+                        update %s set
+                          lft = case when lft > %%s then lft - %%s else lft end,
+                          rght = rght - %%s
+                        where rght > %%s
+                        """
+                        % table,
+                        (right, width, width, right),
+                    )
 
     class Meta:
         abstract = True
@@ -97,27 +326,42 @@ class HierarchyModel(models.Model):
             return
 
         nodes = {}
+        current = {}
         children = {}
         updates = []
 
-        def tagChildren(me, left, level):
+        def tagChildren(root, left):
+            # Depth-first traversal of the subtree, using a stack rather
+            # than recursion to support deep hierarchies
+            stack = [(root, left, 0, iter(sorted(children.get(root, []))))]
             right = left + 1
-            # Get all children of this node
-            for i in children.get(me, []):
-                # Recursive execution of this function for each child of this node
-                right = tagChildren(i, right, level + 1)
+            while stack:
+                me, lft, level, todo = stack[-1]
+                child = next(todo, None)
+                if child is not None:
+                    stack.append(
+                        (child, right, level + 1, iter(sorted(children.get(child, []))))
+                    )
+                    right += 1
+                    continue
+                stack.pop()
 
-            # After processing the children of this node now know its left and right values
-            updates.append((left, right, level, me))
+                # After processing the children of this node now know its left and right values
+                if current[me] != (lft, right, level):
+                    updates.append((lft, right, level, me))
 
-            # Remove from node list (to mark as processed)
-            del nodes[me]
+                # Remove from node list (to mark as processed)
+                del nodes[me]
+                right += 1
 
-            # Return the right value of this node + 1
-            return right + 1
+            # Return the right value of the root + 1
+            return right
 
         # Load all nodes in memory
-        for i in cls.objects.using(database).values("name", "owner"):
+        for i in cls.objects.using(database).values(
+            "name", "owner", "lft", "rght", "lvl"
+        ):
+            current[i["name"]] = (i["lft"], i["rght"], i["lvl"])
             if i["name"] == i["owner"]:
                 logging.error("Data error: '%s' points to itself as owner" % i["name"])
                 nodes[i["name"]] = None
@@ -133,7 +377,7 @@ class HierarchyModel(models.Model):
         cnt = 1
         for i, j in keys:
             if j is None:
-                cnt = tagChildren(i, cnt, 0)
+                cnt = tagChildren(i, cnt)
 
         if nodes:
             # If the nodes dictionary isn't empty, it is an indication of an
@@ -144,7 +388,7 @@ class HierarchyModel(models.Model):
             updated = True
             while updated:
                 updated = False
-                for i in bad.keys():
+                for i in list(bad.keys()):
                     ok = True
                     for j, k in bad.items():
                         if k == i:
@@ -163,7 +407,7 @@ class HierarchyModel(models.Model):
             keys = sorted(nodes.items())
             for i, j in keys:
                 if j is None:
-                    cnt = tagChildren(i, cnt, 0)
+                    cnt = tagChildren(i, cnt)
 
         # Write all results to the database
         with transaction.atomic(using=database):
@@ -191,16 +435,11 @@ class HierarchyModel(models.Model):
             o = cls.objects.using(database).get_or_create(name=rootname)
             if o[1]:
                 o[0].description = "Automatically created root object"
-            else:
-                o[
-                    0
-                ].lft = (
-                    None
-                )  # This is to force hierarchy rebuild that may not occur as all lft values are populated.
-            o[0].save()
+                o[0].save()
+            # Moving the other top-level objects triggers a rebuild of the hierarchy
             cls.objects.using(database).filter(owner__isnull=True).exclude(
                 name=rootname
-            ).update(owner=o[0])
+            ).update(owner=o[0], lft=None, rght=None, lvl=None)
 
             # Rebuild the hierarchy again with the new root
             cls.rebuildHierarchy(database=database)
@@ -240,6 +479,40 @@ class MultiDBRouter:
             return getattr(_thread_locals, "database", None)
 
 
+@contextmanager
+def bulkSave(model, database=DEFAULT_DB_ALIAS, pending=None):
+    """
+    Context manager to wrap the saving of many records of a model.
+    Models with a deferPropagation method postpone the update of the related
+    records till the end of the block.
+    Hierarchical models rebuild the hierarchy once at the end of the block.
+    When a set is passed as the pending argument, the keys of the saved
+    records are collected in it instead, and the caller is responsible for
+    calling bulkSaveFinish afterwards.
+    """
+    if hasattr(model, "deferPropagation"):
+        with model.deferPropagation(database, pending):
+            yield
+    elif issubclass(model, HierarchyModel):
+        with model.deferHierarchy(database, pending):
+            yield
+    else:
+        yield
+
+
+def bulkSaveFinish(model, pending, database=DEFAULT_DB_ALIAS):
+    """
+    Updates the records related to the records collected in the pending set
+    of one or more bulkSave blocks.
+    """
+    if not pending:
+        return
+    if hasattr(model, "propagateStatusBulk"):
+        model.propagateStatusBulk(pending, database)
+    elif issubclass(model, HierarchyModel):
+        model.rebuildHierarchy(database)
+
+
 class AuditModel(models.Model):
     """
   This is an abstract base model.
@@ -285,14 +558,153 @@ class Parameter(AuditModel):
         verbose_name = _("parameter")
         verbose_name_plural = _("parameters")
 
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        # Changes in this transaction aren't notified to other connections yet
+        if self.name not in ParameterCache.uncached:
+            ParameterCache.invalidate(kwargs.get("using", None) or self._state.db)
+
+    def delete(self, *args, **kwargs):
+        database = kwargs.get("using", None) or self._state.db
+        result = super().delete(*args, **kwargs)
+        if self.name not in ParameterCache.uncached:
+            ParameterCache.invalidate(database)
+        return result
+
     @staticmethod
     def getValue(key, database=DEFAULT_DB_ALIAS, default=None):
         try:
-            return Parameter.objects.using(database).only("value").get(pk=key).value
+            values = (
+                None if key in ParameterCache.uncached else ParameterCache.get(database)
+            )
+            if values is None:
+                return (
+                    Parameter.objects.using(database).only("value").get(pk=key).value
+                )
+            return values.get(key, default)
         except Exception:
             return default
 
 
+class NotifiedCache:
+    """
+    Base class for process-wide caches of a database table.
+
+    A trigger on the table sends a notification for every change. The
+    notifications are picked up on a dedicated connection, and invalidate
+    the cache. When we can't listen to the notifications, nothing is cached.
+
+    Subclasses define the notification channel, the load method and their
+    own cache and lock.
+    """
+
+    channel = None
+
+    # Cached data and listening connection per database and process id.
+    # A forked process gets a new entry, and leaves the connection of the
+    # parent process untouched.
+    cache = None
+    lock = None
+
+    @classmethod
+    def listen(cls, database):
+        from freppledb.common.report import create_connection
+
+        try:
+            conn = create_connection(database)
+            conn.ensure_connection()
+            conn.connection.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
+            with conn.connection.cursor() as cursor:
+                cursor.execute("listen %s" % cls.channel)
+            return conn.connection
+        except Exception as e:
+            logger.warning("Can't listen to %s notifications: %s" % (cls.channel, e))
+            return None
+
+    @classmethod
+    def load(cls, database):
+        raise NotImplementedError
+
+    @classmethod
+    def get(cls, database=DEFAULT_DB_ALIAS):
+        """
+        Returns the cached data, or None when the data can't be cached.
+        """
+        key = (database, os.getpid())
+        with cls.lock:
+            if key not in cls.cache:
+                cls.cache[key] = [cls.listen(database), None]
+            entry = cls.cache[key]
+            if not entry[0]:
+                return None
+            try:
+                # Check for notifications without a round trip to the server
+                entry[0].poll()
+                if entry[0].notifies:
+                    entry[0].notifies.clear()
+                    entry[1] = None
+            except Exception:
+                entry[0] = None
+                entry[1] = None
+                return None
+            if entry[1] is None:
+                data = cls.load(database)
+                if connections[database].in_atomic_block:
+                    # The data can include uncommitted changes of the current
+                    # transaction, which can still be rolled back
+                    return data
+                entry[1] = data
+            return entry[1]
+
+    @classmethod
+    def invalidate(cls, database=DEFAULT_DB_ALIAS):
+        with cls.lock:
+            entry = cls.cache.get((database, os.getpid()), None)
+            if entry:
+                entry[1] = None
+
+    @classmethod
+    def close(cls, database=DEFAULT_DB_ALIAS):
+        """
+        Closes the listening connections of this process to a database.
+        They are opened again when the cache is used next.
+        """
+        for subclass in cls.__subclasses__():
+            subclass.close(database)
+        if cls.cache is None:
+            return
+        with cls.lock:
+            entry = cls.cache.pop((database, os.getpid()), None)
+            if entry and entry[0]:
+                try:
+                    entry[0].close()
+                except Exception:
+                    pass
+
+
+class ParameterCache(NotifiedCache):
+    """
+    Cache of all parameters in a database, read with a single query.
+    """
+
+    channel = "frepple_parameter"
+    cache = {}
+    lock = Lock()
+
+    # Parameters that change too often to be cached. The notification
+    # trigger on the table skips them as well.
+    uncached = ("Worker alive",)
+
+    @classmethod
+    def load(cls, database):
+        return {
+            name: value
+            for name, value in Parameter.objects.using(database)
+            .exclude(name__in=cls.uncached)
+            .values_list("name", "value")
+        }
+
+
 class Scenario(models.Model):
     scenarioStatus = (("free", _("free")), ("in use", _("in use")), ("busy", _("busy")))
 
@@ -310,6 +722,15 @@ class Scenario(models.Model):
     def __str__(self):
         return self.name
 
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        ScenarioCache.invalidate()
+
+    def delete(self, *args, **kwargs):
+        result = super().delete(*args, **kwargs)
+        ScenarioCache.invalidate()
+        return result
+
     @staticmethod
     def syncWithSettings():
         try:
@@ -353,6 +774,89 @@ class Scenario(models.Model):
         ordering = ["name"]
 
 
+class ScenarioCache(NotifiedCache):
+    """
+    Cache of the scenarios, and of the scenarios each user has access to.
+
+    The scenarios are refreshed when the scenario table changes. The access
+    of a user is read from all scenario databases, and is only kept for a
+    short time because changes in the scenario databases aren't notified.
+    """
+
+    channel = "frepple_scenario"
+    cache = {}
+    lock = Lock()
+
+    # Number of seconds the scenario access of a user is cached
+    timeout = 10
+    users = {}
+
+    @classmethod
+    def load(cls, database):
+        cls.users.clear()
+        return {s.name: s for s in Scenario.objects.using(database)}
+
+    @classmethod
+    def getScenarios(cls):
+        return cls.get(DEFAULT_DB_ALIAS) or cls.load(DEFAULT_DB_ALIAS)
+
+    @classmethod
+    def getScenario(cls, name):
+        return cls.getScenarios().get(name, None)
+
+    @classmethod
+    def getUserScenarios(cls, user):
+        """
+        Returns the scenarios in which the user is active, and sets the
+        is_superuser attribute on each of them.
+        """
+        scenarios = cls.getScenarios()
+        now = time.time()
+        with cls.lock:
+            access = cls.users.get(user.username, None)
+        if not access or access[0] < now:
+            access = (now + cls.timeout, {})
+            for db in scenarios.values():
+                if db.name == DEFAULT_DB_ALIAS or db.status != "In use":
+                    continue
+                try:
+                    user2 = User.objects.using(db.name).get(username=user.username)
+                    if user2.is_active:
+                        access[1][db.name] = user2.is_superuser
+                except Exception:
+                    # Silently ignore errors. Eg user doesn't exist in scenario
+                    pass
+            with cls.lock:
+                cls.users[user.username] = access
+        result = []
+        for db in scenarios.values():
+            if db.name == DEFAULT_DB_ALIAS:
+                if not user.is_active:
+                    continue
+                is_superuser = user.is_superuser
+            elif db.status != "In use" or db.name not in access[1]:
+                continue
+            else:
+                is_superuser = access[1][db.name]
+            db = copy(db)
+            if not db.description:
+                db.description = db.name
+            db.is_superuser = is_superuser
+            result.append(db)
+        return result
+
+    @classmethod
+    def invalidate(cls, database=DEFAULT_DB_ALIAS):
+        super().invalidate(database)
+        with cls.lock:
+            cls.users.clear()
+
+    @classmethod
+    def invalidateUser(cls, username):
+        with cls.lock:
+            cls.users.pop(username, None)
+
+
 class User(AbstractUser):
     languageList = tuple(
         [("auto", _("Detect automatically"))] + list(settings.LANGUAGES)
@@ -527,6 +1031,7 @@ class User(AbstractUser):
                 .get_or_create(name=settings.DEFAULT_USER_GROUP)[0]
             )
             self.groups.add(grp.id)
+        ScenarioCache.invalidateUser(self.username)
         return usr
 
     def joined_age(self):
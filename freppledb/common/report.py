@@ -29,15 +29,19 @@ It provides the following functionality:
 """
 
 import codecs
+from contextlib import contextmanager
 import csv
 from datetime import date, datetime, timedelta, time
 from decimal import Decimal
 import functools
+import hashlib
 import logging
 import math
 import operator
 import json
+import os
 import re
+from threading import BoundedSemaphore, Lock
 from time import timezone, daylight
 from io import StringIO, BytesIO
 import urllib
@@ -48,7 +52,7 @@ from openpyxl.styles import NamedStyle, PatternFill
 from dateutil.parser import parse
 from openpyxl.comments import Comment as CellComment
 
-from django.db.models import Model
+from django.db.models import Model, Q
 from django.db.utils import DEFAULT_DB_ALIAS, load_backend
 from django.contrib.auth.models import Group
 from django.contrib.auth import get_permission_codename
@@ -57,7 +61,8 @@ from django.views.decorators.csrf import csrf_protect
 from django.contrib import messages
 from django.contrib.admin.views.decorators import staff_member_required
 from django.contrib.admin.utils import unquote, quote
-from django.core.exceptions import ValidationError
+from django.core.cache import cache
+from django.core.exceptions import FieldDoesNotExist, ValidationError
 from django.core.management.color import no_style
 from django.db import connections, transaction, models
 from django.db.models.fields import CharField, AutoField
@@ -85,8 +90,18 @@ from freppledb.common.models import (
     BucketDetail,
     Bucket,
     HierarchyModel,
+    AuditModel,
+    bulkSave,
+)
+from freppledb.execute.models import PlanVersion
+from freppledb.common.dataload import (
+    parseExcelWorksheet,
+    parseCSVdata,
+    bulkUploadAllowed,
+    saveRecords,
+    BulkForeignKeyFormField,
+    UPLOAD_BATCH_SIZE,
 )
-from freppledb.common.dataload import parseExcelWorksheet, parseCSVdata
 
 
 logger = logging.getLogger(__name__)
@@ -108,6 +123,78 @@ def create_connection(alias=DEFAULT_DB_ALIAS):
     return backend.DatabaseWrapper(db, alias)
 
 
+class SQLRoleConnectionPool:
+    """
+    A bounded pool of database connections to run user-defined SQL queries.
+
+    Each use of a connection is a transaction that runs in the role of the
+    SQL_ROLE database setting and with a statement timeout of
+    SQL_REPORT_TIMEOUT seconds. The role is set again in every transaction,
+    so a query can't leave a different role behind for the next user.
+    At most SQL_REPORT_POOLSIZE connections are opened per database and
+    process. Further requests wait for a connection to be released.
+    """
+
+    lock = Lock()
+    pools = {}
+
+    @classmethod
+    def _getPool(cls, database):
+        key = (database, os.getpid())
+        with cls.lock:
+            if key not in cls.pools:
+                cls.pools[key] = (
+                    BoundedSemaphore(getattr(settings, "SQL_REPORT_POOLSIZE", 4)),
+                    [],
+                )
+            return cls.pools[key]
+
+    @classmethod
+    @contextmanager
+    def connection(cls, database=DEFAULT_DB_ALIAS):
+        timeout = getattr(settings, "SQL_REPORT_TIMEOUT", 300)
+        semaphore, idle = cls._getPool(database)
+        if not semaphore.acquire(timeout=timeout or None):
+            raise Exception("No database connection available")
+        try:
+            conn = None
+            with cls.lock:
+                while idle and not conn:
+                    conn = idle.pop()
+                    if conn.closed:
+                        conn = None
+            if not conn:
+                wrapper = create_connection(database)
+                wrapper.ensure_connection()
+                conn = wrapper.connection
+                conn.autocommit = False
+            try:
+                # Both settings are sent in a single round trip
+                stmts = []
+                sqlrole = settings.DATABASES[database].get("SQL_ROLE", "report_role")
+                if sqlrole:
+                    stmts.append("set local role %s" % (sqlrole,))
+                if timeout:
+                    stmts.append("set local statement_timeout = %d" % (timeout * 1000))
+                if stmts:
+                    with conn.cursor() as cursor:
+                        cursor.execute(";".join(stmts))
+                yield conn
+                conn.commit()
+            except BaseException:
+                try:
+                    conn.rollback()
+                except Exception:
+                    pass
+                raise
+            finally:
+                if not conn.closed:
+                    with cls.lock:
+                        idle.append(conn)
+        finally:
+            semaphore.release()
+
+
 def matchesModelName(name, model):
     """
   Returns true if the first argument is a valid name for the model passed as second argument.
@@ -150,9 +237,7 @@ def matchesModelName(name, model):
 def getHorizon(request, future_only=False):
     # Pick up the current date
     try:
-        current = parse(
-            Parameter.objects.using(request.database).get(name="currentdate").value
-        )
+        current = parse(Parameter.getValue("currentdate", request.database))
     except Exception:
         current = datetime.now()
         current = current.replace(microsecond=0)
@@ -1360,11 +1445,18 @@ class GridReport(View):
                 )
         query = cls._apply_sort(request, request.query)
         if page:
-            cnt = (page - 1) * request.pagesize + 1
+            query = cls._get_page(request, query, page)
             if hasattr(cls, "query"):
-                return cls.query(request, query[cnt - 1 : cnt + request.pagesize])
+                return cls.query(request, query)
+            elif request.keyset:
+                return cls._save_keyset(
+                    request,
+                    query.values(
+                        *fields, *[i for i in request.keyset[1] if i not in fields]
+                    ),
+                )
             else:
-                return query[cnt - 1 : cnt + request.pagesize].values(*fields)
+                return query.values(*fields)
         else:
             if hasattr(cls, "query"):
                 return cls.query(request, query)
@@ -1372,6 +1464,136 @@ class GridReport(View):
                 fields = [i.field_name for i in request.rows if i.field_name]
                 return query.values(*fields)
 
+    @staticmethod
+    def _get_cache_key(prefix, request, query):
+        """
+        Returns a cache key identifying the SQL statement of a queryset.
+        """
+        sql, params = query.query.get_compiler(request.database).as_sql(
+            with_col_aliases=False
+        )
+        return "%s_%s_%s" % (
+            prefix,
+            request.database,
+            hashlib.md5(("%s%r" % (sql, params)).encode("utf-8")).hexdigest(),
+        )
+
+    @staticmethod
+    def _get_keyset_fields(query):
+        """
+        Returns the list of sort fields to use for keyset pagination, or None
+        when the sort order of the queryset doesn't allow it.
+        Only plain fields and annotations are supported. The primary key is
+        added as last sort field to make the order unique.
+        Querysets without an explicit order_by or with an extra ordering keep
+        using OFFSET pagination, since reordering them would change the
+        order in which the records are shown.
+        """
+        if not query.query.order_by or query.query.extra_order_by:
+            return None
+        fields = []
+        for f in query.query.order_by:
+            if not isinstance(f, str) or f == "?":
+                return None
+            name = f[1:] if f.startswith("-") else f
+            if name not in query.query.annotations:
+                model = query.model
+                field = None
+                try:
+                    for part in name.split("__"):
+                        if not model:
+                            return None
+                        field = (
+                            model._meta.pk
+                            if part == "pk"
+                            else model._meta.get_field(part)
+                        )
+                        model = field.related_model
+                except FieldDoesNotExist:
+                    return None
+                if not field or field.is_relation:
+                    return None
+                if field.primary_key and "__" not in name:
+                    fields.append(f)
+                    return fields
+            fields.append(f)
+        fields.append("pk")
+        return fields
+
+    @staticmethod
+    def _get_keyset_filter(fields, values):
+        """
+        Builds a filter selecting the records sorted after the given key.
+        PostgreSQL sorts null values last in ascending order.
+        """
+        result = None
+        for i, f in enumerate(fields):
+            name = f[1:] if f.startswith("-") else f
+            if f.startswith("-"):
+                cond = Q(**{"%s__lt" % name: values[i]})
+            else:
+                cond = Q(**{"%s__gt" % name: values[i]}) | Q(
+                    **{"%s__isnull" % name: True}
+                )
+            for g, v in zip(fields[:i], values[:i]):
+                cond &= Q(**{g[1:] if g.startswith("-") else g: v})
+            result = cond if result is None else result | cond
+        return result
+
+    @classmethod
+    def _get_page(cls, request, query, page):
+        """
+        Returns the records of a page.
+
+        The sort key of the last record of each page is cached. When the key
+        of the previous page is known, the page is selected with a keyset
+        condition rather than an OFFSET clause, which would otherwise require
+        the database to read and skip all records of the previous pages.
+        """
+        request.keyset = None
+        cnt = (page - 1) * request.pagesize + 1
+        fields = cls._get_keyset_fields(query)
+        if not fields:
+            return query[cnt - 1 : cnt + request.pagesize]
+        query = query.order_by(*fields)
+        try:
+            key = cls._get_cache_key("keyset_%s" % request.pagesize, request, query)
+        except Exception:
+            return query[cnt - 1 : cnt + request.pagesize]
+        if page == 1:
+            pagequery = query
+        else:
+            previous = cache.get("%s_%s" % (key, page - 1), None)
+            if previous is None:
+                return query[cnt - 1 : cnt + request.pagesize]
+            pagequery = query.filter(cls._get_keyset_filter(fields, previous))
+
+        # The key of the last record on this page is remembered while reading
+        # the records of the page
+        request.keyset = (
+            "%s_%s" % (key, page),
+            [f[1:] if f.startswith("-") else f for f in fields],
+        )
+        return pagequery[: request.pagesize + 1]
+
+    @staticmethod
+    def _save_keyset(request, rows):
+        """
+        Iterates over the records of a page, and caches the sort key of the
+        last record of the page for the selection of the next page.
+        """
+        key, names = request.keyset
+        for i, row in enumerate(rows):
+            if i == request.pagesize - 1:
+                last = tuple(row[n] for n in names)
+                if None not in last:
+                    cache.set(
+                        key,
+                        last,
+                        timeout=getattr(settings, "GRID_COUNT_CACHE_TIMEOUT", 60),
+                    )
+            yield row
+
     @classmethod
     def count_query(cls, request, *args, **kwargs):
         if not hasattr(request, "query"):
@@ -1383,12 +1605,37 @@ class GridReport(View):
                 request.query = cls.filter_items(request, cls.basequeryset).using(
                     request.database
                 )
+        tmp = request.query.query.get_compiler(request.database).as_sql(
+            with_col_aliases=False
+        )
+        key = cls._get_cache_key("count", request, request.query)
+        count = cache.get(key, None)
+        if count is not None:
+            return count
         with connections[request.database].cursor() as cursor:
-            tmp = request.query.query.get_compiler(request.database).as_sql(
-                with_col_aliases=False
-            )
-            cursor.execute("select count(*) from (" + tmp[0] + ") t_subquery", tmp[1])
-            return cursor.fetchone()[0]
+            count = None
+            if (
+                not request.query.query.where
+                and not request.query.query.distinct
+                and not request.query.query.group_by
+            ):
+                # Use the statistics of the database for very large tables
+                cursor.execute(
+                    "select reltuples::bigint from pg_class where oid = %s::regclass",
+                    (request.query.model._meta.db_table,),
+                )
+                estimate = cursor.fetchone()
+                if estimate and estimate[0] > getattr(
+                    settings, "GRID_COUNT_ESTIMATE_THRESHOLD", 1000000
+                ):
+                    count = estimate[0]
+            if count is None:
+                cursor.execute(
+                    "select count(*) from (" + tmp[0] + ") t_subquery", tmp[1]
+                )
+                count = cursor.fetchone()[0]
+        cache.set(key, count, timeout=getattr(settings, "GRID_COUNT_CACHE_TIMEOUT", 60))
+        return count
 
     @classmethod
     def _generate_json_data(cls, request, *args, **kwargs):
@@ -1738,146 +1985,339 @@ class GridReport(View):
         if not request.user.has_perm("%s.%s" % (cls.model._meta.app_label, permname)):
             return HttpResponseForbidden(_("Permission denied"))
 
-        # Loop over the data records
+        # Loop over the data records.
+        # Consecutive edits are validated and saved together, and the admin
+        # log entries are written in batches at the end.
         resp = HttpResponse()
         ok = True
-        with transaction.atomic(using=request.database, savepoint=False):
+        admin_log = []
+        with transaction.atomic(using=request.database, savepoint=False), bulkSave(
+            cls.model, request.database
+        ):
             content_type_id = ContentType.objects.get_for_model(cls.model).pk
+            edits = []
             for rec in json.JSONDecoder().decode(
                 request.read().decode(request.encoding or settings.DEFAULT_CHARSET)
             ):
+                if "delete" not in rec and "copy" not in rec:
+                    edits.append(rec)
+                    continue
+                if edits:
+                    if not cls._save_json_records(
+                        request, edits, content_type_id, resp, admin_log
+                    ):
+                        ok = False
+                    edits = []
                 if "delete" in rec:
-                    # Deleting records
-                    for key in rec["delete"]:
-                        sid = transaction.savepoint(using=request.database)
-                        try:
-                            obj = cls.model.objects.using(request.database).get(pk=key)
-                            obj.delete()
-                            LogEntry(
-                                user_id=request.user.id,
-                                content_type_id=content_type_id,
-                                object_id=force_str(key),
-                                object_repr=force_str(key)[:200],
-                                action_flag=DELETION,
-                            ).save(using=request.database)
-                            transaction.savepoint_commit(sid)
-                        except cls.model.DoesNotExist:
-                            transaction.savepoint_rollback(sid)
-                            ok = False
-                            resp.write(escape(_("Can't find %s" % key)))
-                            resp.write("<br>")
-                        except Exception as e:
-                            transaction.savepoint_rollback(sid)
-                            ok = False
-                            resp.write(escape(e))
-                            resp.write("<br>")
-                elif "copy" in rec:
-                    # Copying records
-                    for key in rec["copy"]:
-                        sid = transaction.savepoint(using=request.database)
-                        try:
-                            obj = cls.model.objects.using(request.database).get(pk=key)
-                            if isinstance(cls.model._meta.pk, CharField):
-                                # The primary key is a string
-                                obj.pk = "Copy of %s" % key
-                            elif isinstance(cls.model._meta.pk, AutoField):
-                                # The primary key is an auto-generated number
-                                obj.pk = None
-                            else:
-                                raise Exception(
-                                    _("Can't copy %s") % cls.model._meta.app_label
-                                )
-                            obj.save(using=request.database, force_insert=True)
-                            LogEntry(
-                                user_id=request.user.pk,
-                                content_type_id=content_type_id,
-                                object_id=obj.pk,
-                                object_repr=force_str(obj),
-                                action_flag=ADDITION,
-                                change_message=_("Copied from %s.") % key,
-                            ).save(using=request.database)
-                            transaction.savepoint_commit(sid)
-                        except cls.model.DoesNotExist:
-                            transaction.savepoint_rollback(sid)
-                            ok = False
-                            resp.write(escape(_("Can't find %s" % key)))
-                            resp.write("<br>")
-                        except Exception as e:
-                            transaction.savepoint_rollback(sid)
-                            ok = False
-                            resp.write(escape(e))
-                            resp.write("<br>")
+                    if not cls._delete_json_records(
+                        request, rec["delete"], content_type_id, resp, admin_log
+                    ):
+                        ok = False
+                elif not cls._copy_json_records(
+                    request, rec["copy"], content_type_id, resp, admin_log
+                ):
+                    ok = False
+            if edits and not cls._save_json_records(
+                request, edits, content_type_id, resp, admin_log
+            ):
+                ok = False
+            LogEntry.objects.all().using(request.database).bulk_create(
+                admin_log, batch_size=UPLOAD_BATCH_SIZE
+            )
+        if ok:
+            resp.write("OK")
+        resp.status_code = ok and 200 or 500
+        return resp
+
+    @classmethod
+    def _prefetch_json_records(cls, request, keys):
+        """
+        Retrieves the records for a list of primary keys with a single query.
+        The result is a dictionary with the keys as received from the client.
+        """
+        pk = cls.model._meta.pk
+        converted = {}
+        for key in keys:
+            try:
+                converted[key] = pk.to_python(key)
+            except Exception:
+                # Reported as a missing record
+                pass
+        if not converted:
+            return {}
+        found = cls.model.objects.using(request.database).in_bulk(
+            list(set(converted.values()))
+        )
+        return {k: found[v] for k, v in converted.items() if v in found}
+
+    @classmethod
+    def _delete_json_records(cls, request, keys, content_type_id, resp, admin_log):
+        ok = True
+        found = cls._prefetch_json_records(request, keys)
+        deleted = []
+        seen = set()
+        for key in keys:
+            if key not in found:
+                ok = False
+                resp.write(escape(_("Can't find %s" % key)))
+                resp.write("<br>")
+            elif key not in seen:
+                seen.add(key)
+                deleted.append(key)
+        if not deleted:
+            return ok
+
+        # Models without custom delete logic are deleted with a single
+        # statement. When that fails, we delete the records one by one to
+        # report the records that can't be deleted.
+        if len(deleted) > 1 and cls.model.delete is Model.delete:
+            sid = transaction.savepoint(using=request.database)
+            try:
+                cls.model.objects.using(request.database).filter(
+                    pk__in=[found[key].pk for key in deleted]
+                ).delete()
+                transaction.savepoint_commit(sid)
+                done = deleted
+                deleted = []
+            except Exception:
+                transaction.savepoint_rollback(sid)
+                done = []
+        else:
+            done = []
+        for key in deleted:
+            sid = transaction.savepoint(using=request.database)
+            try:
+                found[key].delete()
+                transaction.savepoint_commit(sid)
+                done.append(key)
+            except Exception as e:
+                transaction.savepoint_rollback(sid)
+                ok = False
+                resp.write(escape(e))
+                resp.write("<br>")
+        for key in done:
+            admin_log.append(
+                LogEntry(
+                    user_id=request.user.id,
+                    content_type_id=content_type_id,
+                    object_id=force_str(key),
+                    object_repr=force_str(key)[:200],
+                    action_flag=DELETION,
+                )
+            )
+        return ok
+
+    @classmethod
+    def _copy_json_records(cls, request, keys, content_type_id, resp, admin_log):
+        ok = True
+        found = cls._prefetch_json_records(request, keys)
+        pk = cls.model._meta.pk
+        copies = []
+        seen = set()
+        for key in keys:
+            if key not in found:
+                ok = False
+                resp.write(escape(_("Can't find %s" % key)))
+                resp.write("<br>")
+            elif not isinstance(pk, (CharField, AutoField)):
+                ok = False
+                resp.write(escape(_("Can't copy %s") % cls.model._meta.app_label))
+                resp.write("<br>")
+            elif key not in seen:
+                seen.add(key)
+                obj = found[key]
+                if isinstance(pk, CharField):
+                    # The primary key is a string
+                    obj.pk = "Copy of %s" % key
                 else:
-                    # Editing records
-                    pk = rec["id"]
-                    sid = transaction.savepoint(using=request.database)
-                    try:
-                        obj = cls.model.objects.using(request.database).get(
-                            pk=rec["id"]
+                    # The primary key is an auto-generated number
+                    obj.pk = None
+                copies.append((key, obj))
+        if not copies:
+            return ok
+
+        # Models without custom save logic are inserted with a single
+        # statement. When that fails, we insert the records one by one to
+        # report the records that can't be copied.
+        done = []
+        if len(copies) > 1 and bulkUploadAllowed(cls.model, None):
+            if issubclass(cls.model, AuditModel):
+                now = datetime.now()
+                for key, obj in copies:
+                    obj.lastmodified = now
+            sid = transaction.savepoint(using=request.database)
+            try:
+                cls.model.objects.using(request.database).bulk_create(
+                    [obj for key, obj in copies], batch_size=UPLOAD_BATCH_SIZE
+                )
+                PlanVersion.changed(request.database)
+                transaction.savepoint_commit(sid)
+                done = copies
+                copies = []
+            except Exception:
+                transaction.savepoint_rollback(sid)
+                if isinstance(pk, AutoField):
+                    for key, obj in copies:
+                        obj.pk = None
+        for key, obj in copies:
+            sid = transaction.savepoint(using=request.database)
+            try:
+                obj.save(using=request.database, force_insert=True)
+                transaction.savepoint_commit(sid)
+                done.append((key, obj))
+            except Exception as e:
+                transaction.savepoint_rollback(sid)
+                ok = False
+                resp.write(escape(e))
+                resp.write("<br>")
+        for key, obj in done:
+            admin_log.append(
+                LogEntry(
+                    user_id=request.user.pk,
+                    content_type_id=content_type_id,
+                    object_id=obj.pk,
+                    object_repr=force_str(obj),
+                    action_flag=ADDITION,
+                    change_message=_("Copied from %s.") % key,
+                )
+            )
+        return ok
+
+    @classmethod
+    def _save_json_records(cls, request, records, content_type_id, resp, admin_log):
+        ok = True
+        database = request.database
+        found = cls._prefetch_json_records(request, [rec["id"] for rec in records])
+
+        # Models without custom save logic are validated and saved in bulk:
+        # foreign keys are retrieved with a single query, and the valid
+        # records are saved with a single statement.
+        bulk = len(records) > 1 and bulkUploadAllowed(cls.model, None)
+
+        def formfieldCallback(f):
+            if isinstance(f, RelatedField):
+                if bulk:
+                    return BulkForeignKeyFormField(field=f, using=database)
+                return f.formfield(using=database)
+            return f.formfield()
+
+        # Build a form for every combination of edited fields
+        forms = {}
+        for rec in records:
+            for i in rec:
+                if (
+                    rec[i] == "\xa0"
+                ):  # Workaround for Jqgrid issue: date field can't be set to blank
+                    rec[i] = None
+            fields = tuple(i for i in rec.keys() if i != "id")
+            if fields in forms:
+                continue
+            if hasattr(cls.model, "getModelForm"):
+                forms[fields] = cls.model.getModelForm(fields, database=database)
+            else:
+                forms[fields] = modelform_factory(
+                    cls.model, fields=fields, formfield_callback=formfieldCallback
+                )
+        if bulk:
+            for fields, UploadForm in forms.items():
+                for name, field in UploadForm.base_fields.items():
+                    if isinstance(field, BulkForeignKeyFormField):
+                        field.prefetch(
+                            [
+                                rec.get(name, None)
+                                for rec in records
+                                if fields == tuple(i for i in rec.keys() if i != "id")
+                            ]
                         )
-                        del rec["id"]
-                        for i in rec:
-                            if (
-                                rec[i] == "\xa0"
-                            ):  # Workaround for Jqgrid issue: date field can't be set to blank
-                                rec[i] = None
-                        if hasattr(cls.model, "getModelForm"):
-                            UploadForm = cls.model.getModelForm(
-                                tuple(rec.keys()), database=request.database
-                            )
-                        else:
-                            UploadForm = modelform_factory(
-                                cls.model,
-                                fields=tuple(rec.keys()),
-                                formfield_callback=lambda f: (
-                                    isinstance(f, RelatedField)
-                                    and f.formfield(using=request.database)
-                                )
-                                or f.formfield(),
+
+        saved = []
+        for rec in records:
+            pk = rec["id"]
+            sid = None if bulk else transaction.savepoint(using=database)
+            try:
+                obj = found.get(pk, None)
+                if obj is None:
+                    raise cls.model.DoesNotExist
+                del rec["id"]
+                form = forms[tuple(rec.keys())](rec, instance=obj)
+                if form.has_changed():
+                    obj = form.save(commit=False)
+                    if bulk:
+                        # Saved at the end
+                        saved.append((obj, form.changed_data))
+                    else:
+                        obj.save(using=database)
+                        saved.append((obj, form.changed_data))
+                if sid:
+                    transaction.savepoint_commit(sid)
+            except cls.model.DoesNotExist:
+                if sid:
+                    transaction.savepoint_rollback(sid)
+                ok = False
+                resp.write(escape(_("Can't find %s" % pk)))
+                resp.write("<br>")
+            except (ValidationError, ValueError):
+                if sid:
+                    transaction.savepoint_rollback(sid)
+                ok = False
+                for error in form.non_field_errors():
+                    resp.write(escape("%s: %s" % (pk, error)))
+                    resp.write("<br>")
+                for field in form:
+                    for error in field.errors:
+                        resp.write(
+                            escape(
+                                "%s %s: %s: %s"
+                                % (obj.pk, field.name, rec[field.name], error)
                             )
-                        form = UploadForm(rec, instance=obj)
-                        if form.has_changed():
-                            obj = form.save(commit=False)
-                            obj.save(using=request.database)
-                            LogEntry(
-                                user_id=request.user.pk,
-                                content_type_id=content_type_id,
-                                object_id=obj.pk,
-                                object_repr=force_str(obj),
-                                action_flag=CHANGE,
-                                change_message=_("Changed %s.")
-                                % get_text_list(form.changed_data, _("and")),
-                            ).save(using=request.database)
-                        transaction.savepoint_commit(sid)
-                    except cls.model.DoesNotExist:
-                        transaction.savepoint_rollback(sid)
-                        ok = False
-                        resp.write(escape(_("Can't find %s" % pk)))
+                        )
                         resp.write("<br>")
-                    except (ValidationError, ValueError):
-                        transaction.savepoint_rollback(sid)
-                        ok = False
-                        for error in form.non_field_errors():
-                            resp.write(escape("%s: %s" % (pk, error)))
-                            resp.write("<br>")
-                        for field in form:
-                            for error in field.errors:
-                                resp.write(
-                                    escape(
-                                        "%s %s: %s: %s"
-                                        % (obj.pk, field.name, rec[field.name], error)
-                                    )
-                                )
-                                resp.write("<br>")
+            except Exception as e:
+                if sid:
+                    transaction.savepoint_rollback(sid)
+                ok = False
+                resp.write(escape(e))
+                resp.write("<br>")
+
+        # Write all valid records with a single statement. When that fails,
+        # we save the records one by one to report the failing records.
+        if bulk and saved:
+            headers = {
+                cls.model._meta.get_field(f)
+                for obj, changed_data in saved
+                for f in changed_data
+            }
+            try:
+                saveRecords(
+                    cls.model, [(obj, True, c) for obj, c in saved], headers, database
+                )
+            except Exception:
+                pending = saved
+                saved = []
+                for obj, changed_data in pending:
+                    sid = transaction.savepoint(using=database)
+                    try:
+                        obj.save(using=database)
+                        transaction.savepoint_commit(sid)
+                        saved.append((obj, changed_data))
                     except Exception as e:
                         transaction.savepoint_rollback(sid)
                         ok = False
                         resp.write(escape(e))
                         resp.write("<br>")
-        if ok:
-            resp.write("OK")
-        resp.status_code = ok and 200 or 500
-        return resp
+        for obj, changed_data in saved:
+            admin_log.append(
+                LogEntry(
+                    user_id=request.user.pk,
+                    content_type_id=content_type_id,
+                    object_id=obj.pk,
+                    object_repr=force_str(obj),
+                    action_flag=CHANGE,
+                    change_message=_("Changed %s.")
+                    % get_text_list(changed_data, _("and")),
+                )
+            )
+        return ok
 
     @staticmethod
     def dependent_models(m, found):
@@ -1978,6 +2418,7 @@ class GridReport(View):
                     )
             for sql in sql_list:
                 cursor.execute(sql)
+            PlanVersion.changed(request.database)
             # Erase comments and history
             content_ids = [ContentType.objects.get_for_model(m) for m in deps]
             LogEntry.objects.filter(content_type__in=content_ids).delete()
@@ -15,10 +15,17 @@
 # License along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 
+import json
+
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS, connection, transaction
 from django.http.response import StreamingHttpResponse
-from django.test import TestCase
+from django.test import TestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext
 
-from freppledb.common.models import User
+from freppledb.common.models import Parameter, ParameterCache, User
+from freppledb.common.report import GridReport
+from freppledb.execute.models import PlanVersion
 
 
 def checkResponse(testcase, response):
@@ -51,3 +58,133 @@ class UserPreferenceTest(TestCase):
         user.setPreference("test", {"a": 1, "b": "c"})
         after = user.getPreference("test")
         self.assertEqual(after, {"a": 1, "b": "c"})
+
+
+class ParameterCacheTest(TransactionTestCase):
+    def test_rollback(self):
+        Parameter.objects.create(name="test.cache", value="committed")
+        self.assertEqual(Parameter.getValue("test.cache"), "committed")
+        try:
+            with transaction.atomic():
+                param = Parameter.objects.get(name="test.cache")
+                param.value = "rolled back"
+                param.save()
+                self.assertEqual(Parameter.getValue("test.cache"), "rolled back")
+                raise ValueError
+        except ValueError:
+            pass
+        self.assertEqual(Parameter.getValue("test.cache"), "committed")
+
+    def test_heartbeat(self):
+        Parameter.objects.create(name="test.cache", value="cached")
+        cached = ParameterCache.get()
+        self.assertEqual(cached["test.cache"], "cached")
+        # The heartbeat of the worker doesn't invalidate the cache
+        Parameter.objects.update_or_create(
+            name="Worker alive", defaults={"value": "2020-01-01 00:00:00"}
+        )
+        self.assertIs(ParameterCache.get(), cached)
+        self.assertEqual(Parameter.getValue("Worker alive"), "2020-01-01 00:00:00")
+
+
+class PlanVersionTest(TransactionTestCase):
+    def setUp(self):
+        User.objects.create_superuser("admin", "your@company.com", "admin")
+        Parameter.objects.create(name="test.version", value="1")
+        self.client.login(username="admin", password="admin")
+
+    def test_edit(self):
+        version = PlanVersion.load(DEFAULT_DB_ALIAS)
+        # Reading the data doesn't change the version
+        checkResponse(self, self.client.get("/data/common/parameter/?format=json"))
+        self.assertEqual(PlanVersion.load(DEFAULT_DB_ALIAS), version)
+        # Saving the report layout doesn't change the version either
+        response = self.client.post(
+            "/settings/",
+            json.dumps({"freppledb.common.views.ParameterList": {"rows": []}}),
+            content_type="application/json",
+            HTTP_X_REQUESTED_WITH="XMLHttpRequest",
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(PlanVersion.load(DEFAULT_DB_ALIAS), version)
+        # An edit changes the version once the request is finished
+        response = self.client.post(
+            "/data/common/parameter/",
+            json.dumps([{"id": "test.version", "value": "2"}]),
+            content_type="application/json",
+        )
+        checkResponse(self, response)
+        self.assertNotEqual(PlanVersion.load(DEFAULT_DB_ALIAS), version)
+
+
+class KeysetPaginationTest(TestCase):
+    def test_keyset_fields(self):
+        # Explicit sort order
+        self.assertEqual(
+            GridReport._get_keyset_fields(Parameter.objects.order_by("-value")),
+            ["-value", "pk"],
+        )
+        self.assertEqual(
+            GridReport._get_keyset_fields(Parameter.objects.order_by("name")),
+            ["name"],
+        )
+        # The default model ordering must be preserved
+        self.assertIsNone(GridReport._get_keyset_fields(Parameter.objects.all()))
+        # Extra ordering isn't supported
+        self.assertIsNone(
+            GridReport._get_keyset_fields(Parameter.objects.extra(order_by=["value"]))
+        )
+
+    def getPage(self, order, page):
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get(
+                "/data/common/parameter/?format=json&sidx=value&sord=%s&page=%s"
+                % (order, page)
+            )
+            data = json.loads(b"".join(response.streaming_content).decode("utf-8"))
+        queries = [
+            q["sql"].lower()
+            for q in ctx.captured_queries
+            if "common_parameter" in q["sql"]
+        ]
+        return data, queries
+
+    def test_paging(self):
+        User.objects.create_superuser("admin", "your@company.com", "admin", pagesize=5)
+        self.client.login(username="admin", password="admin")
+        # Parameters with ties and null values in the sort column
+        Parameter.objects.bulk_create(
+            [
+                Parameter(name="test %02d" % i, value=(None, "a", "b")[i % 3])
+                for i in range(31)
+            ]
+        )
+        records = Parameter.objects.count()
+        for order in ("asc", "desc"):
+            # Reading the pages in sequence uses the key of the previous page
+            cache.clear()
+            keyset = []
+            keyset_used = False
+            page = 1
+            while True:
+                data, queries = self.getPage(order, page)
+                self.assertEqual(data["records"], records)
+                if page > 1:
+                    # The record count is cached
+                    self.assertFalse([q for q in queries if "count(*)" in q])
+                    if not [q for q in queries if "offset" in q]:
+                        keyset_used = True
+                keyset.append([r["name"] for r in data["rows"]])
+                if page >= data["total"]:
+                    break
+                page += 1
+            self.assertTrue(keyset_used)
+
+            # Reading the pages in reverse order uses an OFFSET clause
+            cache.clear()
+            offset = [
+                [r["name"] for r in self.getPage(order, p)[0]["rows"]]
+                for p in range(page, 0, -1)
+            ]
+            offset.reverse()
+            self.assertEqual(keyset, offset)
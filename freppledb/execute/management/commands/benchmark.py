@@ -0,0 +1,315 @@
+#
+# Copyright (C) 2020 by frePPLe bv
+#
+# This library is free software; you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero
+# General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+from datetime import datetime
+import json
+import os
+import tempfile
+from time import time
+
+from django.conf import settings
+from django.core import management
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS
+
+from freppledb.input.models import Demand, Item, OperationPlan, OperationPlanMaterial
+from freppledb.output.models import Problem
+from freppledb import VERSION
+
+
+class Command(BaseCommand):
+
+    help = """
+      Measures the performance of the complete planning pipeline on models
+      of increasing size.
+
+      For every model size the database is emptied, a model is generated
+      with the createmodel command and a plan is generated with the runplan
+      command. The wall time, the peak memory and the number of SQL
+      statements of every planning step are recorded.
+
+      The results are saved in a JSON file. When a file of a previous run
+      is passed with the --compare argument, the steps that became slower
+      or execute more SQL statements are reported.
+
+      WARNING: All data in the database is erased.
+    """
+
+    requires_system_checks = False
+
+    # Default model sizes, passed as arguments to the createmodel command
+    sizes = [
+        "cluster=10,demand=10,components=20,resource=6",
+        "cluster=100,demand=10,components=200,resource=60",
+        "cluster=1000,demand=10,components=2000,resource=600",
+    ]
+
+    # Arguments of the createmodel command that define the model size
+    size_arguments = (
+        "cluster",
+        "demand",
+        "forecast_per_item",
+        "level",
+        "resource",
+        "resource_size",
+        "components",
+        "components_per",
+        "deliver_lt",
+        "procure_lt",
+    )
+
+    def get_version(self):
+        return VERSION
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--size",
+            action="append",
+            dest="size",
+            help="Model size as a comma separated list of createmodel arguments, "
+            "eg cluster=100,demand=10. Repeat to run multiple sizes.",
+        )
+        parser.add_argument(
+            "--constraint",
+            type=int,
+            default=15,
+            choices=range(0, 16),
+            help="Constraints to be considered: 1=lead time, 4=capacity, 8=release fence",
+        )
+        parser.add_argument(
+            "--plantype",
+            type=int,
+            default=1,
+            choices=[1, 2],
+            help="Plan type: 1=constrained, 2=unconstrained",
+        )
+        parser.add_argument(
+            "--env",
+            default="supply",
+            help="A comma separated list of extra settings passed as environment variables to the engine",
+        )
+        parser.add_argument(
+            "--output", help="Name of the JSON file to store the results in"
+        )
+        parser.add_argument(
+            "--compare", help="JSON file with the results of a previous run"
+        )
+        parser.add_argument(
+            "--tolerance",
+            type=float,
+            default=0.2,
+            help="Relative increase of the wall time or SQL statements reported "
+            "as a regression (default 0.2)",
+        )
+        parser.add_argument(
+            "--min_seconds",
+            type=float,
+            default=1.0,
+            help="Steps running shorter than this number of seconds are not "
+            "checked for time regressions (default 1)",
+        )
+        parser.add_argument(
+            "--database",
+            default=DEFAULT_DB_ALIAS,
+            help="Nominates a specific database to run the benchmark in",
+        )
+        parser.add_argument(
+            "--noinput",
+            "--no-input",
+            action="store_false",
+            dest="interactive",
+            help="Do not ask for confirmation before erasing the database",
+        )
+
+    def parseSize(self, size):
+        args = {}
+        for i in size.split(","):
+            j = i.split("=")
+            if len(j) != 2 or j[0].strip() not in self.size_arguments:
+                raise CommandError("Invalid model size '%s'" % size)
+            try:
+                args[j[0].strip()] = int(j[1])
+            except ValueError:
+                raise CommandError("Invalid model size '%s'" % size)
+        return args
+
+    def handle(self, **options):
+        database = options["database"]
+        if database not in settings.DATABASES:
+            raise CommandError("No database settings known for '%s'" % database)
+        sizes = [(s, self.parseSize(s)) for s in options["size"] or self.sizes]
+        if options["output"]:
+            output = options["output"]
+        else:
+            output = os.path.join(
+                settings.FREPPLE_LOGDIR,
+                "benchmark_%s.json" % datetime.now().strftime("%Y%m%d_%H%M%S"),
+            )
+        previous = None
+        if options["compare"]:
+            try:
+                with open(options["compare"], "r") as f:
+                    previous = json.load(f)
+            except Exception as e:
+                raise CommandError(
+                    "Can't read results from '%s': %s" % (options["compare"], e)
+                )
+        if options["interactive"]:
+            confirm = input(
+                "The benchmark erases all data in the database '%s'.\n"
+                "Type 'yes' to continue, or 'no' to cancel: "
+                % settings.DATABASES[database]["NAME"]
+            )
+            if confirm != "yes":
+                raise CommandError("Benchmark cancelled")
+
+        results = {
+            "version": VERSION,
+            "date": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+            "database": database,
+            "constraint": options["constraint"],
+            "plantype": options["plantype"],
+            "env": options["env"],
+            "runs": [],
+        }
+        for size, args in sizes:
+            results["runs"].append(self.runSize(size, args, database, options))
+            # Save after every model size, to keep the results of an interrupted benchmark
+            with open(output, "w") as f:
+                json.dump(results, f, indent=2)
+        if int(options["verbosity"]) > 0:
+            self.stdout.write("Results saved in %s" % output)
+
+        if previous:
+            regressions = self.compare(
+                previous, results, options["tolerance"], options["min_seconds"]
+            )
+            if regressions:
+                raise CommandError(
+                    "%d regressions compared to %s" % (regressions, options["compare"])
+                )
+
+    def runSize(self, size, args, database, options):
+        verbosity = int(options["verbosity"])
+        if verbosity > 0:
+            self.stdout.write("Benchmarking model size %s" % size)
+
+        # Generate a model
+        management.call_command("empty", database=database, verbosity=0)
+        start = time()
+        management.call_command("createmodel", database=database, verbosity=0, **args)
+        createmodel_seconds = time() - start
+
+        # Generate a plan, with the engine recording the measurements of
+        # every step in a temporary file
+        fd, stepfile = tempfile.mkstemp(prefix="frepple_benchmark_", suffix=".json")
+        os.close(fd)
+        try:
+            os.environ["FREPPLE_BENCHMARK"] = stepfile
+            start = time()
+            management.call_command(
+                "runplan",
+                database=database,
+                constraint=options["constraint"],
+                plantype=options["plantype"],
+                env=options["env"],
+            )
+            plan_seconds = time() - start
+            with open(stepfile, "r") as f:
+                steps = [json.loads(line) for line in f if line.strip()]
+        finally:
+            del os.environ["FREPPLE_BENCHMARK"]
+            os.remove(stepfile)
+
+        run = {
+            "size": size,
+            "arguments": args,
+            "createmodel_seconds": createmodel_seconds,
+            "plan_seconds": plan_seconds,
+            "records": {
+                "item": Item.objects.using(database).count(),
+                "demand": Demand.objects.using(database).count(),
+                "operationplan": OperationPlan.objects.using(database).count(),
+                "operationplanmaterial": OperationPlanMaterial.objects.using(
+                    database
+                ).count(),
+                "problem": Problem.objects.using(database).count(),
+            },
+            "steps": steps,
+        }
+        if verbosity > 0:
+            self.stdout.write(
+                "  createmodel: %.2f seconds, runplan: %.2f seconds"
+                % (createmodel_seconds, plan_seconds)
+            )
+            for s in steps:
+                self.stdout.write(
+                    "  %-10s %-8s %8.2fs %10s statements %8s MB  %s"
+                    % (
+                        s["sequence"],
+                        s["thread"],
+                        s["seconds"],
+                        s["statements"],
+                        int(s["peak_memory"] / 1024 / 1024)
+                        if s["peak_memory"]
+                        else "-",
+                        s["description"],
+                    )
+                )
+        return run
+
+    def compare(self, previous, results, tolerance, min_seconds):
+        """
+        Reports the steps that are slower or execute more SQL statements
+        than in the previous results, and returns the number of regressions.
+        """
+        regressions = 0
+        old_runs = {r["size"]: r for r in previous.get("runs", [])}
+        for run in results["runs"]:
+            old_run = old_runs.get(run["size"], None)
+            if not old_run:
+                self.stdout.write(
+                    "Model size %s not found in previous results" % run["size"]
+                )
+                continue
+            self.stdout.write("Comparing model size %s" % run["size"])
+            old_steps = {
+                (s["sequence"], s["thread"], s["description"]): s
+                for s in old_run["steps"]
+            }
+            for s in run["steps"]:
+                old = old_steps.get((s["sequence"], s["thread"], s["description"]))
+                if not old:
+                    continue
+                problems = []
+                if max(s["seconds"], old["seconds"]) >= min_seconds and s[
+                    "seconds"
+                ] > old["seconds"] * (1 + tolerance):
+                    problems.append(
+                        "time %.2fs -> %.2fs" % (old["seconds"], s["seconds"])
+                    )
+                if s["statements"] > old["statements"] * (1 + tolerance):
+                    problems.append(
+                        "statements %s -> %s" % (old["statements"], s["statements"])
+                    )
+                if problems:
+                    regressions += 1
+                    self.stdout.write(
+                        "  REGRESSION %s '%s': %s"
+                        % (s["sequence"], s["description"], ", ".join(problems))
+                    )
+        return regressions
@@ -174,6 +174,10 @@ class Command(BaseCommand):
                     cursor.execute(
                         "delete from common_bucket where name in ('year','quarter','month','week','day')"
                     )
+                    # The plan summaries per bucket are rebuilt when needed
+                    cursor.execute(
+                        "truncate table out_resourceplan_bucket, out_buffer_bucket, out_buffer_bucket_refresh"
+                    )
 
                 # Create buckets
                 y = Bucket(name="year", description="Yearly time buckets", level=1)
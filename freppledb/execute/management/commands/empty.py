@@ -234,10 +234,22 @@ class Command(BaseCommand):
                 tables.add("operationplanmaterial")
                 tables.add("operationplanresource")
                 tables.add("out_problem")
+                tables.add("out_pegging")
             if "resource" in tables and "out_resourceplan" not in tables:
                 tables.add("out_resourceplan")
+            if (
+                options["models"] and (hasPO or hasDO or hasMO or hasDeO)
+            ) or tables.intersection(
+                ("operationplan", "operationplanmaterial", "out_resourceplan")
+            ):
+                # The plan summaries per bucket are rebuilt when needed
+                tables.add("out_resourceplan_bucket")
+                tables.add("out_buffer_bucket")
+                tables.add("out_buffer_bucket_refresh")
             if "demand" in tables and "out_constraint" not in tables:
                 tables.add("out_constraint")
+            if "demand" in tables and "out_pegging" not in tables:
+                tables.add("out_pegging")
             if (
                 "reportmanager_report" in tables
                 and "reportmanager_column" not in tables
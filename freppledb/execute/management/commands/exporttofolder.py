@@ -19,9 +19,11 @@ import os
 import errno
 import gzip
 import logging
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from threading import local, Lock
 
 from _datetime import datetime
-from time import localtime, strftime
+from time import localtime, strftime, perf_counter
 from django.conf import settings
 from django.db import connections, DEFAULT_DB_ALIAS
 from django.core.management.base import BaseCommand, CommandError
@@ -31,7 +33,7 @@ from django.utils.translation import gettext_lazy as _
 
 from freppledb.common.middleware import _thread_locals
 from freppledb.common.models import User
-from freppledb.common.report import GridReport
+from freppledb.common.report import GridReport, create_connection
 from freppledb import VERSION
 from freppledb.execute.models import Task
 from freppledb.output.views import resource
@@ -40,6 +42,40 @@ from freppledb.output.views import buffer
 logger = logging.getLogger(__name__)
 
 
+class ChunkedWriter:
+    """
+    Collects the strings written to it, and writes them to a binary file
+    in large encoded chunks.
+    """
+
+    def __init__(self, datafile, encoding, size=1024 * 1024):
+        self.datafile = datafile
+        self.encoding = encoding
+        self.size = size
+        self.buffer = []
+        self.buffered = 0
+
+    def write(self, data):
+        if isinstance(data, str):
+            self.buffer.append(data)
+            self.buffered += len(data)
+            if self.buffered >= self.size:
+                self.flush()
+        else:
+            self.flush()
+            self.datafile.write(data)
+
+    def flush(self):
+        if self.buffer:
+            self.datafile.write("".join(self.buffer).encode(self.encoding))
+            self.buffer = []
+            self.buffered = 0
+
+    def close(self):
+        self.flush()
+        self.datafile.close()
+
+
 class Command(BaseCommand):
 
     help = """
@@ -165,6 +201,18 @@ class Command(BaseCommand):
             type=int,
             help="Task identifier (generated automatically if not provided)",
         )
+        parser.add_argument(
+            "--threads",
+            type=int,
+            default=1,
+            help="Number of database connections exporting the SQL files in parallel",
+        )
+        parser.add_argument(
+            "--compress",
+            default="none",
+            choices=["none", "gzip", "zstd"],
+            help="Compression of the exported CSV files",
+        )
 
     def handle(self, *args, **options):
         # Pick up the options
@@ -184,6 +232,13 @@ class Command(BaseCommand):
                 raise CommandError("User '%s' not found" % options["user"])
         else:
             self.user = None
+        self.threads = max(1, options["threads"] or 1)
+        self.compress = options["compress"]
+        if self.compress == "zstd":
+            try:
+                import zstandard  # noqa
+            except ImportError:
+                raise CommandError("zstd compression requires the zstandard package")
 
         timestamp = now.strftime("%Y%m%d%H%M%S")
         if self.database == DEFAULT_DB_ALIAS:
@@ -306,104 +361,50 @@ class Command(BaseCommand):
                             "Missing folder in export configuration for %s" % filename
                         )
 
-                    # Report progress
-                    logger.info(
-                        "%s Started export of %s"
-                        % (datetime.now().replace(microsecond=0), filename)
-                    )
-                    if task:
-                        task.message = "Exporting %s" % filename
-                        task.save(using=self.database)
-
-                    # Make sure export folder exists
-                    exportFolder = os.path.join(
-                        settings.DATABASES[self.database]["FILEUPLOADFOLDER"], folder
-                    )
-                    if not os.path.isdir(exportFolder):
-                        os.makedirs(exportFolder)
-
+                if self.threads > 1:
+                    # SQL exports run in parallel on a pool of connections, while
+                    # the report exports run in this thread
+                    self.local = local()
+                    self.lock = Lock()
+                    self.connections = []
                     try:
-                        reportclass = cfg.get("report", None)
-                        sql = cfg.get("sql", None)
-                        if reportclass:
-                            # Export from report class
-
-                            # Create a dummy request
-                            factory = RequestFactory()
-                            request = factory.get("/dummy/", cfg.get("data", {}))
-                            if self.user:
-                                request.user = self.user
-                            else:
-                                request.user = User.objects.all().get(username="admin")
-                            request.database = self.database
-                            request.LANGUAGE_CODE = settings.LANGUAGE_CODE
-                            request.prefs = cfg.get("prefs", None)
-
-                            # Initialize the report
-                            if hasattr(reportclass, "initialize"):
-                                reportclass.initialize(request)
-                            if hasattr(reportclass, "rows"):
-                                if callable(reportclass.rows):
-                                    request.rows = reportclass.rows(request)
-                                else:
-                                    request.rows = reportclass.rows
-                            if hasattr(reportclass, "crosses"):
-                                if callable(reportclass.crosses):
-                                    request.crosses = reportclass.crosses(request)
+                        with ThreadPoolExecutor(max_workers=self.threads) as pool:
+                            futures = [
+                                pool.submit(self.exportFile, cfg, None)
+                                for cfg in self.statements
+                                if not cfg.get("report", None)
+                            ]
+                            for cfg in self.statements:
+                                if cfg.get("report", None):
+                                    if self.exportFile(cfg, cursor):
+                                        i += 1
+                                    else:
+                                        errors += 1
+                                    task.status = str(int(i / cnt * 100)) + "%"
+                                    task.save(using=self.database)
+                            for f in as_completed(futures):
+                                if f.result():
+                                    i += 1
                                 else:
-                                    request.crosses = reportclass.crosses
-                            if reportclass.hasTimeBuckets:
-                                reportclass.getBuckets(request)
-
-                            # Write the report file
-                            datafile = open(os.path.join(exportFolder, filename), "wb")
-                            if filename.endswith(".xlsx"):
-                                reportclass._generate_spreadsheet_data(
-                                    request,
-                                    [request.database],
-                                    datafile,
-                                    **cfg.get("data", {})
-                                )
-                            elif filename.endswith(".csv"):
-                                for r in reportclass._generate_csv_data(
-                                    request, [request.database], **cfg.get("data", {})
-                                ):
-                                    datafile.write(
-                                        r.encode(settings.CSV_CHARSET)
-                                        if isinstance(r, str)
-                                        else r
-                                    )
-                            else:
-                                raise Exception(
-                                    "Unknown output format for %s" % filename
-                                )
-                        elif sql:
-                            # Exporting using SQL
-                            if filename.lower().endswith(".gz"):
-                                datafile = gzip.open(
-                                    os.path.join(exportFolder, filename), "w"
-                                )
-                            else:
-                                datafile = open(
-                                    os.path.join(exportFolder, filename), "w"
-                                )
-                            cursor.copy_expert(sql, datafile)
-                        else:
-                            raise Exception("Unknown export type for %s" % filename)
-                        datafile.close()
-                        i += 1
-
-                    except Exception as e:
-                        errors += 1
-                        logger.error(
-                            "%s Failed to export to %s: %s"
-                            % (datetime.now().replace(microsecond=0), filename, e)
-                        )
+                                    errors += 1
+                                task.status = str(int(i / cnt * 100)) + "%"
+                                task.save(using=self.database)
+                    finally:
+                        for conn in self.connections:
+                            conn.close()
+                else:
+                    for cfg in self.statements:
                         if task:
-                            task.message = "Failed to export %s" % filename
-
-                    task.status = str(int(i / cnt * 100)) + "%"
-                    task.save(using=self.database)
+                            task.message = "Exporting %s" % cfg["filename"]
+                            task.save(using=self.database)
+                        if self.exportFile(cfg, cursor):
+                            i += 1
+                        else:
+                            errors += 1
+                            if task:
+                                task.message = "Failed to export %s" % cfg["filename"]
+                        task.status = str(int(i / cnt * 100)) + "%"
+                        task.save(using=self.database)
 
                 logger.info(
                     "%s Exported %s file(s)"
@@ -467,6 +468,139 @@ class Command(BaseCommand):
                 task.save(using=self.database)
             setattr(_thread_locals, "database", None)
 
+    def getCursor(self):
+        """
+        Returns a cursor on the database connection of the current thread.
+        """
+        conn = getattr(self.local, "connection", None)
+        if conn is None:
+            conn = create_connection(self.database)
+            # The connections are closed by the main thread at the end
+            conn.inc_thread_sharing()
+            self.local.connection = conn
+            with self.lock:
+                self.connections.append(conn)
+        return conn.cursor()
+
+    def openFile(self, exportFolder, filename):
+        """
+        Opens an export file for writing in binary mode, applying the
+        requested compression on CSV files.
+        """
+        if filename.lower().endswith(".gz"):
+            return gzip.open(os.path.join(exportFolder, filename), "wb")
+        elif self.compress == "gzip" and filename.lower().endswith(".csv"):
+            return gzip.open(os.path.join(exportFolder, filename + ".gz"), "wb")
+        elif self.compress == "zstd" and filename.lower().endswith(".csv"):
+            import zstandard
+
+            return zstandard.ZstdCompressor().stream_writer(
+                open(os.path.join(exportFolder, filename + ".zst"), "wb")
+            )
+        else:
+            return open(os.path.join(exportFolder, filename), "wb")
+
+    def exportFile(self, cfg, cursor):
+        """
+        Exports a single file, and returns whether it was successful.
+        When no cursor is passed, the export uses the connection of the thread.
+        """
+        filename = cfg["filename"]
+        start = perf_counter()
+        logger.info(
+            "%s Started export of %s"
+            % (datetime.now().replace(microsecond=0), filename)
+        )
+
+        # Make sure export folder exists
+        exportFolder = os.path.join(
+            settings.DATABASES[self.database]["FILEUPLOADFOLDER"], cfg["folder"]
+        )
+        if not os.path.isdir(exportFolder):
+            os.makedirs(exportFolder, exist_ok=True)
+
+        try:
+            reportclass = cfg.get("report", None)
+            sql = cfg.get("sql", None)
+            if reportclass:
+                # Export from report class
+
+                # Create a dummy request
+                factory = RequestFactory()
+                request = factory.get("/dummy/", cfg.get("data", {}))
+                if self.user:
+                    request.user = self.user
+                else:
+                    request.user = User.objects.all().get(username="admin")
+                request.database = self.database
+                request.LANGUAGE_CODE = settings.LANGUAGE_CODE
+                request.prefs = cfg.get("prefs", None)
+
+                # Initialize the report
+                if hasattr(reportclass, "initialize"):
+                    reportclass.initialize(request)
+                if hasattr(reportclass, "rows"):
+                    if callable(reportclass.rows):
+                        request.rows = reportclass.rows(request)
+                    else:
+                        request.rows = reportclass.rows
+                if hasattr(reportclass, "crosses"):
+                    if callable(reportclass.crosses):
+                        request.crosses = reportclass.crosses(request)
+                    else:
+                        request.crosses = reportclass.crosses
+                if reportclass.hasTimeBuckets:
+                    reportclass.getBuckets(request)
+
+                # Write the report file
+                if filename.endswith(".xlsx"):
+                    with open(os.path.join(exportFolder, filename), "wb") as datafile:
+                        reportclass._generate_spreadsheet_data(
+                            request, [request.database], datafile, **cfg.get("data", {})
+                        )
+                elif filename.endswith((".csv", ".csv.gz")):
+                    datafile = ChunkedWriter(
+                        self.openFile(exportFolder, filename), settings.CSV_CHARSET
+                    )
+                    try:
+                        for r in reportclass._generate_csv_data(
+                            request, [request.database], **cfg.get("data", {})
+                        ):
+                            datafile.write(r)
+                    finally:
+                        datafile.close()
+                else:
+                    raise Exception("Unknown output format for %s" % filename)
+            elif sql:
+                # Exporting using SQL, streaming the data directly into the file
+                datafile = self.openFile(exportFolder, filename)
+                try:
+                    if cursor:
+                        cursor.copy_expert(sql, datafile)
+                    else:
+                        with self.getCursor() as threadcursor:
+                            threadcursor.copy_expert(sql, datafile)
+                finally:
+                    datafile.close()
+            else:
+                raise Exception("Unknown export type for %s" % filename)
+            logger.info(
+                "%s Finished export of %s in %.2f seconds"
+                % (
+                    datetime.now().replace(microsecond=0),
+                    filename,
+                    perf_counter() - start,
+                )
+            )
+            return True
+
+        except Exception as e:
+            logger.error(
+                "%s Failed to export to %s: %s"
+                % (datetime.now().replace(microsecond=0), filename, e)
+            )
+            return False
+
     # accordion template
     title = _("Export plan result to folder")
     index = 1200
@@ -498,7 +632,9 @@ class Command(BaseCommand):
             if os.path.isdir(exportfolder):
                 tzoffset = GridReport.getTimezoneOffset(request)
                 for file in os.listdir(exportfolder):
-                    if file.endswith((".xlsx", ".xlsx.gz", ".csv", ".csv.gz", ".log")):
+                    if file.endswith(
+                        (".xlsx", ".xlsx.gz", ".csv", ".csv.gz", ".csv.zst", ".log")
+                    ):
                         filesexported.append(
                             [
                                 file,
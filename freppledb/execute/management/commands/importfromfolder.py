@@ -16,6 +16,7 @@
 #
 
 import codecs
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
 from datetime import datetime
 from time import localtime, strftime
 import csv
@@ -44,6 +45,8 @@ from freppledb.common.report import EXCLUDE_FROM_BULK_OPERATIONS, create_connect
 
 logger = logging.getLogger(__name__)
 
+SQLFILES = (".sql", ".sql.gz")
+
 
 class Command(BaseCommand):
 
@@ -67,6 +70,12 @@ class Command(BaseCommand):
             type=int,
             help="Task identifier (generated automatically if not provided)",
         )
+        parser.add_argument(
+            "--processes",
+            type=int,
+            default=1,
+            help="Number of processes loading data files in parallel",
+        )
 
     def get_version(self):
         return VERSION
@@ -88,16 +97,16 @@ class Command(BaseCommand):
                 raise CommandError("User '%s' not found" % options["user"])
         else:
             self.user = None
+        self.processes = max(1, options["processes"] or 1)
         timestamp = now.strftime("%Y%m%d%H%M%S")
         if self.database == DEFAULT_DB_ALIAS:
             logfile = "importfromfolder-%s.log" % timestamp
         else:
             logfile = "importfromfolder_%s-%s.log" % (self.database, timestamp)
 
+        self.logfile = os.path.join(settings.FREPPLE_LOGDIR, logfile)
         try:
-            handler = logging.FileHandler(
-                os.path.join(settings.FREPPLE_LOGDIR, logfile), encoding="utf-8"
-            )
+            handler = logging.FileHandler(self.logfile, encoding="utf-8")
             # handler.setFormatter(logging.Formatter(settings.LOGGING['formatters']['simple']['format']))
             logger.addHandler(handler)
             logger.propagate = False
@@ -138,16 +147,7 @@ class Command(BaseCommand):
             task.processid = os.getpid()
             task.save(using=self.database)
 
-            # Choose the right self.delimiter and language
-            self.delimiter = (
-                get_format("DECIMAL_SEPARATOR", settings.LANGUAGE_CODE, True) == ","
-                and ";"
-                or ","
-            )
-            translation.activate(settings.LANGUAGE_CODE)
-            self.SQLrole = settings.DATABASES[self.database].get(
-                "SQL_ROLE", "report_role"
-            )
+            self.initialize()
 
             # Execute
             if "FILEUPLOADFOLDER" in settings.DATABASES[
@@ -217,63 +217,19 @@ class Command(BaseCommand):
                 # Sort the list of models, based on dependencies between models
                 models = GridReport.sort_models(models)
 
-                i = 0
                 cnt = len(models)
-                for ifile, model, contenttype_id, dependencies in models:
-                    task.status = str(int(10 + i / cnt * 80)) + "%"
-                    task.message = "Processing data file %s" % ifile
-                    task.save(using=self.database)
-                    i += 1
-                    filetoparse = os.path.join(
-                        os.path.abspath(
-                            settings.DATABASES[self.database]["FILEUPLOADFOLDER"]
-                        ),
-                        ifile,
-                    )
-                    if ifile.lower().endswith((".sql", ".sql.gz")):
-                        logger.info(
-                            "%s Started executing SQL statements from file: %s"
-                            % (datetime.now().replace(microsecond=0), ifile)
-                        )
-                        errors[0] += self.executeSQLfile(filetoparse)
-                        logger.info(
-                            "%s Finished executing SQL statements from file: %s"
-                            % (datetime.now().replace(microsecond=0), ifile)
-                        )
-                    elif ifile.lower().endswith((".cpy", ".cpy.gz")):
-                        logger.info(
-                            "%s Started uploading copy file: %s"
-                            % (datetime.now().replace(microsecond=0), ifile)
-                        )
-                        errors[0] += self.executeCOPYfile(model, filetoparse)
-                        logger.info(
-                            "%s Finished uploading copy file: %s"
-                            % (datetime.now().replace(microsecond=0), ifile)
-                        )
-                    elif ifile.lower().endswith(".xlsx"):
-                        logger.info(
-                            "%s Started processing data in Excel file: %s"
-                            % (datetime.now().replace(microsecond=0), ifile)
-                        )
-                        returnederrors = self.loadExcelfile(model, filetoparse)
-                        errors[0] += returnederrors[0]
-                        errors[1] += returnederrors[1]
-                        logger.info(
-                            "%s Finished processing data in file: %s"
-                            % (datetime.now().replace(microsecond=0), ifile)
-                        )
-                    else:
-                        logger.info(
-                            "%s Started processing data in CSV file: %s"
-                            % (datetime.now().replace(microsecond=0), ifile)
-                        )
-                        returnederrors = self.loadCSVfile(model, filetoparse)
+                if self.processes > 1 and cnt > 1:
+                    self.loadFilesInParallel(models, task, errors)
+                else:
+                    i = 0
+                    for ifile, model, contenttype_id, dependencies in models:
+                        task.status = str(int(10 + i / cnt * 80)) + "%"
+                        task.message = "Processing data file %s" % ifile
+                        task.save(using=self.database)
+                        i += 1
+                        returnederrors = self.loadFile(ifile, model)
                         errors[0] += returnederrors[0]
                         errors[1] += returnederrors[1]
-                        logger.info(
-                            "%s Finished processing data in CSV file: %s"
-                            % (datetime.now().replace(microsecond=0), ifile)
-                        )
             else:
                 errors[0] += 1
                 cnt = 0
@@ -327,6 +283,132 @@ class Command(BaseCommand):
                 "%s End of importfromfolder\n" % datetime.now().replace(microsecond=0)
             )
 
+    def initialize(self):
+        # Choose the right self.delimiter and language
+        self.delimiter = (
+            get_format("DECIMAL_SEPARATOR", settings.LANGUAGE_CODE, True) == ","
+            and ";"
+            or ","
+        )
+        translation.activate(settings.LANGUAGE_CODE)
+        self.SQLrole = settings.DATABASES[self.database].get("SQL_ROLE", "report_role")
+
+    def loadFile(self, ifile, model):
+        """
+        Loads a single data file, and returns the number of errors and warnings.
+        """
+        filetoparse = os.path.join(
+            os.path.abspath(settings.DATABASES[self.database]["FILEUPLOADFOLDER"]),
+            ifile,
+        )
+        if ifile.lower().endswith(SQLFILES):
+            logger.info(
+                "%s Started executing SQL statements from file: %s"
+                % (datetime.now().replace(microsecond=0), ifile)
+            )
+            errors = [self.executeSQLfile(filetoparse), 0]
+            logger.info(
+                "%s Finished executing SQL statements from file: %s"
+                % (datetime.now().replace(microsecond=0), ifile)
+            )
+        elif ifile.lower().endswith((".cpy", ".cpy.gz")):
+            logger.info(
+                "%s Started uploading copy file: %s"
+                % (datetime.now().replace(microsecond=0), ifile)
+            )
+            errors = [self.executeCOPYfile(model, filetoparse), 0]
+            logger.info(
+                "%s Finished uploading copy file: %s"
+                % (datetime.now().replace(microsecond=0), ifile)
+            )
+        elif ifile.lower().endswith(".xlsx"):
+            logger.info(
+                "%s Started processing data in Excel file: %s"
+                % (datetime.now().replace(microsecond=0), ifile)
+            )
+            errors = self.loadExcelfile(model, filetoparse)
+            logger.info(
+                "%s Finished processing data in file: %s"
+                % (datetime.now().replace(microsecond=0), ifile)
+            )
+        else:
+            logger.info(
+                "%s Started processing data in CSV file: %s"
+                % (datetime.now().replace(microsecond=0), ifile)
+            )
+            errors = self.loadCSVfile(model, filetoparse)
+            logger.info(
+                "%s Finished processing data in CSV file: %s"
+                % (datetime.now().replace(microsecond=0), ifile)
+            )
+        return errors
+
+    def loadFilesInParallel(self, models, task, errors):
+        """
+        Loads the data files on a pool of processes.
+        A file is loaded as soon as all files it depends on are loaded:
+          - files for models it refers to
+          - files for the same model that come earlier in alphabetical order
+          - SQL files, which are run in isolation since they can touch any table
+        """
+        cnt = len(models)
+        waiting = {}
+        for j, (ifile, model, contenttype_id, dependencies) in enumerate(models):
+            waiting[j] = set(
+                i
+                for i in range(j)
+                if models[i][1] == model
+                or model in models[i][3]
+                or models[i][1] in dependencies
+                or ifile.lower().endswith(SQLFILES)
+                or models[i][0].lower().endswith(SQLFILES)
+            )
+
+        # Close all database connections to assure the parent and child
+        # processes don't share them.
+        connections.close_all()
+
+        done = 0
+        running = {}
+        with ProcessPoolExecutor(
+            max_workers=self.processes,
+            initializer=initializeWorker,
+            initargs=(self.database, self.logfile),
+        ) as pool:
+            while waiting or running:
+                # Launch all files that have no pending dependencies any longer
+                for j in sorted(j for j, deps in waiting.items() if not deps):
+                    del waiting[j]
+                    running[
+                        pool.submit(
+                            loadFileInWorker,
+                            self.database,
+                            self.user.username if self.user else None,
+                            models[j][0],
+                            models[j][1],
+                        )
+                    ] = j
+
+                # Wait for a file to finish
+                for f in wait(running, return_when=FIRST_COMPLETED)[0]:
+                    j = running.pop(f)
+                    try:
+                        returnederrors = f.result()
+                    except Exception as e:
+                        logger.error(
+                            "%s Error processing file %s: %s"
+                            % (datetime.now().replace(microsecond=0), models[j][0], e)
+                        )
+                        returnederrors = [1, 0]
+                    errors[0] += returnederrors[0]
+                    errors[1] += returnederrors[1]
+                    for deps in waiting.values():
+                        deps.discard(j)
+                    done += 1
+                task.status = str(int(10 + done / cnt * 80)) + "%"
+                task.message = "Processed %s of %s data files" % (done, cnt)
+                task.save(using=self.database)
+
     def executeCOPYfile(self, model, ifile):
         """
         Use the copy command to upload data into the database
@@ -605,6 +687,39 @@ class Command(BaseCommand):
         )
 
 
+def initializeWorker(database, logfile):
+    """
+    Initializes a process of the pool loading data files in parallel.
+    """
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "freppledb.settings")
+    import django
+
+    django.setup()
+
+    # Processes that are forked inherit the log handler of the parent process
+    if not logger.handlers and logfile:
+        logger.addHandler(logging.FileHandler(logfile, encoding="utf-8"))
+        logger.propagate = False
+
+
+def loadFileInWorker(database, username, ifile, model):
+    """
+    Loads a data file in a process of the pool.
+    """
+    cmd = Command()
+    cmd.database = database
+    cmd.user = (
+        User.objects.all().using(database).get(username=username) if username else None
+    )
+    cmd.initialize()
+    setattr(_thread_locals, "database", database)
+    try:
+        return cmd.loadFile(ifile, model)
+    finally:
+        setattr(_thread_locals, "database", None)
+        connections.close_all()
+
+
 class EncodedCSVReader:
     """
     A CSV reader which will iterate over lines in the CSV data buffer.
@@ -17,7 +17,8 @@
 
 from datetime import datetime, timedelta
 import logging
-from multiprocessing import Process
+from multiprocessing import Process, Pipe
+from multiprocessing.connection import wait
 import operator
 import os
 import shlex
@@ -30,15 +31,26 @@ from django.conf import settings
 from django.core.management import get_commands
 from django.core.management.base import BaseCommand, CommandError
 from django.db import DEFAULT_DB_ALIAS, connections
+from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
 
 from freppledb import VERSION, runCommand
 from freppledb.common.models import Parameter
 from freppledb.common.middleware import _thread_locals
+from freppledb.common.report import create_connection
 from freppledb.execute.models import Task
 
 
 logger = logging.getLogger(__name__)
 
+# Short tasks that can run concurrently in the worker pool.
+# All other tasks run in a dedicated process, after all running tasks finished.
+CONCURRENT_TASKS = (
+    "exporttofolder",
+    "emailreport",
+    "importfromfolder",
+    "importworkbook",
+)
+
 
 class WorkerAlive(Thread):
     def __init__(self, database=DEFAULT_DB_ALIAS):
@@ -113,6 +125,53 @@ def launchWorker(database=DEFAULT_DB_ALIAS):
             Popen(["frepplectl", "runworker", "--database=%s" % database])
 
 
+def taskArguments(task, database):
+    """
+    Returns the positional and keyword arguments to run a task.
+    """
+    args = []
+    kwargs = {"database": database, "task": task.id, "verbosity": 0}
+    if task.arguments:
+        for i in shlex.split(task.arguments):
+            if "=" in i:
+                key, val = i.split("=")
+                kwargs[key.strip("--").replace("-", "_")] = val
+            else:
+                args.append(i)
+    return args, kwargs
+
+
+def finishTask(task, database):
+    """
+    Updates the status of a task after its process finished.
+    """
+    background = "background" in task.arguments if task.arguments else False
+
+    # Read the task again from the database and update it
+    task = Task.objects.all().using(database).get(pk=task.id)
+    task.processid = None
+    if task.status not in ("Done", "Failed") or not task.finished or not task.started:
+        now = datetime.now()
+        if not task.started:
+            task.started = now
+        if not background:
+            if not task.finished:
+                task.finished = now
+            if task.status not in ("Done", "Failed"):
+                task.status = "Done"
+        task.save(using=database)
+    if "FREPPLE_TEST" not in os.environ:
+        logger.info(
+            "Worker %s for database '%s' finished task %d at %s: success"
+            % (
+                os.getpid(),
+                settings.DATABASES[database]["NAME"],
+                task.id,
+                datetime.now(),
+            )
+        )
+
+
 def runTask(task, database):
     task.started = datetime.now()
     # Verify the command exists
@@ -133,16 +192,7 @@ def runTask(task, database):
         # process don't share them.
         connections.close_all()
         # Spawn a new command process
-        args = []
-        kwargs = {"database": database, "task": task.id, "verbosity": 0}
-        background = "background" in task.arguments if task.arguments else False
-        if task.arguments:
-            for i in shlex.split(task.arguments):
-                if "=" in i:
-                    key, val = i.split("=")
-                    kwargs[key.strip("--").replace("-", "_")] = val
-                else:
-                    args.append(i)
+        args, kwargs = taskArguments(task, database)
         child = Process(
             target=runCommand,
             args=(task.name, *args),
@@ -158,34 +208,164 @@ def runTask(task, database):
 
         # Wait for the child to finish
         child.join()
+        finishTask(task, database)
 
-        # Read the task again from the database and update it
-        task = Task.objects.all().using(database).get(pk=task.id)
-        task.processid = None
-        if (
-            task.status not in ("Done", "Failed")
-            or not task.finished
-            or not task.started
-        ):
-            now = datetime.now()
-            if not task.started:
-                task.started = now
-            if not background:
-                if not task.finished:
-                    task.finished = now
-                if task.status not in ("Done", "Failed"):
-                    task.status = "Done"
-            task.save(using=database)
-        if "FREPPLE_TEST" not in os.environ:
-            logger.info(
-                "Worker %s for database '%s' finished task %d at %s: success"
-                % (
-                    os.getpid(),
-                    settings.DATABASES[database]["NAME"],
-                    task.id,
-                    datetime.now(),
-                )
+
+def poolWorker(database, pipe):
+    """
+    Main loop of a process in the worker pool.
+    The process initializes django and imports all commands upfront, and
+    then runs the tasks it receives one by one.
+    """
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "freppledb.settings")
+    import django
+
+    django.setup()
+
+    from django.core.management import load_command_class
+
+    for name, app in get_commands().items():
+        try:
+            load_command_class(app, name)
+        except Exception:
+            pass
+
+    while True:
+        msg = pipe.recv()
+        if msg is None:
+            break
+        taskname, args, kwargs = msg
+        runCommand(taskname, *args, **kwargs)
+        pipe.send(kwargs["task"])
+
+
+class WorkerPool:
+    """
+    A pool of processes that are started once, and run short tasks concurrently.
+    """
+
+    def __init__(self, database, size):
+        self.database = database
+        self.workers = [self.startWorker() for i in range(size)]
+
+    def startWorker(self):
+        # Close all database connections to assure the parent and child
+        # process don't share them.
+        connections.close_all()
+        parent, child = Pipe()
+        process = Process(
+            target=poolWorker,
+            args=(self.database, child),
+            name="frepplectl worker pool",
+            daemon=True,
+        )
+        process.start()
+        return {"process": process, "pipe": parent, "task": None}
+
+    def running(self):
+        return [w["task"] for w in self.workers if w["task"]]
+
+    def available(self, task):
+        """
+        Returns true when the task can be started now in the pool.
+        """
+        return (
+            task.name in CONCURRENT_TASKS
+            and any(w["task"] is None for w in self.workers)
+            and all(
+                w["task"] is None or w["task"].name != task.name for w in self.workers
             )
+        )
+
+    def submit(self, task):
+        for w in self.workers:
+            if w["task"] is None:
+                args, kwargs = taskArguments(task, self.database)
+                w["task"] = task
+                task.started = datetime.now()
+                task.processid = w["process"].pid
+                task.save(update_fields=["processid"], using=self.database)
+                w["pipe"].send((task.name, args, kwargs))
+                return
+
+    def waitables(self):
+        """
+        Returns the objects to wait for to detect the end of a task.
+        """
+        return [w["pipe"] for w in self.workers if w["task"]] + [
+            w["process"].sentinel for w in self.workers if w["task"]
+        ]
+
+    def collect(self):
+        """
+        Updates the status of the tasks that finished.
+        A process that died, eg because the task was canceled, is replaced.
+        """
+        for idx, w in enumerate(self.workers):
+            if not w["task"]:
+                continue
+            if w["pipe"].poll():
+                w["pipe"].recv()
+            elif w["process"].is_alive():
+                continue
+            else:
+                w["pipe"].close()
+                self.workers[idx] = self.startWorker()
+            finishTask(w["task"], self.database)
+            w["task"] = None
+
+    def close(self):
+        for w in self.workers:
+            try:
+                w["pipe"].send(None)
+            except Exception:
+                pass
+        for w in self.workers:
+            w["process"].join(5)
+            if w["process"].is_alive():
+                w["process"].terminate()
+
+
+class TaskListener:
+    """
+    Listens on a dedicated database connection for the notifications
+    sent when a new task is added to the queue.
+    """
+
+    def __init__(self, database):
+        self.connection = None
+        if os.name == "nt":
+            # Waiting on a socket isn't supported on windows
+            return
+        try:
+            self.connection = create_connection(database)
+            self.connection.ensure_connection()
+            self.connection.connection.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
+            with self.connection.connection.cursor() as cursor:
+                cursor.execute("listen %s" % Task.notify_channel)
+        except Exception as e:
+            logger.warning("Can't listen to task notifications: %s" % e)
+            self.connection = None
+
+    def wait(self, timeout, others=[]):
+        """
+        Waits till a new task is announced, one of the other objects is ready
+        or the timeout expires.
+        """
+        if not self.connection:
+            if others:
+                wait(others, timeout if os.name != "nt" else min(timeout, 0.2))
+            else:
+                time.sleep(timeout)
+            return
+        conn = self.connection.connection
+        if conn in wait([conn, *others], timeout):
+            conn.poll()
+            conn.notifies.clear()
+
+    def close(self):
+        if self.connection:
+            self.connection.close()
 
 
 class Command(BaseCommand):
@@ -211,6 +391,12 @@ class Command(BaseCommand):
             default=False,
             help="Keep the worker alive after the queue is empty",
         )
+        parser.add_argument(
+            "--processes",
+            type=int,
+            default=1,
+            help="Number of pre-started processes running short tasks concurrently",
+        )
 
     def handle(self, *args, **options):
 
@@ -219,6 +405,7 @@ class Command(BaseCommand):
         if database not in settings.DATABASES:
             raise CommandError("No database settings known for '%s'" % database)
         continuous = options["continuous"]
+        processes = options["processes"] or 1
 
         # Use the test database if we are running the test suite
         if "FREPPLE_TEST" in os.environ:
@@ -246,19 +433,27 @@ class Command(BaseCommand):
             )
         idle_loop_done = False
         setattr(_thread_locals, "database", database)
+        pool = WorkerPool(database, processes) if processes > 1 else None
+        listener = TaskListener(database)
         while True:
+            if pool:
+                pool.collect()
             try:
                 task = (
                     Task.objects.all()
                     .using(database)
                     .filter(status="Waiting")
+                    .exclude(id__in=[t.id for t in pool.running()] if pool else [])
                     .order_by("id")[0]
                 )
                 idle_loop_done = False
             except Exception:
                 # No more tasks found
-                if continuous:
-                    time.sleep(5)
+                if pool and pool.running():
+                    listener.wait(5, pool.waitables())
+                    continue
+                elif continuous:
+                    listener.wait(5)
                     continue
                 else:
                     # Special case: we need to permit a single idle loop before shutting down
@@ -268,9 +463,13 @@ class Command(BaseCommand):
                         break
                     else:
                         idle_loop_done = True
-                        time.sleep(5)
+                        listener.wait(5)
                         continue
             try:
+                if pool and pool.running() and not pool.available(task):
+                    # Wait for the running tasks to finish
+                    listener.wait(5, pool.waitables())
+                    continue
                 if "FREPPLE_TEST" not in os.environ:
                     logger.info(
                         "Worker %s for database '%s' starting task %d at %s"
@@ -281,7 +480,10 @@ class Command(BaseCommand):
                             datetime.now(),
                         )
                     )
-                runTask(task, database)
+                if pool and pool.available(task):
+                    pool.submit(task)
+                else:
+                    runTask(task, database)
             except Exception as e:
                 # Read the task again from the database and update.
                 task = Task.objects.all().using(database).get(pk=task.id)
@@ -302,6 +504,10 @@ class Command(BaseCommand):
                             datetime.now(),
                         )
                     )
+        if pool:
+            pool.close()
+        listener.close()
+
         # Remove the parameter again
         try:
             Parameter.objects.all().using(database).get(pk="Worker alive").delete()
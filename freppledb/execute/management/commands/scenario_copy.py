@@ -16,17 +16,20 @@
 #
 
 import os
+import psycopg2
+import shutil
 import subprocess
+import tempfile
 from datetime import datetime
 
 from django.core.management.base import BaseCommand, CommandError
 from django.conf import settings
-from django.db import DEFAULT_DB_ALIAS
+from django.db import connections, DEFAULT_DB_ALIAS
 from django.utils.translation import gettext_lazy as _
 from django.template.loader import render_to_string
 
 from freppledb.execute.models import Task, ScheduledTask
-from freppledb.common.models import User, Scenario
+from freppledb.common.models import NotifiedCache, User, Scenario
 from freppledb import VERSION
 
 
@@ -41,6 +44,23 @@ class Command(BaseCommand):
 
     requires_system_checks = False
 
+    # Tables that are not copied when promoting a scenario to production
+    excluded_tables = (
+        "common_user",
+        "common_scenario",
+        "auth_group",
+        "auth_group_permission",
+        "auth_permission",
+        "django_content_type",
+        "common_comment",
+        "common_user_groups",
+        "common_user_user_permissions",
+        "common_preferences",
+        "reportmanager_report",
+        "reportmanager_column",
+        "execute_schedule",
+    )
+
     def get_version(self):
         return VERSION
 
@@ -71,6 +91,20 @@ class Command(BaseCommand):
             default=False,
             help="promotes a scenario to production",
         )
+        parser.add_argument(
+            "--method",
+            default="dump",
+            choices=["dump", "template", "directory"],
+            help="Copy method: dump and restore over a pipe (default), "
+            "a template database with a fallback to the directory method, "
+            "or a parallel dump and restore in directory format",
+        )
+        parser.add_argument(
+            "--jobs",
+            type=int,
+            default=4,
+            help="Number of parallel jobs of the directory copy method",
+        )
         parser.add_argument("source", help="source database to copy")
         parser.add_argument("destination", help="destination database to copy")
 
@@ -85,7 +119,8 @@ class Command(BaseCommand):
         # Pick up options
         force = options["force"]
         promote = options["promote"]
-        test = "FREPPLE_TEST" in os.environ
+        method = options["method"]
+        self.jobs = max(1, options["jobs"] or 1)
         if options["user"]:
             try:
                 user = User.objects.all().get(username=options["user"])
@@ -176,80 +211,14 @@ class Command(BaseCommand):
             # Commenting the next line is a little more secure, but requires you to create a .pgpass file.
             if settings.DATABASES[source]["PASSWORD"]:
                 os.environ["PGPASSWORD"] = settings.DATABASES[source]["PASSWORD"]
-            if os.name == "nt":
-                # On windows restoring with pg_restore over a pipe is broken :-(
-                cmd = "pg_dump -c -Fp %s%s%s%s%s | psql %s%s%s%s"
+            if method == "template" and self.copyWithTemplate(
+                task, source, destination
+            ):
+                pass
+            elif method in ("template", "directory"):
+                self.copyWithDirectory(task, source, destination)
             else:
-                cmd = "pg_dump -Fc %s%s%s%s%s | pg_restore -n public -Fc -c --if-exists %s%s%s -d %s"
-            commandline = cmd % (
-                settings.DATABASES[source]["USER"]
-                and ("-U %s " % settings.DATABASES[source]["USER"])
-                or "",
-                settings.DATABASES[source]["HOST"]
-                and ("-h %s " % settings.DATABASES[source]["HOST"])
-                or "",
-                settings.DATABASES[source]["PORT"]
-                and ("-p %s " % settings.DATABASES[source]["PORT"])
-                or "",
-                """
-                -T common_user
-                -T common_scenario
-                -T auth_group
-                -T auth_group_permission
-                -T auth_permission
-                -T django_content_type
-                -T common_comment
-                -T common_user_groups
-                -T common_user_user_permissions
-                -T common_preferences
-                -T reportmanager_report
-                -T reportmanager_column
-                -T execute_schedule
-                """
-                if destination == DEFAULT_DB_ALIAS
-                else "",
-                test
-                and settings.DATABASES[source]["TEST"]["NAME"]
-                or settings.DATABASES[source]["NAME"],
-                settings.DATABASES[destination]["USER"]
-                and ("-U %s " % settings.DATABASES[destination]["USER"])
-                or "",
-                settings.DATABASES[destination]["HOST"]
-                and ("-h %s " % settings.DATABASES[destination]["HOST"])
-                or "",
-                settings.DATABASES[destination]["PORT"]
-                and ("-p %s " % settings.DATABASES[destination]["PORT"])
-                or "",
-                test
-                and settings.DATABASES[destination]["TEST"]["NAME"]
-                or settings.DATABASES[destination]["NAME"],
-            )
-            with subprocess.Popen(
-                commandline,
-                shell=True,
-                stdout=subprocess.DEVNULL,
-                stderr=subprocess.STDOUT,
-            ) as p:
-                try:
-                    task.processid = p.pid
-                    task.save(using=source)
-                    p.wait()
-                    # Deactivated because a successful copy can still leave warnings and errors
-                    # if p.returncode and destination != DEFAULT_DB_ALIAS:
-                    #    # Consider the destination database free again
-                    #    destinationscenario.status = "Free"
-                    #    destinationscenario.lastrefresh = datetime.today()
-                    #    destinationscenario.save(using=DEFAULT_DB_ALIAS)
-                    #    raise Exception("Database copy failed")
-                except Exception:
-                    p.kill()
-                    p.wait()
-                    # Consider the destination database free again
-                    if destination != DEFAULT_DB_ALIAS:
-                        destinationscenario.status = "Free"
-                        destinationscenario.lastrefresh = datetime.today()
-                        destinationscenario.save(using=DEFAULT_DB_ALIAS)
-                    raise Exception("Database copy failed")
+                self.copyWithDump(task, source, destination, destinationscenario)
 
             # Update the scenario table
             destinationscenario.status = "In use"
@@ -325,6 +294,290 @@ class Command(BaseCommand):
                 task.save(using=source)
             settings.DEBUG = tmp_debug
 
+    def databaseName(self, database):
+        if "FREPPLE_TEST" in os.environ:
+            return settings.DATABASES[database]["TEST"]["NAME"]
+        else:
+            return settings.DATABASES[database]["NAME"]
+
+    def connectionArguments(self, database):
+        args = []
+        if settings.DATABASES[database]["USER"]:
+            args += ["-U", settings.DATABASES[database]["USER"]]
+        if settings.DATABASES[database]["HOST"]:
+            args += ["-h", settings.DATABASES[database]["HOST"]]
+        if settings.DATABASES[database]["PORT"]:
+            args += ["-p", str(settings.DATABASES[database]["PORT"])]
+        return args
+
+    def copyWithDump(self, task, source, destination, destinationscenario):
+        """
+        Copies the database with pg_dump and pg_restore connected with a pipe.
+        """
+        if os.name == "nt":
+            # On windows restoring with pg_restore over a pipe is broken :-(
+            cmd = "pg_dump -c -Fp %s%s%s%s%s | psql %s%s%s%s"
+        else:
+            cmd = "pg_dump -Fc %s%s%s%s%s | pg_restore -n public -Fc -c --if-exists %s%s%s -d %s"
+        commandline = cmd % (
+            settings.DATABASES[source]["USER"]
+            and ("-U %s " % settings.DATABASES[source]["USER"])
+            or "",
+            settings.DATABASES[source]["HOST"]
+            and ("-h %s " % settings.DATABASES[source]["HOST"])
+            or "",
+            settings.DATABASES[source]["PORT"]
+            and ("-p %s " % settings.DATABASES[source]["PORT"])
+            or "",
+            " ".join("-T %s" % t for t in self.excluded_tables) + " "
+            if destination == DEFAULT_DB_ALIAS
+            else "",
+            self.databaseName(source),
+            settings.DATABASES[destination]["USER"]
+            and ("-U %s " % settings.DATABASES[destination]["USER"])
+            or "",
+            settings.DATABASES[destination]["HOST"]
+            and ("-h %s " % settings.DATABASES[destination]["HOST"])
+            or "",
+            settings.DATABASES[destination]["PORT"]
+            and ("-p %s " % settings.DATABASES[destination]["PORT"])
+            or "",
+            self.databaseName(destination),
+        )
+        with subprocess.Popen(
+            commandline,
+            shell=True,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.STDOUT,
+        ) as p:
+            try:
+                task.processid = p.pid
+                task.save(using=source)
+                p.wait()
+                # Deactivated because a successful copy can still leave warnings and errors
+                # if p.returncode and destination != DEFAULT_DB_ALIAS:
+                #    # Consider the destination database free again
+                #    destinationscenario.status = "Free"
+                #    destinationscenario.lastrefresh = datetime.today()
+                #    destinationscenario.save(using=DEFAULT_DB_ALIAS)
+                #    raise Exception("Database copy failed")
+            except Exception:
+                p.kill()
+                p.wait()
+                # Consider the destination database free again
+                if destination != DEFAULT_DB_ALIAS:
+                    destinationscenario.status = "Free"
+                    destinationscenario.lastrefresh = datetime.today()
+                    destinationscenario.save(using=DEFAULT_DB_ALIAS)
+                raise Exception("Database copy failed")
+
+    def copyWithTemplate(self, task, source, destination):
+        """
+        Creates the destination database as a copy of the source database.
+        This is a file-level copy on the database server, which is much faster
+        than a dump and restore. It's only possible when no other sessions are
+        connected to the source and destination databases, and the user has
+        the privilege to create databases.
+        The copy is built under a temporary name, and replaces the destination
+        database only when it is complete.
+        Returns false when the copy wasn't possible.
+        """
+        if destination == DEFAULT_DB_ALIAS:
+            # A promotion needs to leave some tables untouched
+            return False
+        src = settings.DATABASES[source]
+        dest = settings.DATABASES[destination]
+        if (src["HOST"], src["PORT"]) != (dest["HOST"], dest["PORT"]):
+            return False
+        sourcename = self.databaseName(source)
+        destinationname = self.databaseName(destination)
+        tempname = "%s_copy" % destinationname
+        oldname = "%s_old" % destinationname
+        task.status = "10%"
+        task.message = "Copying database from template"
+        task.save(using=source)
+
+        # Our own connections to both databases need to be closed
+        for db in (source, destination):
+            connections[db].close()
+            NotifiedCache.close(db)
+        conn = None
+        try:
+            conn = psycopg2.connect(
+                dbname="postgres",
+                user=dest["USER"] or None,
+                password=dest["PASSWORD"] or None,
+                host=dest["HOST"] or None,
+                port=dest["PORT"] or None,
+            )
+            conn.autocommit = True
+            with conn.cursor() as cursor:
+                # Other sessions, eg of the web server or the worker, block the
+                # copy and the replacement of the destination database.
+                # We don't interrupt them, but use another copy method.
+                cursor.execute(
+                    """
+                    select datname from pg_stat_activity
+                    where datname in (%s, %s) and pid <> pg_backend_pid()
+                    limit 1
+                    """,
+                    (sourcename, destinationname),
+                )
+                busy = cursor.fetchone()
+                if busy:
+                    task.message = (
+                        "Can't use template database: other sessions are using database %s"
+                        % busy[0]
+                    )
+                    return False
+                cursor.execute('drop database if exists "%s"' % tempname)
+                cursor.execute('drop database if exists "%s"' % oldname)
+                try:
+                    cursor.execute(
+                        'create database "%s" template "%s"' % (tempname, sourcename)
+                    )
+                except psycopg2.Error as e:
+                    # Typically because a session connected to the source database
+                    task.message = "Can't use template database: %s" % e
+                    return False
+
+                # Swap the copy in place of the destination in a single
+                # transaction, such that the destination database always exists
+                cursor.execute(
+                    "select 1 from pg_database where datname = %s", (destinationname,)
+                )
+                exists = cursor.fetchone() is not None
+                try:
+                    conn.autocommit = False
+                    if exists:
+                        cursor.execute(
+                            'alter database "%s" rename to "%s"'
+                            % (destinationname, oldname)
+                        )
+                    cursor.execute(
+                        'alter database "%s" rename to "%s"'
+                        % (tempname, destinationname)
+                    )
+                    conn.commit()
+                except psycopg2.Error as e:
+                    # Typically because a session connected to the destination database
+                    conn.rollback()
+                    conn.autocommit = True
+                    cursor.execute('drop database "%s"' % tempname)
+                    task.message = "Can't replace destination database: %s" % e
+                    return False
+                conn.autocommit = True
+                if exists:
+                    cursor.execute('drop database "%s"' % oldname)
+            return True
+        except Exception as e:
+            task.message = "Can't use template database: %s" % e
+            return False
+        finally:
+            if conn:
+                conn.close()
+            task.save(using=source)
+
+    def copyWithDirectory(self, task, source, destination):
+        """
+        Copies the database with a parallel pg_dump and pg_restore in
+        directory format. The progress is reported per table.
+        """
+        with connections[source].cursor() as cursor:
+            cursor.execute(
+                """
+                select count(*) from pg_tables
+                where schemaname = 'public' and not tablename = any(%s)
+                """,
+                (
+                    list(self.excluded_tables)
+                    if destination == DEFAULT_DB_ALIAS
+                    else [],
+                ),
+            )
+            tables = cursor.fetchone()[0]
+        folder = tempfile.mkdtemp(prefix="scenario_copy_")
+        dumpfolder = os.path.join(folder, "dump")
+        try:
+            # Dump the source database
+            args = ["pg_dump", "-Fd", "-v", "-j", str(self.jobs), "-f", dumpfolder]
+            args += self.connectionArguments(source)
+            if destination == DEFAULT_DB_ALIAS:
+                for t in self.excluded_tables:
+                    args += ["-T", t]
+            args.append(self.databaseName(source))
+            self.runWithProgress(
+                task, source, args, "dumping contents of table", 0, 50, tables
+            )
+
+            # Restore into the destination database
+            tables = subprocess.run(
+                ["pg_restore", "-l", dumpfolder],
+                stdout=subprocess.PIPE,
+                universal_newlines=True,
+                check=True,
+            ).stdout.count(" TABLE DATA ")
+            args = [
+                "pg_restore",
+                "-Fd",
+                "-v",
+                "-j",
+                str(self.jobs),
+                "-n",
+                "public",
+                "-c",
+                "--if-exists",
+            ]
+            args += self.connectionArguments(destination)
+            args += ["-d", self.databaseName(destination), dumpfolder]
+            # A successful restore can still leave warnings and errors
+            self.runWithProgress(
+                task,
+                source,
+                args,
+                "processing data for table",
+                50,
+                100,
+                tables,
+                check=False,
+            )
+        finally:
+            shutil.rmtree(folder, ignore_errors=True)
+
+    def runWithProgress(
+        self, task, source, args, marker, start, end, tables, check=True
+    ):
+        """
+        Runs pg_dump or pg_restore in verbose mode, and reports the progress
+        on the task for every table.
+        """
+        count = 0
+        with subprocess.Popen(
+            args,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE,
+            universal_newlines=True,
+        ) as p:
+            try:
+                task.processid = p.pid
+                task.save(using=source)
+                for line in p.stderr:
+                    if marker in line:
+                        count += 1
+                        task.status = "%d%%" % (
+                            start + (end - start) * min(count, tables) / max(tables, 1)
+                        )
+                        table = line.split(marker, 1)[1].strip().strip('"')
+                        task.message = "Copying table %s" % table
+                        task.save(using=source)
+                p.wait()
+            except Exception:
+                p.kill()
+                p.wait()
+                raise
+        if check and p.returncode:
+            raise Exception("Database copy failed")
+
     # accordion template
     title = _("scenario management")
     index = 1500
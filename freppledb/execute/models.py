@@ -16,12 +16,13 @@
 #
 
 from datetime import datetime, timedelta
+from threading import Lock
 
-from django.db import models
+from django.db import connections, models, transaction, DEFAULT_DB_ALIAS
 from django.utils.translation import gettext_lazy as _
 
 from freppledb.common.fields import JSONBField
-from freppledb.common.models import User
+from freppledb.common.models import NotifiedCache, User
 
 import logging
 
@@ -64,9 +65,32 @@ class Task(models.Model):
     )
     processid = models.IntegerField("processid", editable=False, null=True)
 
+    # Names of the PostgreSQL notification channels announcing new tasks
+    # and finished tasks
+    notify_channel = "frepple_task"
+    finished_channel = "frepple_task_finished"
+
     def __str__(self):
         return "%s - %s - %s" % (self.id, self.name, self.status)
 
+    def save(self, *args, **kwargs):
+        created = self._state.adding
+        super().save(*args, **kwargs)
+        if self.status == "Waiting":
+            if not created:
+                return
+            # Wake up the worker listening for new tasks.
+            # The notification is delivered when the transaction commits.
+            channel = self.notify_channel
+        elif self.status in ("Done", "Failed"):
+            # The task may have changed the data: invalidate cached results
+            channel = self.finished_channel
+        else:
+            return
+        database = self._state.db or DEFAULT_DB_ALIAS
+        with connections[database].cursor() as cursor:
+            cursor.execute("select pg_notify(%s, %s)", (channel, str(self.id)))
+
     class Meta:
         db_table = "execute_log"
         verbose_name_plural = _("tasks")
@@ -80,6 +104,65 @@ class Task(models.Model):
         return 1
 
 
+class PlanVersion(NotifiedCache):
+    """
+    Identifies the version of the data in a database, based on the tasks
+    that finished and the edits that were saved. Cached results computed
+    from the data include the version in their key, so they become obsolete
+    when a task finishes or an edit is committed.
+    """
+
+    channel = Task.finished_channel
+    cache = {}
+    lock = Lock()
+
+    @classmethod
+    def load(cls, database):
+        with connections[database].cursor() as cursor:
+            cursor.execute(
+                """
+                select count(*), max(finished),
+                  (
+                  select case when is_called then last_value else 0 end
+                  from execute_planversion_seq
+                  )
+                from execute_log
+                where status in ('Done', 'Failed')
+                """
+            )
+            return "%s_%s_%s" % cursor.fetchone()
+
+    @classmethod
+    def getVersion(cls, database=DEFAULT_DB_ALIAS):
+        return cls.get(database) or cls.load(database)
+
+    @classmethod
+    def changed(cls, database=DEFAULT_DB_ALIAS):
+        """
+        Registers an edit of the data. The version is incremented once the
+        current transaction commits, so a new version never sees the data
+        from before the edit.
+        """
+        connection = connections[database]
+        increment = getattr(connection, "planversion_increment", None)
+        if increment is None:
+
+            def increment():
+                with connection.cursor() as cursor:
+                    cursor.execute(
+                        "select nextval('execute_planversion_seq'), pg_notify(%s, '')",
+                        (cls.channel,),
+                    )
+
+            connection.planversion_increment = increment
+        elif connection.in_atomic_block and any(
+            f is increment for sids, f in connection.run_on_commit
+        ):
+            # Already registered in this transaction
+            return
+        transaction.on_commit(increment, using=database)
+
+
 class ScheduledTask(models.Model):
 
     # Database fields
@@ -94,6 +94,75 @@ class execute_with_commands(TransactionTestCase):
                     count += 1
         self.assertGreaterEqual(count, 8)
 
+    def test_sharded_export(self):
+        def exportedPlan():
+            return sorted(
+                input.models.OperationPlan.objects.all().values_list(
+                    "type",
+                    "status",
+                    "operation",
+                    "item",
+                    "location",
+                    "origin",
+                    "destination",
+                    "supplier",
+                    "demand",
+                    "quantity",
+                    "startdate",
+                    "enddate",
+                ),
+                key=lambda x: tuple(str(i) for i in x),
+            )
+
+        management.call_command("runplan", plantype=1, constraint=15, env="supply")
+        single = exportedPlan()
+        self.assertGreater(len(single), 0)
+        for sharding in ("hash", "cluster"):
+            Parameter.objects.update_or_create(
+                name="plan.export.shards", defaults={"value": "3"}
+            )
+            Parameter.objects.update_or_create(
+                name="plan.export.sharding", defaults={"value": sharding}
+            )
+            management.call_command("runplan", plantype=1, constraint=15, env="supply")
+            self.assertEqual(exportedPlan(), single)
+
+    def test_benchmark(self):
+        outfile = os.path.join(settings.FREPPLE_LOGDIR, "benchmark_test.json")
+        try:
+            management.call_command(
+                "benchmark",
+                size=["cluster=1"],
+                output=outfile,
+                interactive=False,
+                verbosity=0,
+            )
+            with open(outfile, "r") as f:
+                results = json.load(f)
+            self.assertEqual(len(results["runs"]), 1)
+            run = results["runs"][0]
+            self.assertEqual(run["size"], "cluster=1")
+            self.assertGreater(run["records"]["operationplan"], 0)
+            self.assertGreater(len(run["steps"]), 0)
+            for step in run["steps"]:
+                self.assertEqual(step["status"], "Done")
+                self.assertGreaterEqual(step["seconds"], 0)
+            # Steps loading data from the database execute SQL statements
+            self.assertGreater(sum(s["statements"] for s in run["steps"]), 0)
+            # Comparing with itself finds no regressions
+            management.call_command(
+                "benchmark",
+                size=["cluster=1"],
+                output=outfile,
+                compare=outfile,
+                tolerance=100,
+                interactive=False,
+                verbosity=0,
+            )
+        finally:
+            if os.path.exists(outfile):
+                os.remove(outfile)
+
 
 class execute_multidb(TransactionTestCase):
 
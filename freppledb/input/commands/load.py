@@ -52,6 +52,8 @@ class LoadTask(PlanTask):
     - low weight by default, ie fast execution assumed
     - filter attribute to load only a subset of the data
     - subclass is used by the odoo connector to recognize data loading tasks
+    - the queries of a load task can be executed upfront in parallel, once the
+      reporting buckets are generated and checked
     """
 
     @staticmethod
@@ -60,6 +62,15 @@ class LoadTask(PlanTask):
 
     filter = None
 
+    dependencies = (3, 80)
+
+    @classmethod
+    def getFilter(cls):
+        if cls.filter:
+            return "where %s " % cls.filter
+        else:
+            return ""
+
 
 @PlanTaskRegistry.register
 class checkBuckets(CheckTask):
@@ -303,79 +314,72 @@ class loadCalendarBuckets(LoadTask):
     description = "Importing calendar buckets"
     sequence = 93
 
+    @classmethod
+    def getQueries(cls, **kwargs):
+        return [
+            """
+            SELECT
+              calendar_id, startdate, enddate, priority, value,
+              sunday, monday, tuesday, wednesday, thursday, friday, saturday,
+              starttime, endtime, source
+            FROM calendarbucket %s
+            UNION
+            SELECT
+              bucket_id calendar_id, startdate, enddate, 10 priority , 0 as value,
+              't' sunday,'t' monday,'t' tuesday,'t' wednesday,'t' thurday,'t' friday,'t' saturday,
+              time '00:00:00' starttime, time '23:59:59' endtime, 'common_bucketdetail' source
+            FROM common_bucketdetail
+            ORDER BY calendar_id, startdate desc
+            """
+            % cls.getFilter()
+        ]
+
     @classmethod
     def run(cls, database=DEFAULT_DB_ALIAS, **kwargs):
         import frepple
 
-        if cls.filter:
-            filter_where = "where %s " % cls.filter
-        else:
-            filter_where = ""
-
-        with connections[database].chunked_cursor() as cursor:
-            cnt = 0
-            starttime = time()
-            cursor.execute(
-                """
-                SELECT
-                  calendar_id, startdate, enddate, priority, value,
-                  sunday, monday, tuesday, wednesday, thursday, friday, saturday,
-                  starttime, endtime, source
-                FROM calendarbucket %s
-                UNION
-                SELECT
-                  bucket_id calendar_id, startdate, enddate, 10 priority , 0 as value,
-                  't' sunday,'t' monday,'t' tuesday,'t' wednesday,'t' thurday,'t' friday,'t' saturday,
-                  time '00:00:00' starttime, time '23:59:59' endtime, 'common_bucketdetail' source
-                FROM common_bucketdetail
-                ORDER BY calendar_id, startdate desc
-                """
-                % filter_where
-            )
-            prevcal = None
-            for i in cursor:
-                cnt += 1
-                try:
-                    days = 0
-                    if i[5]:
-                        days += 1
-                    if i[6]:
-                        days += 2
-                    if i[7]:
-                        days += 4
-                    if i[8]:
-                        days += 8
-                    if i[9]:
-                        days += 16
-                    if i[10]:
-                        days += 32
-                    if i[11]:
-                        days += 64
-                    if i[0] != prevcal:
-                        cal = frepple.calendar(name=i[0])
-                        prevcal = i[0]
-                    b = frepple.bucket(
-                        calendar=cal,
-                        start=i[1],
-                        end=i[2] if i[2] else datetime(2030, 12, 31),
-                        priority=i[3],
-                        source=i[14],
-                        value=i[4],
-                        days=days,
-                    )
-                    if i[12]:
-                        b.starttime = (
-                            i[12].hour * 3600 + i[12].minute * 60 + i[12].second
-                        )
-                    if i[13]:
-                        b.endtime = (
-                            i[13].hour * 3600 + i[13].minute * 60 + i[13].second + 1
-                        )
-                except Exception as e:
-                    logger.error("**** %s ****" % e)
-            logger.info(
-                "Loaded %d calendar buckets in %.2f seconds" % (cnt, time() - starttime)
-            )
+        cnt = 0
+        starttime = time()
+        prevcal = None
+        for i in cls.fetch(cls.getQueries()[0], database):
+            cnt += 1
+            try:
+                days = 0
+                if i[5]:
+                    days += 1
+                if i[6]:
+                    days += 2
+                if i[7]:
+                    days += 4
+                if i[8]:
+                    days += 8
+                if i[9]:
+                    days += 16
+                if i[10]:
+                    days += 32
+                if i[11]:
+                    days += 64
+                if i[0] != prevcal:
+                    cal = frepple.calendar(name=i[0])
+                    prevcal = i[0]
+                b = frepple.bucket(
+                    calendar=cal,
+                    start=i[1],
+                    end=i[2] if i[2] else datetime(2030, 12, 31),
+                    priority=i[3],
+                    source=i[14],
+                    value=i[4],
+                    days=days,
+                )
+                if i[12]:
+                    b.starttime = i[12].hour * 3600 + i[12].minute * 60 + i[12].second
+                if i[13]:
+                    b.endtime = i[13].hour * 3600 + i[13].minute * 60 + i[13].second + 1
+            except Exception as e:
+                logger.error("**** %s ****" % e)
+        logger.info(
+            "Loaded %d calendar buckets in %.2f seconds" % (cnt, time() - starttime)
+        )
 
 
 @PlanTaskRegistry.register
@@ -384,43 +388,38 @@ class loadCustomers(LoadTask):
     description = "Importing customers"
     sequence = 94
 
+    @classmethod
+    def getQueries(cls, **kwargs):
+        return [
+            """
+            SELECT
+              name, description, owner_id, category, subcategory, source
+            FROM customer %s
+            """
+            % cls.getFilter()
+        ]
+
     @classmethod
     def run(cls, database=DEFAULT_DB_ALIAS, **kwargs):
         import frepple
 
-        if cls.filter:
-            filter_where = "where %s " % cls.filter
-        else:
-            filter_where = ""
-
-        with connections[database].chunked_cursor() as cursor:
-            cnt = 0
-            starttime = time()
-            cursor.execute(
-                """
-                SELECT
-                  name, description, owner_id, category, subcategory, source
-                FROM customer %s
-                """
-                % filter_where
-            )
-            for i in cursor:
-                cnt += 1
-                try:
-                    x = frepple.customer(
-                        name=i[0],
-                        description=i[1],
-                        category=i[3],
-                        subcategory=i[4],
-                        source=i[5],
-                    )
-                    if i[2]:
-                        x.owner = frepple.customer(name=i[2])
-                except Exception as e:
-                    logger.error("**** %s ****" % e)
-            logger.info(
-                "Loaded %d customers in %.2f seconds" % (cnt, time() - starttime)
-            )
+        cnt = 0
+        starttime = time()
+        for i in cls.fetch(cls.getQueries()[0], database):
+            cnt += 1
+            try:
+                x = frepple.customer(
+                    name=i[0],
+                    description=i[1],
+                    category=i[3],
+                    subcategory=i[4],
+                    source=i[5],
+                )
+                if i[2]:
+                    x.owner = frepple.customer(name=i[2])
+            except Exception as e:
+                logger.error("**** %s ****" % e)
+        logger.info("Loaded %d customers in %.2f seconds" % (cnt, time() - starttime))
 
 
 @PlanTaskRegistry.register
@@ -429,47 +428,40 @@ class loadSuppliers(LoadTask):
     description = "Importing suppliers"
     sequence = 95
 
+    @classmethod
+    def getQueries(cls, **kwargs):
+        return [
+            """
+            SELECT
+              name, description, owner_id, category, subcategory, source, available_id
+            FROM supplier %s
+            """
+            % cls.getFilter()
+        ]
+
     @classmethod
     def run(cls, database=DEFAULT_DB_ALIAS, **kwargs):
         import frepple
 
-        if cls.filter:
-            filter_where = "where %s " % cls.filter
-        else:
-            filter_where = ""
-
-        with connections[database].chunked_cursor() as cursor:
-            cnt = 0
-            starttime = time()
-            cursor.execute(
-                """
-                SELECT
-                  name, description, owner_id, category, subcategory, source, available_id
-                FROM supplier %s
-                """
-                % filter_where
-            )
-            for i in cursor:
-                cnt += 1
-                try:
-                    x = frepple.supplier(
-                        name=i[0],
-                        description=i[1],
-                        category=i[3],
-                        subcategory=i[4],
-                        source=i[5],
-                    )
-                    if i[2]:
-                        x.owner = frepple.supplier(name=i[2])
-                    if i[6]:
-                        frepple.location(name=i[0]).available = frepple.calendar(
-                            name=i[6]
-                        )
-                except Exception as e:
-                    logger.error("**** %s ****" % e)
-            logger.info(
-                "Loaded %d suppliers in %.2f seconds" % (cnt, time() - starttime)
-            )
+        cnt = 0
+        starttime = time()
+        for i in cls.fetch(cls.getQueries()[0], database):
+            cnt += 1
+            try:
+                x = frepple.supplier(
+                    name=i[0],
+                    description=i[1],
+                    category=i[3],
+                    subcategory=i[4],
+                    source=i[5],
+                )
+                if i[2]:
+                    x.owner = frepple.supplier(name=i[2])
+                if i[6]:
+                    frepple.location(name=i[0]).available = frepple.calendar(name=i[6])
+            except Exception as e:
+                logger.error("**** %s ****" % e)
+        logger.info("Loaded %d suppliers in %.2f seconds" % (cnt, time() - starttime))
 
 
 @PlanTaskRegistry.register
@@ -1064,69 +1056,63 @@ class loadSetupMatrices(LoadTask):
     description = "Importing setup matrix rules"
     sequence = 102
 
+    @classmethod
+    def getQueries(cls, **kwargs):
+        return [
+            """
+            SELECT name, source
+            FROM setupmatrix %s
+            ORDER BY name
+            """
+            % cls.getFilter(),
+            """
+            SELECT
+              setupmatrix_id, priority, fromsetup, tosetup, duration,
+              cost, source, resource_id
+            FROM setuprule %s
+            ORDER BY setupmatrix_id, priority DESC
+            """
+            % cls.getFilter(),
+        ]
+
     @classmethod
     def run(cls, database=DEFAULT_DB_ALIAS, **kwargs):
         import frepple
 
-        if cls.filter:
-            filter_where = "where %s " % cls.filter
-        else:
-            filter_where = ""
-
-        with connections[database].chunked_cursor() as cursor:
-            cnt = 0
-            starttime = time()
-            cursor.execute(
-                """
-                SELECT name, source
-                FROM setupmatrix %s
-                ORDER BY name
-                """
-                % filter_where
-            )
-            for i in cursor:
-                cnt += 1
-                try:
-                    frepple.setupmatrix(name=i[0], source=i[1])
-                except Exception as e:
-                    logger.error("**** %s ****" % e)
-            logger.info(
-                "Loaded %d setup matrices in %.2f seconds" % (cnt, time() - starttime)
-            )
-
-        with connections[database].chunked_cursor() as cursor:
-            cnt = 0
-            starttime = time()
-            cursor.execute(
-                """
-                SELECT
-                  setupmatrix_id, priority, fromsetup, tosetup, duration,
-                  cost, source, resource_id
-                FROM setuprule %s
-                ORDER BY setupmatrix_id, priority DESC
-                """
-                % filter_where
-            )
-            for i in cursor:
-                cnt += 1
-                try:
-                    r = frepple.setupmatrixrule(
-                        setupmatrix=frepple.setupmatrix(name=i[0]),
-                        priority=i[1],
-                        fromsetup=i[2],
-                        tosetup=i[3],
-                        duration=i[4].total_seconds() if i[4] else 0,
-                        cost=i[5],
-                        source=i[6],
-                    )
-                    if i[7]:
-                        r.resource = frepple.resource(name=i[7])
-                except Exception as e:
-                    logger.error("**** %s ****" % e)
-            logger.info(
-                "Loaded %d setup matrix rules in %.2f seconds"
-                % (cnt, time() - starttime)
-            )
+        queries = cls.getQueries()
+        cnt = 0
+        starttime = time()
+        for i in cls.fetch(queries[0], database):
+            cnt += 1
+            try:
+                frepple.setupmatrix(name=i[0], source=i[1])
+            except Exception as e:
+                logger.error("**** %s ****" % e)
+        logger.info(
+            "Loaded %d setup matrices in %.2f seconds" % (cnt, time() - starttime)
+        )
+
+        cnt = 0
+        starttime = time()
+        for i in cls.fetch(queries[1], database):
+            cnt += 1
+            try:
+                r = frepple.setupmatrixrule(
+                    setupmatrix=frepple.setupmatrix(name=i[0]),
+                    priority=i[1],
+                    fromsetup=i[2],
+                    tosetup=i[3],
+                    duration=i[4].total_seconds() if i[4] else 0,
+                    cost=i[5],
+                    source=i[6],
+                )
+                if i[7]:
+                    r.resource = frepple.resource(name=i[7])
+            except Exception as e:
+                logger.error("**** %s ****" % e)
+        logger.info(
+            "Loaded %d setup matrix rules in %.2f seconds" % (cnt, time() - starttime)
+        )
 
 
 @PlanTaskRegistry.register
@@ -1244,45 +1230,42 @@ class loadResourceSkills(LoadTask):
     description = "Importing resources skills"
     sequence = 104
 
+    @classmethod
+    def getQueries(cls, **kwargs):
+        return [
+            """
+            SELECT
+              resource_id, skill_id, effective_start, effective_end, priority, source
+            FROM resourceskill %s
+            ORDER BY skill_id, priority, resource_id
+            """
+            % cls.getFilter()
+        ]
+
     @classmethod
     def run(cls, database=DEFAULT_DB_ALIAS, **kwargs):
         import frepple
 
-        if cls.filter:
-            filter_where = "where %s " % cls.filter
-        else:
-            filter_where = ""
-
-        with connections[database].chunked_cursor() as cursor:
-            cnt = 0
-            starttime = time()
-            cursor.execute(
-                """
-                SELECT
-                  resource_id, skill_id, effective_start, effective_end, priority, source
-                FROM resourceskill %s
-                ORDER BY skill_id, priority, resource_id
-                """
-                % filter_where
-            )
-            for i in cursor:
-                cnt += 1
-                try:
-                    cur = frepple.resourceskill(
-                        resource=frepple.resource(name=i[0]),
-                        skill=frepple.skill(name=i[1]),
-                        priority=i[4] or 1,
-                        source=i[5],
-                    )
-                    if i[2]:
-                        cur.effective_start = i[2]
-                    if i[3]:
-                        cur.effective_end = i[3]
-                except Exception as e:
-                    logger.error("**** %s ****" % e)
-            logger.info(
-                "Loaded %d resource skills in %.2f seconds" % (cnt, time() - starttime)
-            )
+        cnt = 0
+        starttime = time()
+        for i in cls.fetch(cls.getQueries()[0], database):
+            cnt += 1
+            try:
+                cur = frepple.resourceskill(
+                    resource=frepple.resource(name=i[0]),
+                    skill=frepple.skill(name=i[1]),
+                    priority=i[4] or 1,
+                    source=i[5],
+                )
+                if i[2]:
+                    cur.effective_start = i[2]
+                if i[3]:
+                    cur.effective_end = i[3]
+            except Exception as e:
+                logger.error("**** %s ****" % e)
+        logger.info(
+            "Loaded %d resource skills in %.2f seconds" % (cnt, time() - starttime)
+        )
 
 
 @PlanTaskRegistry.register
@@ -1508,6 +1491,347 @@ class loadOperationPlans(LoadTask):
     description = "Importing operationplans"
     sequence = 108
 
+    # Number of records read and processed together
+    batchsize = 1000
+
+    # Columns of a batch of operationplans
+    columns = (
+        "operation",
+        "reference",
+        "quantity",
+        "startdate",
+        "enddate",
+        "status",
+        "source",
+        "type",
+        "origin",
+        "destination",
+        "supplier",
+        "item",
+        "location",
+        "batch",
+        "demand",
+        "owner",
+    )
+
+    @staticmethod
+    def resolve(cache, constructor, names):
+        """
+        Returns the list of frePPLe objects for a list of names.
+        Every distinct name is looked up only once, and the result is
+        remembered in the cache dictionary for later batches.
+        A lookup that fails returns the exception, which the caller raises
+        when processing that record.
+        """
+        for n in set(names):
+            if n and n not in cache:
+                try:
+                    cache[n] = constructor(name=n)
+                except Exception as e:
+                    cache[n] = e
+        return [cache[n] if n else None for n in names]
+
+    @staticmethod
+    def checkResolved(*args):
+        for a in args:
+            if isinstance(a, Exception):
+                raise a
+
+    @classmethod
+    def loadBatch(
+        cls,
+        ordertype,
+        batch,
+        cache=None,
+        create=False,
+        consume_material=True,
+        consume_capacity=True,
+        consume_material_completed=True,
+    ):
+        """
+        Creates operationplans of a single type from a columnar batch.
+
+        The batch argument is a dictionary with a list of values for each of
+        the columns of this class. The names of the operations, locations, items,
+        suppliers and demands are resolved once per batch rather than once
+        per operationplan.
+        Returns the number of records processed.
+        """
+        import frepple
+
+        if cache is None:
+            cache = {}
+        for key in ("operation", "location", "item", "supplier", "demand"):
+            if key not in cache:
+                cache[key] = {}
+        count = len(batch["reference"])
+        demands = cls.resolve(
+            cache["demand"], frepple.demand, batch.get("demand", [None] * count)
+        )
+        owners = batch.get("owner", None)
+
+        if ordertype == "MO":
+            operations = cls.resolve(
+                cache["operation"], frepple.operation, batch["operation"]
+            )
+            for (
+                operation,
+                reference,
+                quantity,
+                startdate,
+                enddate,
+                status,
+                source,
+                btch,
+                dmd,
+                owner,
+            ) in zip(
+                operations,
+                batch["reference"],
+                batch["quantity"],
+                batch["startdate"],
+                batch["enddate"],
+                batch["status"],
+                batch["source"],
+                batch["batch"],
+                demands,
+                owners or [None] * count,
+            ):
+                try:
+                    cls.checkResolved(operation, dmd)
+                    if owner:
+                        opplan = frepple.operationplan(
+                            operation=operation,
+                            reference=reference,
+                            quantity=quantity,
+                            source=source,
+                            start=startdate,
+                            end=enddate,
+                            statusNoPropagation=status,
+                            batch=btch,
+                        )
+                    else:
+                        opplan = frepple.operationplan(
+                            operation=operation,
+                            reference=reference,
+                            quantity=quantity,
+                            source=source,
+                            start=startdate,
+                            end=enddate,
+                            statusNoPropagation=status,
+                            create=create,
+                            batch=btch,
+                        )
+                    if opplan:
+                        if status == "confirmed":
+                            if not consume_material:
+                                opplan.consume_material = False
+                            if not consume_capacity:
+                                opplan.consume_capacity = False
+                        elif status == "completed":
+                            if not consume_material_completed:
+                                opplan.consume_material = False
+                        if owner:
+                            try:
+                                opplan.owner = frepple.operationplan(reference=owner)
+                            except Exception:
+                                logger.error(
+                                    "Reference %s: Can't set owner field to %s"
+                                    % (reference, owner)
+                                )
+                        if dmd:
+                            opplan.demand = dmd
+                except Exception as e:
+                    logger.error("**** %s ****" % e)
+
+        elif ordertype == "PO":
+            locations = cls.resolve(
+                cache["location"], frepple.location, batch["location"]
+            )
+            items = cls.resolve(cache["item"], frepple.item, batch["item"])
+            suppliers = cls.resolve(
+                cache["supplier"], frepple.supplier, batch["supplier"]
+            )
+            for (
+                location,
+                item,
+                supplier,
+                reference,
+                quantity,
+                startdate,
+                enddate,
+                status,
+                source,
+                btch,
+                dmd,
+            ) in zip(
+                locations,
+                items,
+                suppliers,
+                batch["reference"],
+                batch["quantity"],
+                batch["startdate"],
+                batch["enddate"],
+                batch["status"],
+                batch["source"],
+                batch["batch"],
+                demands,
+            ):
+                try:
+                    cls.checkResolved(location, item, supplier, dmd)
+                    opplan = frepple.operationplan(
+                        location=location,
+                        ordertype=ordertype,
+                        reference=reference,
+                        item=item,
+                        supplier=supplier,
+                        quantity=quantity,
+                        start=startdate,
+                        end=enddate,
+                        statusNoPropagation=status,
+                        source=source,
+                        create=create,
+                        batch=btch,
+                    )
+                    if opplan and status == "confirmed":
+                        if not consume_capacity:
+                            opplan.consume_capacity = False
+                    if dmd and opplan:
+                        opplan.demand = dmd
+                except Exception as e:
+                    logger.error("**** %s ****" % e)
+
+        elif ordertype == "DO":
+            locations = cls.resolve(
+                cache["location"], frepple.location, batch["destination"]
+            )
+            items = cls.resolve(cache["item"], frepple.item, batch["item"])
+            origins = cls.resolve(cache["location"], frepple.location, batch["origin"])
+            for (
+                location,
+                item,
+                origin,
+                reference,
+                quantity,
+                startdate,
+                enddate,
+                status,
+                source,
+                btch,
+                dmd,
+            ) in zip(
+                locations,
+                items,
+                origins,
+                batch["reference"],
+                batch["quantity"],
+                batch["startdate"],
+                batch["enddate"],
+                batch["status"],
+                batch["source"],
+                batch["batch"],
+                demands,
+            ):
+                try:
+                    cls.checkResolved(location, item, origin, dmd)
+                    opplan = frepple.operationplan(
+                        location=location,
+                        reference=reference,
+                        ordertype=ordertype,
+                        item=item,
+                        origin=origin,
+                        quantity=quantity,
+                        start=startdate,
+                        end=enddate,
+                        statusNoPropagation=status,
+                        source=source,
+                        create=create,
+                        batch=btch,
+                    )
+                    if opplan:
+                        if status == "confirmed":
+                            if not consume_capacity:
+                                opplan.consume_capacity = False
+                        elif status == "completed":
+                            if not consume_material_completed:
+                                opplan.consume_material = False
+                    if dmd and opplan:
+                        opplan.demand = dmd
+                except Exception as e:
+                    logger.error("**** %s ****" % e)
+
+        elif ordertype == "DLVR":
+            locations = cls.resolve(
+                cache["location"], frepple.location, batch["location"]
+            )
+            items = cls.resolve(cache["item"], frepple.item, batch["item"])
+            origins = cls.resolve(cache["location"], frepple.location, batch["origin"])
+            for (
+                location,
+                item,
+                origin,
+                reference,
+                quantity,
+                startdate,
+                enddate,
+                status,
+                source,
+                btch,
+                dmd,
+            ) in zip(
+                locations,
+                items,
+                origins,
+                batch["reference"],
+                batch["quantity"],
+                batch["startdate"],
+                batch["enddate"],
+                batch["status"],
+                batch["source"],
+                batch["batch"],
+                demands,
+            ):
+                try:
+                    cls.checkResolved(location, item, origin, dmd)
+                    opplan = frepple.operationplan(
+                        location=location,
+                        reference=reference,
+                        ordertype=ordertype,
+                        item=item,
+                        origin=origin,
+                        demand=dmd,
+                        quantity=quantity,
+                        start=startdate,
+                        end=enddate,
+                        statusNoPropagation=status,
+                        source=source,
+                        create=create,
+                        batch=btch,
+                    )
+                    if opplan and status == "confirmed":
+                        if not consume_capacity:
+                            opplan.consume_capacity = False
+                except Exception as e:
+                    logger.error("**** %s ****" % e)
+
+        else:
+            logger.warning("Warning: unhandled operationplan type '%s'" % ordertype)
+            return 0
+        return count
+
+    @classmethod
+    def splitBatch(cls, rows):
+        """
+        Converts a list of records into a columnar batch per operationplan type.
+        """
+        rows_per_type = {}
+        for r in rows:
+            rows_per_type.setdefault(r[7], []).append(r)
+        return {
+            ordertype: dict(zip(cls.columns, zip(*typerows)))
+            for ordertype, typerows in rows_per_type.items()
+        }
+
     @classmethod
     def run(cls, database=DEFAULT_DB_ALIAS, **kwargs):
         import frepple
@@ -1517,32 +1841,30 @@ class loadOperationPlans(LoadTask):
         else:
             filter_and = ""
 
-        with connections[database].chunked_cursor() as cursor:
-            consume_material = (
-                Parameter.getValue("WIP.consume_material", database, "true").lower()
-                == "true"
+        consume_material = (
+            Parameter.getValue("WIP.consume_material", database, "true").lower()
+            == "true"
+        )
+        consume_capacity = (
+            Parameter.getValue("WIP.consume_capacity", database, "true").lower()
+            == "true"
+        )
+        consume_material_completed = (
+            Parameter.getValue("COMPLETED.consume_material", database, "true").lower()
+            == "true"
+        )
+        if "supply" in os.environ:
+            confirmed_filter = (
+                " and operationplan.status in ('confirmed', 'approved', 'completed')"
             )
-            consume_capacity = (
-                Parameter.getValue("WIP.consume_capacity", database, "true").lower()
-                == "true"
-            )
-            consume_material_completed = (
-                Parameter.getValue(
-                    "COMPLETED.consume_material", database, "true"
-                ).lower()
-                == "true"
-            )
-            if "supply" in os.environ:
-                confirmed_filter = " and operationplan.status in ('confirmed', 'approved', 'completed')"
-                create_flag = True
-            else:
-                confirmed_filter = ""
-                create_flag = False
-            cnt_mo = 0
-            cnt_po = 0
-            cnt_do = 0
-            cnt_dlvr = 0
-            starttime = time()
+            create_flag = True
+        else:
+            confirmed_filter = ""
+            create_flag = False
+        cnt = {"MO": 0, "PO": 0, "DO": 0, "DLVR": 0}
+        cache = {}
+        starttime = time()
+        with connections[database].chunked_cursor() as cursor:
             cursor.execute(
                 """
                 SELECT
@@ -1550,7 +1872,7 @@ class loadOperationPlans(LoadTask):
                   operationplan.startdate, operationplan.enddate, operationplan.status, operationplan.source,
                   operationplan.type, operationplan.origin_id, operationplan.destination_id, operationplan.supplier_id,
                   operationplan.item_id, operationplan.location_id, operationplan.batch,
-                  coalesce(dmd.name, null)
+                  coalesce(dmd.name, null), null
                 FROM operationplan
                 LEFT OUTER JOIN (select name from demand
                   where demand.status is null or demand.status in ('open', 'quote')
@@ -1565,117 +1887,28 @@ class loadOperationPlans(LoadTask):
                 """
                 % (filter_and, confirmed_filter)
             )
-            for i in cursor:
-                try:
-                    if i[14]:
-                        dmd = frepple.demand(name=i[14])
-                    else:
-                        dmd = None
-                    if i[7] == "MO":
-                        cnt_mo += 1
-                        opplan = frepple.operationplan(
-                            operation=frepple.operation(name=i[0]),
-                            reference=i[1],
-                            quantity=i[2],
-                            source=i[6],
-                            start=i[3],
-                            end=i[4],
-                            statusNoPropagation=i[5],
-                            create=create_flag,
-                            batch=i[13],
-                        )
-                        if opplan:
-                            if i[5] == "confirmed":
-                                if not consume_material:
-                                    opplan.consume_material = False
-                                if not consume_capacity:
-                                    opplan.consume_capacity = False
-                            elif i[5] == "completed":
-                                if not consume_material_completed:
-                                    opplan.consume_material = False
-                    elif i[7] == "PO":
-                        cnt_po += 1
-                        opplan = frepple.operationplan(
-                            location=frepple.location(name=i[12]),
-                            ordertype=i[7],
-                            reference=i[1],
-                            item=frepple.item(name=i[11]) if i[11] else None,
-                            supplier=frepple.supplier(name=i[10]) if i[10] else None,
-                            quantity=i[2],
-                            start=i[3],
-                            end=i[4],
-                            statusNoPropagation=i[5],
-                            source=i[6],
-                            create=create_flag,
-                            batch=i[13],
-                        )
-                        if opplan and i[5] == "confirmed":
-                            if not consume_capacity:
-                                opplan.consume_capacity = False
-                    elif i[7] == "DO":
-                        cnt_do += 1
-                        opplan = frepple.operationplan(
-                            location=frepple.location(name=i[9]) if i[9] else None,
-                            reference=i[1],
-                            ordertype=i[7],
-                            item=frepple.item(name=i[11]) if i[11] else None,
-                            origin=frepple.location(name=i[8]) if i[8] else None,
-                            quantity=i[2],
-                            start=i[3],
-                            end=i[4],
-                            statusNoPropagation=i[5],
-                            source=i[6],
-                            create=create_flag,
-                            batch=i[13],
-                        )
-                        if opplan:
-                            if i[5] == "confirmed":
-                                if not consume_capacity:
-                                    opplan.consume_capacity = False
-                            elif i[5] == "completed":
-                                if not consume_material_completed:
-                                    opplan.consume_material = False
-                    elif i[7] == "DLVR":
-                        cnt_dlvr += 1
-                        opplan = frepple.operationplan(
-                            location=frepple.location(name=i[12]) if i[12] else None,
-                            reference=i[1],
-                            ordertype=i[7],
-                            item=frepple.item(name=i[11]) if i[11] else None,
-                            origin=frepple.location(name=i[8]) if i[8] else None,
-                            demand=dmd,
-                            quantity=i[2],
-                            start=i[3],
-                            end=i[4],
-                            statusNoPropagation=i[5],
-                            source=i[6],
-                            create=create_flag,
-                            batch=i[13],
-                        )
-                        if opplan and i[5] == "confirmed":
-                            if not consume_capacity:
-                                opplan.consume_capacity = False
-                            elif i[5] == "completed":
-                                if not consume_material_completed:
-                                    opplan.consume_material = False
-                        opplan = None
-                    else:
-                        logger.warning(
-                            "Warning: unhandled operationplan type '%s'" % i[7]
-                        )
-                        continue
-                    if dmd and opplan:
-                        opplan.demand = dmd
-                except Exception as e:
-                    logger.error("**** %s ****" % e)
+            while True:
+                rows = cursor.fetchmany(cls.batchsize)
+                if not rows:
+                    break
+                for ordertype, batch in cls.splitBatch(rows).items():
+                    cnt[ordertype] = cnt.get(ordertype, 0) + cls.loadBatch(
+                        ordertype,
+                        batch,
+                        cache=cache,
+                        create=create_flag,
+                        consume_material=consume_material,
+                        consume_capacity=consume_capacity,
+                        consume_material_completed=consume_material_completed,
+                    )
         with connections[database].chunked_cursor() as cursor:
             cursor.execute(
                 """
                 SELECT
                   operationplan.operation_id, operationplan.reference, operationplan.quantity,
                   operationplan.startdate, operationplan.enddate, operationplan.status,
-                  operationplan.owner_id, operationplan.source, operationplan.batch,
-                  coalesce(dmd.name, null)
+                  operationplan.source, operationplan.type, null, null, null, null, null,
+                  operationplan.batch, coalesce(dmd.name, null), operationplan.owner_id
                 FROM operationplan
                 INNER JOIN (select reference
                   from operationplan
@@ -1693,44 +1926,22 @@ class loadOperationPlans(LoadTask):
                 """
                 % (filter_and, confirmed_filter)
             )
-            for i in cursor:
-                try:
-                    cnt_mo += 1
-                    opplan = frepple.operationplan(
-                        operation=frepple.operation(name=i[0]),
-                        reference=i[1],
-                        quantity=i[2],
-                        source=i[7],
-                        start=i[3],
-                        end=i[4],
-                        statusNoPropagation=i[5],
-                        batch=i[8],
-                    )
-                    if opplan:
-                        if i[5] == "confirmed":
-                            if not consume_material:
-                                opplan.consume_material = False
-                            if not consume_capacity:
-                                opplan.consume_capacity = False
-                        elif i[5] == "completed":
-                            if not consume_material_completed:
-                                opplan.consume_material = False
-                        if i[6]:
-                            try:
-                                opplan.owner = frepple.operationplan(reference=i[6])
-                            except Exception:
-                                logger.error(
-                                    "Reference %s: Can't set owner field to %s"
-                                    % (i[1], i[6])
-                                )
-                        if i[9]:
-                            opplan.demand = frepple.demand(name=i[9])
-                except Exception as e:
-                    logger.error("**** %s ****" % e)
-            logger.info(
-                "Loaded %d manufacturing orders, %d purchase orders, %d distribution orders and %s deliveries in %.2f seconds"
-                % (cnt_mo, cnt_po, cnt_do, cnt_dlvr, time() - starttime)
-            )
+            while True:
+                rows = cursor.fetchmany(cls.batchsize)
+                if not rows:
+                    break
+                cnt["MO"] += cls.loadBatch(
+                    "MO",
+                    dict(zip(cls.columns, zip(*rows))),
+                    cache=cache,
+                    consume_material=consume_material,
+                    consume_capacity=consume_capacity,
+                    consume_material_completed=consume_material_completed,
+                )
+        logger.info(
+            "Loaded %d manufacturing orders, %d purchase orders, %d distribution orders and %s deliveries in %.2f seconds"
+            % (cnt["MO"], cnt["PO"], cnt["DO"], cnt["DLVR"], time() - starttime)
+        )
 
         with connections[database].cursor() as cursor:
             # Assure the operationplan ids will be unique.
@@ -16,11 +16,12 @@
 #
 
 import ast
+from contextlib import contextmanager
 from datetime import datetime, time
-from decimal import Decimal
+from threading import local
 
 from django.core.cache import cache
-from django.db import models, DEFAULT_DB_ALIAS
+from django.db import models, connections, transaction, DEFAULT_DB_ALIAS
 from django.db.models.fields.related import RelatedField
 from django.forms.models import modelform_factory
 from django import forms
@@ -1683,176 +1684,381 @@ class OperationPlan(AuditModel):
     def __str__(self):
         return str(self.reference)
 
-    def propagateStatus(self):
-        if self.type == "STCK":
-            return
-        state = getattr(self, "_state", None)
-        db = state.db if state else DEFAULT_DB_ALIAS
+    # Operationplans saved in a deferPropagation block, per thread and database
+    _pendingPropagation = local()
 
-        # Get the parameter that controls whether completed operations are
-        # allowed to have dates in the future
-        completed_allow_future = cache.get("completed_allow_future_%s" % db, None)
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Remember the status and owner in the database, to detect changes
+        if "status" in field_names and "owner_id" in field_names:
+            instance._loadedStatus = (instance.status, instance.owner_id)
+        return instance
+
+    @staticmethod
+    def completedAllowFuture(database=DEFAULT_DB_ALIAS):
+        """
+        Returns the parameter that controls whether completed operations are
+        allowed to have dates in the future.
+        """
+        completed_allow_future = cache.get("completed_allow_future_%s" % database, None)
         if completed_allow_future is None:
             completed_allow_future = (
-                Parameter.getValue("COMPLETED.allow_future", db, "false").lower()
+                Parameter.getValue("COMPLETED.allow_future", database, "false").lower()
                 == "true"
             )
             cache.set(
-                "completed_allow_future_%s" % db, completed_allow_future, timeout=60
+                "completed_allow_future_%s" % database,
+                completed_allow_future,
+                timeout=60,
             )
+        return completed_allow_future
 
-        # Assure that all child operationplans also get the same status
+    @classmethod
+    @contextmanager
+    def deferPropagation(cls, database=DEFAULT_DB_ALIAS, pending=None):
+        """
+        Context manager to propagate the status of all operationplans saved
+        in its scope at once, when leaving it.
+        When a set is passed as argument, the references of the saved
+        operationplans are added to it, and the caller needs to call
+        propagateStatusBulk for them.
+        """
+        if getattr(cls._pendingPropagation, database, None) is not None:
+            # Nested block
+            yield
+            return
+        references = set() if pending is None else pending
+        setattr(cls._pendingPropagation, database, references)
+        try:
+            yield
+        finally:
+            delattr(cls._pendingPropagation, database)
+        if pending is None and references:
+            OperationPlan.propagateStatusBulk(references, database)
+
+    @staticmethod
+    def propagateStatusBulk(references, database=DEFAULT_DB_ALIAS):
+        """
+        Propagates the status of a set of operationplans, as stored in the
+        database, to the related operationplans:
+          - Child operationplans get the same status as their parent.
+          - When a routing step is completed or closed, the previous steps
+            get the same status and the routing is at least approved.
+          - Completed and closed operationplans no longer load resources,
+            and their dates are moved to the past.
+          - When the completed and closed operationplans consume more than
+            the completed and closed supply in a buffer, supply is closed as
+            well. Confirmed supply is picked first, then approved and finally
+            proposed supply.
+        Every round executes a few statements for the complete set, and the
+        operationplans changed in a round are processed in the next one.
+        The bucket summaries of the buffers of all affected operationplans
+        are marked for refresh.
+        """
+        from freppledb.output.models import BufferBucketRefresh
+
+        clamp = not OperationPlan.completedAllowFuture(database)
         now = datetime.now()
-        if self.type not in ("DO", "PO"):
-            for subop in self.xchildren.all().using(db):
-                if subop.status != self.status:
-                    subop.status = self.status
-                    subop.save(update_fields=["status"])
+        todo = set(references)
+        # Routings changed in a round don't push their status to their steps
+        nochildren = set()
+        # Operationplans changed in any round
+        affected = set()
+        with transaction.atomic(using=database):
+            with connections[database].cursor() as cursor:
+                while todo:
+                    changed = set()
+                    changed_routing = set()
+
+                    # Assure that all child operationplans get the same status
+                    cursor.execute(
+                        """
+                        with recursive children as (
+                          select reference, status
+                          from operationplan
+                          where reference = any(%s)
+                          and type not in ('DO', 'PO', 'STCK')
+                          union all
+                          select operationplan.reference, children.status
+                          from operationplan
+                          inner join children
+                            on operationplan.owner_id = children.reference
+                          )
+                        update operationplan
+                        set status = children.status
+                        from children
+                        where operationplan.reference = children.reference
+                        and operationplan.status is distinct from children.status
+                        returning operationplan.reference
+                        """,
+                        (list(todo - nochildren),),
+                    )
+                    changed.update(i[0] for i in cursor.fetchall())
+
+                    cursor.execute(
+                        """
+                        select reference from operationplan
+                        where reference = any(%s)
+                        and type <> 'STCK' and status in ('completed', 'closed')
+                        """,
+                        (list(todo),),
+                    )
+                    done = [i[0] for i in cursor.fetchall()]
+                    if not done:
+                        affected.update(changed)
+                        todo = changed
+                        nochildren = set()
+                        continue
+
+                    # Assure the start, end and material flows are in the past.
+                    # We are not correcting the expected onhand. The next plan
+                    # generation will do that.
+                    if clamp:
+                        cursor.execute(
+                            """
+                            update operationplan
+                            set startdate = least(startdate, %s),
+                              enddate = least(enddate, %s)
+                            where reference = any(%s)
+                            and (startdate > %s or enddate > %s)
+                            """,
+                            (now, now, done, now, now),
+                        )
+                        cursor.execute(
+                            """
+                            update operationplanmaterial
+                            set flowdate = %s
+                            where operationplan_id = any(%s) and flowdate > %s
+                            """,
+                            (now, done, now),
+                        )
 
-        if self.status not in ("completed", "closed"):
-            return
+                    # Remove all capacity consumption of closed and completed
+                    cursor.execute(
+                        "delete from operationplanresource where operationplan_id = any(%s)",
+                        (done,),
+                    )
+
+                    # Assure that previous routing steps are also completed or
+                    # closed. A step gets the status of the first later step
+                    # in the set.
+                    cursor.execute(
+                        """
+                        with steps as (
+                          select
+                            op.owner_id, op.status, routing.name as routing,
+                            coalesce(operation.priority, 0) as priority
+                          from operationplan as op
+                          inner join operationplan as parent
+                            on parent.reference = op.owner_id
+                          inner join operation as routing
+                            on routing.name = parent.operation_id
+                            and routing.type = 'routing'
+                          left outer join operation
+                            on operation.name = op.operation_id
+                            and operation.owner_id = routing.name
+                          where op.reference = any(%s) and op.type = 'MO'
+                          ),
+                        previous as (
+                          select distinct on (sibling.reference)
+                            sibling.reference, steps.status
+                          from steps
+                          inner join operationplan as sibling
+                            on sibling.owner_id = steps.owner_id
+                          left outer join operation
+                            on operation.name = sibling.operation_id
+                            and operation.owner_id = steps.routing
+                          where coalesce(operation.priority, 0) < steps.priority
+                          order by sibling.reference, steps.priority
+                          )
+                        update operationplan
+                        set status = previous.status,
+                          startdate = case
+                            when %s and startdate > %s then %s else startdate
+                            end,
+                          enddate = case
+                            when %s and enddate > %s then %s else enddate
+                            end
+                        from previous
+                        where operationplan.reference = previous.reference
+                        and operationplan.status is distinct from previous.status
+                        returning operationplan.reference
+                        """,
+                        (done, clamp, now, now, clamp, now, now),
+                    )
+                    changed.update(i[0] for i in cursor.fetchall())
+
+                    # Assure that the routing is at least approved, and
+                    # completed or closed when all its steps are.
+                    cursor.execute(
+                        """
+                        with routings as (
+                          select distinct parent.reference, parent.status,
+                            parent.operation_id
+                          from operationplan as op
+                          inner join operationplan as parent
+                            on parent.reference = op.owner_id
+                          inner join operation as routing
+                            on routing.name = parent.operation_id
+                            and routing.type = 'routing'
+                          where op.reference = any(%s) and op.type = 'MO'
+                          ),
+                        summary as (
+                          select
+                            routings.reference,
+                            case
+                              when count(*) = (
+                                select count(*) from operation
+                                where operation.owner_id = routings.operation_id
+                                )
+                                and bool_and(step.status = 'closed')
+                                then 'closed'
+                              when count(*) = (
+                                select count(*) from operation
+                                where operation.owner_id = routings.operation_id
+                                )
+                                and bool_and(step.status in ('closed', 'completed'))
+                                then 'completed'
+                              when routings.status = 'proposed' then 'approved'
+                              else routings.status
+                            end as status
+                          from routings
+                          inner join operationplan as step
+                            on step.owner_id = routings.reference
+                          group by
+                            routings.reference, routings.status, routings.operation_id
+                          )
+                        update operationplan
+                        set status = summary.status,
+                          startdate = case
+                            when %s and startdate > %s then %s else startdate
+                            end
+                        from summary
+                        where operationplan.reference = summary.reference
+                        and operationplan.status is distinct from summary.status
+                        returning operationplan.reference
+                        """,
+                        (done, clamp, now, now),
+                    )
+                    changed_routing.update(i[0] for i in cursor.fetchall())
+
+                    # Check that upstream buffers have enough supply in the
+                    # completed or closed status. If not, we close some
+                    # upstream supply to make things match up.
+                    cursor.execute(
+                        """
+                        with buffers as (
+                          select
+                            opm.item_id, opm.location_id,
+                            case
+                              when bool_and(operationplan.status = 'closed')
+                              then 'closed' else 'completed'
+                            end as status
+                          from operationplanmaterial as opm
+                          inner join operationplan
+                            on operationplan.reference = opm.operationplan_id
+                          where opm.operationplan_id = any(%s) and opm.quantity < 0
+                          group by opm.item_id, opm.location_id
+                          ),
+                        balance as (
+                          -- Leaving some room for rounding errors
+                          select
+                            buffers.item_id, buffers.location_id, buffers.status,
+                            0.00001 + coalesce(sum(opm.quantity) filter (
+                              where operationplan.type = 'STCK'
+                              or operationplan.status in ('completed', 'closed')
+                              ), 0) as closed_balance
+                          from buffers
+                          inner join operationplanmaterial as opm
+                            on opm.item_id = buffers.item_id
+                            and opm.location_id = buffers.location_id
+                          inner join operationplan
+                            on operationplan.reference = opm.operationplan_id
+                          group by buffers.item_id, buffers.location_id, buffers.status
+                          ),
+                        supply as (
+                          select
+                            opm.operationplan_id, balance.status,
+                            balance.closed_balance + coalesce(sum(opm.quantity) over (
+                              partition by opm.item_id, opm.location_id
+                              order by
+                                case operationplan.status
+                                  when 'confirmed' then 1
+                                  when 'approved' then 2
+                                  else 3
+                                end,
+                                opm.flowdate, opm.quantity desc, opm.id
+                              rows between unbounded preceding and 1 preceding
+                              ), 0) as shortage
+                          from balance
+                          inner join operationplanmaterial as opm
+                            on opm.item_id = balance.item_id
+                            and opm.location_id = balance.location_id
+                            and opm.quantity > 0
+                          inner join operationplan
+                            on operationplan.reference = opm.operationplan_id
+                            and operationplan.type <> 'STCK'
+                            and operationplan.status in ('confirmed', 'approved', 'proposed')
+                          where balance.closed_balance < 0
+                          ),
+                        closing as (
+                          select distinct on (operationplan_id) operationplan_id, status
+                          from supply
+                          where shortage < 0
+                          order by operationplan_id, status
+                          )
+                        update operationplan
+                        set status = closing.status
+                        from closing
+                        where operationplan.reference = closing.operationplan_id
+                        returning operationplan.reference
+                        """,
+                        (done,),
+                    )
+                    changed.update(i[0] for i in cursor.fetchall())
+
+                    affected.update(done, changed, changed_routing)
+                    todo = changed | changed_routing
+                    nochildren = changed_routing - changed
+
+            if affected:
+                BufferBucketRefresh.markOperationPlans(affected, database)
 
-        # Assure the start and end are in the past
-        if not completed_allow_future:
-            if self.enddate > now:
+    def save(self, *args, **kwargs):
+        db = kwargs.get("using", None) or self._state.db or DEFAULT_DB_ALIAS
+        if (
+            self.type != "STCK"
+            and self.status in ("completed", "closed")
+            and not self.completedAllowFuture(db)
+        ):
+            # Assure the start and end are in the past
+            now = datetime.now()
+            if self.enddate and self.enddate > now:
                 self.enddate = now
-            if self.startdate > now:
+            if self.startdate and self.startdate > now:
                 self.startdate = now
-
-        if self.type == "MO" and self.owner and self.owner.operation.type == "routing":
-            # Assure that previous routing steps are also marked closed or completed
-            subopplans = [i for i in self.owner.xchildren.all().using(db)]
-            for subop in subopplans:
-                if subop.reference == self.reference:
-                    subop.status = self.status
-            steps = {
-                z: z.priority
-                for z in self.owner.operation.childoperations.all()
-                .using(db)
-                .only("name", "priority")
-            }
-            myprio = steps.get(self.operation, 0)
-            for subop in subopplans:
-                if (
-                    subop.status != self.status
-                    and steps.get(subop.operation, 0) < myprio
-                ):
-                    subop.status = self.status
-                    if not completed_allow_future:
-                        if subop.enddate > now:
-                            subop.enddate = now
-                        if subop.startdate > now:
-                            subop.startdate = now
-                    subop.save(update_fields=["status", "startdate", "enddate"])
-
-            # Assure that the parent is at least approved
-            if len(steps) == len(subopplans):
-                all_steps_completed = all_steps_closed = True
-            else:
-                # We know there are will be some proposed steps
-                all_steps_completed = all_steps_closed = False
-            for subop in subopplans:
-                if subop.status not in ("closed", "completed"):
-                    all_steps_completed = False
-                if subop.status != "closed":
-                    all_steps_closed = False
-            if all_steps_closed and self.owner.status != "closed":
-                self.owner.status = "closed"
-                if not completed_allow_future:
-                    if self.owner.enddate > now:
-                        self.owner.enddate = now
-                    if self.owner.startdate > now:
-                        self.owner.startdate = now
-                self.owner.save(
-                    update_fields=["status", "startdate", "enddate"], using=db
-                )
-            elif all_steps_completed and self.owner.status != "completed":
-                self.owner.status = "completed"
-                if not completed_allow_future:
-                    if self.owner.enddate > now:
-                        self.owner.enddate = now
-                    if self.owner.startdate > now:
-                        self.owner.startdate = now
-                self.owner.save(
-                    update_fields=["status", "startdate", "enddate"], using=db
-                )
-            elif self.owner.status == "proposed":
-                self.owner.status = "approved"
-                if not completed_allow_future and self.owner.startdate > now:
-                    self.owner.startdate = now
-                self.owner.save(update_fields=["status", "startdate"], using=db)
-
-        # Remove all capacity consumption of closed and completed
-        self.resources.all().using(db).delete()
-
-        for opplanmat in self.materials.all().using(db):
-            # Assure the material production and consumption are in the past
-            # We are not correcting the expected onhand. The next plan generation will do that.
-            if not completed_allow_future and opplanmat.flowdate > now:
-                opplanmat.flowdate = now
-                opplanmat.save(using=db)
-            # Check that upstream buffers have enough supply in the closed status
-            if opplanmat.quantity < 0:
-                # check the inventory + consumed
-                flplns = [
-                    i
-                    for i in OperationPlanMaterial.objects.all()
-                    .using(db)
-                    .filter(item=opplanmat.item.name, location=opplanmat.location.name)
-                    .order_by("flowdate", "-quantity")
-                    .select_related("operationplan")
-                ]
-                closed_balance = Decimal(
-                    0.00001
-                )  # Leaving some room for rounding errors
-                for f in flplns:
-                    if (
-                        f.operationplan.type == "STCK"
-                        or f.operationplan.status in ["closed", "completed"]
-                        or f.operationplan.reference == self.reference
-                    ):
-                        closed_balance += f.quantity
-                if closed_balance < 0:
-                    # Things don't add up here.
-                    # We'll close some upstream supply to make things match up
-                    # First, try changing the status of confirmed supply
-                    for f in flplns:
-                        if (
-                            f.quantity > 0
-                            and f.operationplan.status == "confirmed"
-                            and f.operationplan.type != "STCK"
-                        ):
-                            f.operationplan.status = self.status
-                            f.operationplan.save(update_fields=["status"])
-                            closed_balance += f.quantity
-                            if closed_balance >= 0:
-                                break
-                    if closed_balance < 0:
-                        # Second, try changing the status of approved supply
-                        for f in flplns:
-                            if f.quantity > 0 and f.operationplan.status == "approved":
-                                f.operationplan.status = self.status
-                                f.operationplan.save(update_fields=["status"])
-                                closed_balance += f.quantity
-                                if closed_balance >= 0:
-                                    break
-                        if closed_balance < 0:
-                            # Finally, try changing the status of proposed supply
-                            for f in flplns:
-                                if (
-                                    f.quantity > 0
-                                    and f.operationplan.status == "proposed"
-                                ):
-                                    f.operationplan.status = self.status
-                                    f.operationplan.save(update_fields=["status"])
-                                    closed_balance += f.quantity
-                                    if closed_balance >= 0:
-                                        break
-
-    def save(self, *args, **kwargs):
-        self.propagateStatus()
+        # The related operationplans only need an update when the status or
+        # the owner changed
+        update_fields = kwargs.get("update_fields", None)
+        if update_fields is not None:
+            propagate = bool(
+                {"status", "owner", "owner_id"}.intersection(update_fields)
+            )
+        else:
+            propagate = getattr(self, "_loadedStatus", None) != (
+                self.status,
+                self.owner_id,
+            )
         # Call the real save() method
         super().save(*args, **kwargs)
+        self._loadedStatus = (self.status, self.owner_id)
+        if self.type != "STCK" and propagate:
+            pending = getattr(self._pendingPropagation, db, None)
+            if pending is None:
+                self.propagateStatusBulk([self.reference], db)
+            else:
+                pending.add(self.reference)
 
     @classmethod
     def getDeleteStatements(cls):
@@ -15,14 +15,22 @@
 # License along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 
+from datetime import datetime
+import json
+import logging
 import os
 from rest_framework.test import APIClient, APITestCase, APIRequestFactory
 import tempfile
 
+from django.contrib.admin.models import LogEntry
+from django.contrib.contenttypes.models import ContentType
 from django.core import management
+from django.db import connection
 from django.http.response import StreamingHttpResponse
 from django.test import TestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext
 
+from freppledb.common.dataload import parseCSVdata
 from freppledb.common.models import User, Bucket, BucketDetail, Parameter
 from freppledb.common.tests import checkResponse
 from freppledb.input.models import (
@@ -39,6 +47,7 @@ from freppledb.input.models import (
     ManufacturingOrder,
     Operation,
     OperationMaterial,
+    OperationPlan,
     OperationPlanMaterial,
     OperationPlanResource,
     OperationResource,
@@ -50,6 +59,7 @@ from freppledb.input.models import (
     SubOperation,
     Supplier,
 )
+from freppledb.output.models import BufferBucketRefresh
 
 
 class DataLoadTest(TestCase):
@@ -194,6 +204,469 @@ class DataLoadTest(TestCase):
             1,
         )
 
+    def test_operationplan_detail(self):
+        # Add extra purchase orders to the demo data
+        po = PurchaseOrder.objects.all().order_by("reference")[0]
+        PurchaseOrder.objects.bulk_create(
+            [
+                PurchaseOrder(
+                    reference="detail PO %s" % i,
+                    type="PO",
+                    item=po.item,
+                    location=po.location,
+                    supplier=po.supplier,
+                    quantity=i + 1,
+                    startdate=po.startdate,
+                    enddate=po.enddate,
+                    status="proposed",
+                )
+                for i in range(20)
+            ]
+        )
+        references = list(
+            PurchaseOrder.objects.all()
+            .order_by("reference")
+            .values_list("reference", flat=True)
+        )
+
+        # The number of queries is independent of the number of operationplans.
+        # The first request fills the caches of the process, and isn't counted.
+        queries = []
+        for refs in (references[1:2], references[:1], references):
+            with CaptureQueriesContext(connection) as ctx:
+                response = self.client.get(
+                    "/input/operationplan/",
+                    {"reference": refs},
+                    HTTP_X_REQUESTED_WITH="XMLHttpRequest",
+                )
+                self.assertEqual(response.status_code, 200)
+                data = json.loads(b"".join(response.streaming_content).decode("utf-8"))
+            self.assertEqual(sorted(i["reference"] for i in data), sorted(refs))
+            queries.append(len(ctx.captured_queries))
+        self.assertEqual(queries[1], queries[2])
+
+    def test_json_upload(self):
+        # Edit records, including a missing record and an invalid value
+        response = self.client.post(
+            "/data/input/calendar/",
+            json.dumps(
+                [
+                    {"id": "pack capacity factory 1", "description": "edited 1"},
+                    {"id": "pack capacity factory 2", "description": "edited 2"},
+                    {"id": "unknown calendar", "description": "edited 3"},
+                    {"id": "weave capacity factory 1", "defaultvalue": "abc"},
+                ]
+            ),
+            content_type="application/json",
+        )
+        self.assertEqual(response.status_code, 500)
+        self.assertContains(response, "unknown calendar", status_code=500)
+        self.assertContains(response, "defaultvalue", status_code=500)
+        self.assertEqual(
+            Calendar.objects.filter(description__startswith="edited").count(), 2
+        )
+
+        # Copy records
+        response = self.client.post(
+            "/data/input/calendar/",
+            json.dumps(
+                [{"copy": ["pack capacity factory 1", "pack capacity factory 2"]}]
+            ),
+            content_type="application/json",
+        )
+        checkResponse(self, response)
+        self.assertEqual(
+            Calendar.objects.filter(name__startswith="Copy of ").count(), 2
+        )
+
+        # Delete records
+        response = self.client.post(
+            "/data/input/calendar/",
+            json.dumps(
+                [
+                    {
+                        "delete": [
+                            "Copy of pack capacity factory 1",
+                            "Copy of pack capacity factory 2",
+                        ]
+                    }
+                ]
+            ),
+            content_type="application/json",
+        )
+        checkResponse(self, response)
+        self.assertEqual(
+            Calendar.objects.filter(name__startswith="Copy of ").count(), 0
+        )
+
+        # All successful changes are logged
+        self.assertEqual(
+            LogEntry.objects.filter(
+                content_type=ContentType.objects.get_for_model(Calendar)
+            ).count(),
+            6,
+        )
+
+
+class BulkUploadTest(TestCase):
+    """
+    Uploads of models without custom save logic are saved in batches.
+    """
+
+    fixtures = ["demo"]
+
+    def upload(self, model, rows):
+        errors = {}
+        for msg in parseCSVdata(model, rows):
+            if msg[0] == logging.ERROR:
+                errors.setdefault(msg[1], []).append(msg[2])
+        return errors
+
+    def test_bulk_upload(self):
+        # New and updated records
+        errors = self.upload(
+            Calendar,
+            [
+                ["name", "description", "defaultvalue"],
+                ["new calendar 1", "new 1", "1"],
+                ["new calendar 2", "new 2", "2"],
+                ["pack capacity factory 1", "updated", "5"],
+            ],
+        )
+        self.assertEqual(errors, {})
+        self.assertEqual(Calendar.objects.get(name="new calendar 2").defaultvalue, 2)
+        cal = Calendar.objects.get(name="pack capacity factory 1")
+        self.assertEqual((cal.description, cal.defaultvalue), ("updated", 5))
+
+        # Only the fields in the header are updated
+        errors = self.upload(
+            Calendar,
+            [["name", "description"], ["pack capacity factory 1", "partial"]],
+        )
+        self.assertEqual(errors, {})
+        cal = Calendar.objects.get(name="pack capacity factory 1")
+        self.assertEqual((cal.description, cal.defaultvalue), ("partial", 5))
+
+        # A missing foreign key is reported on its row
+        errors = self.upload(
+            CalendarBucket,
+            [
+                ["calendar", "startdate", "enddate", "priority", "value"],
+                ["new calendar 1", "2020-01-01", "2021-01-01", "1", "10"],
+                ["unknown calendar", "2020-01-01", "2021-01-01", "1", "10"],
+                ["new calendar 2", "2020-01-01", "2021-01-01", "1", "20"],
+            ],
+        )
+        self.assertEqual(errors, {3: ["calendar"]})
+        self.assertEqual(
+            CalendarBucket.objects.filter(
+                calendar__name__startswith="new calendar"
+            ).count(),
+            2,
+        )
+
+        # A database constraint failing halfway the batch only rejects its row
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "alter table calendar add constraint calendar_test "
+                "check (defaultvalue is distinct from 13)"
+            )
+        errors = self.upload(
+            Calendar,
+            [
+                ["name", "defaultvalue"],
+                ["new calendar 3", "3"],
+                ["new calendar 4", "13"],
+                ["new calendar 1", "11"],
+            ],
+        )
+        self.assertEqual(list(errors.keys()), [3])
+        self.assertTrue(Calendar.objects.filter(name="new calendar 3").exists())
+        self.assertFalse(Calendar.objects.filter(name="new calendar 4").exists())
+        self.assertEqual(Calendar.objects.get(name="new calendar 1").defaultvalue, 11)
+
+
+class HierarchyTest(TestCase):
+    """
+    Verifies the nested set of a hierarchy model after incremental changes.
+    """
+
+    def assertNestedSet(self):
+        nodes = {i.name: i for i in Location.objects.all()}
+        self.assertFalse([i for i in nodes.values() if i.lft is None])
+        self.assertEqual(
+            sorted([i.lft for i in nodes.values()] + [i.rght for i in nodes.values()]),
+            list(range(1, 2 * len(nodes) + 1)),
+        )
+        for node in nodes.values():
+            ancestors = set()
+            owner = node.owner_id
+            while owner:
+                ancestors.add(owner)
+                owner = nodes[owner].owner_id
+            self.assertEqual(node.lvl, len(ancestors))
+            self.assertEqual(
+                {
+                    i.name
+                    for i in nodes.values()
+                    if i.lft < node.lft and i.rght > node.rght
+                },
+                ancestors,
+            )
+
+    def createTree(self):
+        for name, owner in [
+            ("All", None),
+            ("a", "All"),
+            ("a1", "a"),
+            ("a2", "a"),
+            ("b", "All"),
+            ("b1", "b"),
+            ("c", "All"),
+        ]:
+            Location(name=name, owner_id=owner).save()
+
+    def test_insert(self):
+        self.createTree()
+        self.assertNestedSet()
+        Location(name="d", owner_id=None).save()
+        Location(name="b2", owner_id="b").save()
+        self.assertNestedSet()
+
+    def test_move(self):
+        self.createTree()
+        # Move a subtree to the right
+        a = Location.objects.get(name="a")
+        a.owner_id = "c"
+        a.save()
+        self.assertNestedSet()
+        # Move a subtree to the left
+        c = Location.objects.get(name="c")
+        c.owner_id = "b1"
+        c.save()
+        self.assertNestedSet()
+        # Move a subtree to the top level
+        b = Location.objects.get(name="b")
+        b.owner_id = None
+        b.save()
+        self.assertNestedSet()
+        # Saving without a new owner doesn't change the hierarchy
+        b.description = "edited"
+        b.save()
+        self.assertNestedSet()
+
+    def test_move_under_descendant(self):
+        self.createTree()
+        before = dict(Location.objects.exclude(name="a").values_list("name", "lft"))
+        a = Location.objects.get(name="a")
+        a.owner_id = "a1"
+        a.save()
+        # The move isn't done incrementally, but left to a full rebuild
+        self.assertIsNone(Location.objects.get(name="a").lft)
+        self.assertEqual(
+            dict(Location.objects.exclude(name="a").values_list("name", "lft")),
+            before,
+        )
+        Location.rebuildHierarchy()
+        self.assertFalse(Location.objects.filter(lft__isnull=True).exists())
+
+    def test_bulk(self):
+        self.createTree()
+        with Location.deferHierarchy():
+            # The first node is positioned incrementally
+            Location(name="d", owner_id="b").save()
+            self.assertIsNotNone(Location.objects.get(name="d").lft)
+            # The next nodes are positioned by a rebuild at the end
+            Location(name="e", owner_id="d").save()
+            a = Location.objects.get(name="a")
+            a.owner_id = "e"
+            a.save()
+            self.assertIsNone(Location.objects.get(name="e").lft)
+            self.assertIsNone(Location.objects.get(name="a").lft)
+        self.assertNestedSet()
+        self.assertEqual(Location.objects.get(name="a1").lvl, 5)
+
+    def test_delete(self):
+        self.createTree()
+        # Deleting a leaf node closes the gap in the nested set
+        Location.objects.get(name="b1").delete()
+        self.assertNestedSet()
+        b = Location.objects.get(name="b")
+        self.assertEqual(b.rght, b.lft + 1)
+        # Deleting a node with children moves its children to the top
+        Location.objects.get(name="a").delete()
+        Location.rebuildHierarchy()
+        self.assertNestedSet()
+        self.assertEqual(Location.objects.get(name="a1").lvl, 0)
+
+    def test_rebuild(self):
+        # A hierarchy deeper than the recursion limit of Python
+        depth = 1500
+        Location.objects.bulk_create(
+            [
+                Location(
+                    name="node %04d" % i, owner_id="node %04d" % (i - 1) if i else None
+                )
+                for i in range(depth)
+            ]
+        )
+        Location.objects.bulk_create(
+            [Location(name="leaf %04d" % i, owner_id="node 0000") for i in range(10)]
+        )
+        Location.rebuildHierarchy()
+        self.assertNestedSet()
+        self.assertEqual(
+            Location.objects.get(name="node %04d" % (depth - 1)).lvl, depth - 1
+        )
+
+
+class PropagateStatusTest(TestCase):
+    """
+    Verifies the propagation of the status of operationplans to the
+    related operationplans.
+    """
+
+    def setUp(self):
+        Location(name="factory").save()
+        Item(name="product").save()
+        Item(name="component").save()
+        Operation(
+            name="routing", type="routing", location_id="factory", item_id="product"
+        ).save()
+        for i in range(1, 4):
+            Operation(
+                name="step %s" % i,
+                location_id="factory",
+                owner_id="routing",
+                priority=i,
+            ).save()
+        Operation(name="assembly", location_id="factory", item_id="product").save()
+        start = datetime(2100, 1, 1)
+        end = datetime(2100, 1, 2)
+        OperationPlan.objects.bulk_create(
+            [
+                OperationPlan(
+                    reference=reference,
+                    type=type,
+                    status=status,
+                    operation_id=operation,
+                    owner_id=owner,
+                    item_id="component" if type == "PO" else None,
+                    location_id="factory",
+                    quantity=10,
+                    startdate=start,
+                    enddate=end,
+                )
+                for reference, type, status, operation, owner in [
+                    ("MO 1", "MO", "proposed", "routing", None),
+                    ("MO 1-1", "MO", "proposed", "step 1", "MO 1"),
+                    ("MO 1-2", "MO", "proposed", "step 2", "MO 1"),
+                    ("MO 1-3", "MO", "proposed", "step 3", "MO 1"),
+                    ("MO 2", "MO", "proposed", "assembly", None),
+                    ("PO 1", "PO", "proposed", None, None),
+                    ("PO 2", "PO", "confirmed", None, None),
+                    ("PO 3", "PO", "proposed", None, None),
+                ]
+            ]
+        )
+        OperationPlanMaterial.objects.bulk_create(
+            [
+                OperationPlanMaterial(
+                    operationplan_id=reference,
+                    item_id=item,
+                    location_id="factory",
+                    quantity=quantity,
+                    flowdate=flowdate,
+                )
+                for reference, item, quantity, flowdate in [
+                    ("MO 1-2", "product", 10, end),
+                    ("MO 2", "component", -10, start),
+                    ("PO 1", "component", 4, end),
+                    ("PO 2", "component", 8, end),
+                    ("PO 3", "component", 5, datetime(2100, 1, 3)),
+                ]
+            ]
+        )
+
+    def setStatus(self, reference, status):
+        OperationPlan.objects.filter(reference=reference).update(status=status)
+        OperationPlan.propagateStatusBulk([reference])
+
+    def assertStatus(self, expected):
+        self.assertEqual(
+            dict(
+                OperationPlan.objects.filter(reference__in=expected.keys()).values_list(
+                    "reference", "status"
+                )
+            ),
+            expected,
+        )
+
+    def test_children(self):
+        self.setStatus("MO 1", "approved")
+        self.assertStatus(
+            {
+                "MO 1": "approved",
+                "MO 1-1": "approved",
+                "MO 1-2": "approved",
+                "MO 1-3": "approved",
+            }
+        )
+
+    def test_routing_steps(self):
+        # Previous steps are completed as well, and the routing is approved
+        self.setStatus("MO 1-2", "completed")
+        self.assertStatus(
+            {
+                "MO 1": "approved",
+                "MO 1-1": "completed",
+                "MO 1-2": "completed",
+                "MO 1-3": "proposed",
+            }
+        )
+        self.assertFalse(
+            OperationPlan.objects.filter(
+                reference__in=("MO 1-1", "MO 1-2"), enddate__gt=datetime.now()
+            ).exists()
+        )
+        # The routing is completed with its last step
+        self.setStatus("MO 1-3", "completed")
+        self.assertStatus(
+            {
+                "MO 1": "completed",
+                "MO 1-1": "completed",
+                "MO 1-2": "completed",
+                "MO 1-3": "completed",
+            }
+        )
+
+    def test_buffer_summary(self):
+        # The buffers of the child operationplans are marked for refresh
+        BufferBucketRefresh.objects.all().delete()
+        self.setStatus("MO 1", "completed")
+        self.assertEqual(
+            set(BufferBucketRefresh.objects.values_list("item", "location")),
+            {("product", "factory")},
+        )
+
+    def test_upstream_closing(self):
+        # The consumption of 10 is covered by completing the confirmed supply
+        # of 8 first, and then the proposed supply with the earliest date
+        self.setStatus("MO 2", "completed")
+        self.assertStatus(
+            {
+                "MO 2": "completed",
+                "PO 1": "completed",
+                "PO 2": "completed",
+                "PO 3": "proposed",
+            }
+        )
+        self.assertFalse(
+            OperationPlanMaterial.objects.filter(
+                operationplan_id="MO 2", flowdate__gt=datetime.now()
+            ).exists()
+        )
+
 
 class ExcelTest(TransactionTestCase):
 
@@ -6479,19 +6479,26 @@ class OperationPlanDetail(View):
     def getData(self, request):
         # Current date
         try:
-            current_date = parse(
-                Parameter.objects.using(request.database).get(name="currentdate").value
-            )
+            current_date = parse(Parameter.getValue("currentdate", request.database))
         except Exception:
             current_date = datetime.now()
         cursor = connections[request.database].cursor()
 
-        # Read the results from the database
+        # Read the results from the database.
+        # The details of all operationplans are retrieved together, with a
+        # fixed number of queries regardless of the number of operationplans.
         ids = request.GET.getlist("reference")
-        first = True
         if not ids:
             yield "[]"
-            raise StopIteration
+            return
+
+        # Store my permissions
+        view_PO = request.user.has_perm("input.view_purchaseorder")
+        view_MO = request.user.has_perm("input.view_manufacturingorder")
+        view_DO = request.user.has_perm("input.view_distributionorder")
+        view_OpplanMaterial = request.user.has_perm("input.view_operationplanmaterial")
+        view_OpplanResource = request.user.has_perm("input.view_operationplanresource")
+
         try:
             opplans = [
                 x
@@ -6499,43 +6506,270 @@ class OperationPlanDetail(View):
                 .using(request.database)
                 .filter(reference__in=ids)
                 .select_related("operation")
+                if not (x.type == "DO" and not view_DO)
+                and not (x.type == "PO" and not view_PO)
+                and not (x.type == "MO" and not view_MO)
             ]
-            opplanmats = [
-                x
-                for x in OperationPlanMaterial.objects.all()
-                .using(request.database)
-                .filter(operationplan__reference__in=ids)
-                .values()
-            ]
-            opplanrscs = [
-                x
-                for x in OperationPlanResource.objects.all()
-                .using(request.database)
-                .filter(operationplan__reference__in=ids)
-                .values()
-            ]
+            if not opplans:
+                yield "[]"
+                return
+            references = [x.reference for x in opplans]
+            operations = list({x.operation_id for x in opplans if x.operation_id})
+
+            # Demands the operationplans are pegged to
+            demands = {
+                d
+                for x in opplans
+                if x.plan and "pegging" in x.plan
+                for d in x.plan["pegging"]
+            }
+            if demands:
+                demands = {
+                    x[0]: x
+                    for x in Demand.objects.all()
+                    .using(request.database)
+                    .filter(name__in=demands)
+                    .values_list("name", "item_id", "due")
+                }
+
+            # Material flows and alternate materials
+            opplanmats = {}
+            matalts = {}
+            if view_OpplanMaterial:
+                for x in (
+                    OperationPlanMaterial.objects.all()
+                    .using(request.database)
+                    .filter(operationplan__reference__in=references)
+                    .values()
+                ):
+                    opplanmats.setdefault(x["operationplan_id"], []).append(x)
+                if operations:
+                    cursor.execute(
+                        """
+                        select a.operation_id, a.item_id, b.item_id
+                        from operationmaterial a
+                        inner join operationmaterial b on a.operation_id = b.operation_id and a.name = b.name
+                        where a.operation_id = any(%s)
+                        and a.id != b.id
+                        """,
+                        (operations,),
+                    )
+                    for i in cursor.fetchall():
+                        matalts.setdefault(i[0], {}).setdefault(i[1], set()).add(i[2])
+
+            # Resource loading and alternate resources
+            opplanrscs = {}
+            rscalts = {}
+            if view_OpplanResource:
+                for x in (
+                    OperationPlanResource.objects.all()
+                    .using(request.database)
+                    .filter(operationplan__reference__in=references)
+                    .values()
+                ):
+                    opplanrscs.setdefault(x["operationplan_id"], []).append(x)
+                if operations:
+                    cursor.execute(
+                        """
+                        select operationresource.operation_id, res_children.name, alt_res_children.name
+                        from operationresource
+                        inner join resource
+                          on  resource.name = operationresource.resource_id
+                        inner join resource res_children
+                          on  res_children.lft between resource.lft and resource.rght
+                          and res_children.rght = res_children.lft + 1
+                        inner join operationresource alt_opres
+                          on ((operationresource.name is not null and operationresource.name = alt_opres.name)
+                          or (operationresource.name is null and operationresource.id = alt_opres.id))
+                          and operationresource.operation_id = alt_opres.operation_id
+                        inner join resource alt_res
+                          on alt_opres.resource_id = alt_res.name
+                        inner join resource alt_res_children
+                           on alt_res_children.lft between alt_res.lft and alt_res.rght
+                           and alt_res_children.rght = alt_res_children.lft + 1
+                        where (operationresource.skill_id is null or exists (
+                           select 1 from resourceskill
+                           where resourceskill.resource_id = alt_res_children.name
+                           and resourceskill.skill_id = alt_opres.skill_id
+                           ))
+                        and operationresource.operation_id = any(%s)
+                        """,
+                        (operations,),
+                    )
+                    for i in cursor.fetchall():
+                        rscalts.setdefault(i[0], {}).setdefault(i[1], set()).add(i[2])
+
+            # Network status of the items.
+            # The last field indicates whether the location is relevant for
+            # all operationplans of the item, or only for the operationplans
+            # at that location.
+            network = {}
+            items = [x for x in opplans if x.item_id]
+            if items:
+                cursor.execute(
+                    """
+                    with items as (
+                       select name from item where name = any(%s)
+                       )
+                    select * from (
+                    select
+                      items.name,
+                      false,
+                      location.name as location,
+                      coalesce(onhand.qty,0) + coalesce(completed.quantity,0),
+                      orders_plus.PO,
+                      coalesce(orders_plus.DO, 0) - coalesce(orders_minus.DO, 0),
+                      orders_plus.MO, sales.BO, sales.SO,
+                      (coalesce(onhand.qty,0) + coalesce(completed.quantity,0)) > 0
+                      or orders_plus.MO is not null
+                      or orders_plus.PO is not null
+                      or orders_plus.DO is not null
+                      or orders_minus.DO is not null
+                      or sales.BO is not null
+                      or sales.SO is not null as relevant
+                    from items
+                    cross join location
+                    left outer join (
+                      select item_id, location_id, onhand as qty
+                      from buffer
+                      inner join items on items.name = buffer.item_id
+                      ) onhand
+                    on onhand.item_id = items.name and onhand.location_id = location.name
+                    left outer join (
+                       select opm.item_id, opm.location_id, sum(opm.quantity) as quantity
+                       from operationplanmaterial opm
+                       inner join items on items.name = opm.item_id
+                       inner join operationplan op on opm.operationplan_id = op.reference
+                       where op.status = 'completed'
+                       group by opm.item_id, opm.location_id
+                    ) completed
+                    on completed.item_id = items.name and completed.location_id = location.name
+                    left outer join (
+                      select item_id, coalesce(location_id, destination_id) as location_id,
+                      sum(case when type = 'MO' then quantity end) as MO,
+                      sum(case when type = 'PO' then quantity end) as PO,
+                      sum(case when type = 'DO' then quantity end) as DO
+                      from operationplan
+                      inner join items on items.name = operationplan.item_id
+                      and status in ('approved', 'confirmed')
+                      group by item_id, coalesce(location_id, destination_id)
+                      ) orders_plus
+                    on orders_plus.item_id = items.name and orders_plus.location_id = location.name
+                    left outer join (
+                      select item_id, origin_id as location_id,
+                      sum(quantity) as DO
+                      from operationplan
+                      inner join items on items.name = operationplan.item_id
+                      and status in ('approved', 'confirmed')
+                      and type = 'DO'
+                      group by item_id, origin_id
+                      ) orders_minus
+                    on orders_minus.item_id = items.name and orders_minus.location_id = location.name
+                    left outer join (
+                      select item_id, location_id,
+                      sum(case when due < %s then quantity end) as BO,
+                      sum(case when due >= %s then quantity end) as SO
+                      from demand
+                      inner join items on items.name = demand.item_id
+                      where status in ('open', 'quote')
+                      group by item_id, location_id
+                      ) sales
+                    on sales.item_id = items.name and sales.location_id = location.name
+                    ) network
+                    where relevant or exists (
+                      select 1
+                      from unnest(%s::varchar[], %s::varchar[]) as selected(item, location)
+                      where selected.item = network.name
+                      and selected.location = network.location
+                      )
+                    order by network.name, network.location
+                    """,
+                    (
+                        list({x.item_id for x in items}),
+                        current_date,
+                        current_date,
+                        [x.item_id for x in items],
+                        [x.location_id for x in items],
+                    ),
+                )
+                for a in cursor.fetchall():
+                    network.setdefault(a[0], []).append(a)
+
+            # Downstream and upstream operationplans
+            linked = {}
+            for field in ("downstream_opplans", "upstream_opplans"):
+                linked[field] = {}
+                cursor.execute(
+                    """
+                    with cte as (
+                      select
+                        op.reference as root,
+                        (value->>0)::int as level,
+                        value->>1 as reference,
+                        (value->>2)::numeric as quantity,
+                        rownum
+                      from operationplan op
+                      cross join lateral jsonb_array_elements(op.plan->'%s')
+                        with ordinality as elements(value, rownum)
+                      where op.reference = any(%%s)
+                      )
+                    select cte.root,
+                    cte.level,
+                    cte.reference,
+                    operationplan.type,
+                    case when operationplan.type = 'PO' then 'Purchase '||operationplan.item_id||' @ '||operationplan.location_id||' from '||operationplan.supplier_id
+                         when operationplan.type = 'DO' then 'Ship '||operationplan.item_id||' from '||operationplan.origin_id||' to '||operationplan.destination_id
+                         %s
+                    else operationplan.operation_id end,
+                    operationplan.status,
+                    operationplan.item_id,
+                    coalesce(operationplan.location_id, operationplan.destination_id),
+                    case when operationplan.type = 'STCK' then '' else to_char(operationplan.startdate,'YYYY-MM-DD hh24:mi:ss') end,
+                    case when operationplan.type = 'STCK' then '' else to_char(operationplan.enddate,'YYYY-MM-DD hh24:mi:ss') end,
+                    trim(trailing '.' from (trim(trailing '0' from round(cte.quantity,8)::text)))||'/'||
+                    trim(trailing '.' from (trim(trailing '0' from round(operationplan.quantity,8)::text)))
+                    from cte
+                    inner join operationplan on operationplan.reference = cte.reference
+                    order by cte.root, cte.rownum
+                    """
+                    % (
+                        field,
+                        (
+                            "when operationplan.demand_id is not null then 'Deliver '||operationplan.demand_id"
+                            if "freppledb.forecast" not in settings.INSTALLED_APPS
+                            else """
+                            when coalesce(operationplan.demand_id, operationplan.forecast) is not null then 'Deliver '||coalesce(operationplan.demand_id, operationplan.forecast)
+                            """
+                        )
+                        if field == "downstream_opplans"
+                        else "",
+                    ),
+                    (references,),
+                )
+                for a in cursor.fetchall():
+                    linked[field].setdefault(a[0], []).append(
+                        [
+                            a[1],  # level
+                            a[2],  # reference
+                            a[3],  # type
+                            a[4] or "",  # operation (null if optype is STCK)
+                            a[5],  # status
+                            a[6],  # item
+                            a[7],  # location
+                            a[8],  # startdate
+                            a[9],  # enddate
+                            a[10],  # quantity,
+                            0 if a[1] == 1 else 2,
+                        ]
+                    )
         except Exception as e:
             logger.error("Error retrieving operationplan data: %s" % e)
             yield "[]"
-            raise StopIteration
-
-        # Store my permissions
-        view_PO = request.user.has_perm("input.view_purchaseorder")
-        view_MO = request.user.has_perm("input.view_manufacturingorder")
-        view_DO = request.user.has_perm("input.view_distributionorder")
-        view_OpplanMaterial = request.user.has_perm("input.view_operationplanmaterial")
-        view_OpplanResource = request.user.has_perm("input.view_operationplanresource")
+            return
 
         # Loop over all operationplans
+        first = True
         for opplan in opplans:
-
-            # Check permissions
-            if opplan.type == "DO" and not view_DO:
-                continue
-            if opplan.type == "PO" and not view_PO:
-                continue
-            if opplan.type == "MO" and not view_MO:
-                continue
             try:
                 # Base information
                 res = {
@@ -6563,31 +6797,25 @@ class OperationPlanDetail(View):
                     "supplier": opplan.supplier_id,
                     "item": opplan.item_id,
                     "color": float(opplan.color) if opplan.color else "",
-                    "owner": opplan.owner.reference if opplan.owner else None,
+                    "owner": opplan.owner_id,
                 }
                 if opplan.plan and "pegging" in opplan.plan:
                     res["pegging_demand"] = []
                     for d, q in opplan.plan["pegging"].items():
-                        try:
-                            obj = (
-                                Demand.objects.all()
-                                .using(request.database)
-                                .only("name", "item", "due")
-                                .get(name=d)
-                            )
-                            res["pegging_demand"].append(
-                                {
-                                    "demand": {
-                                        "name": obj.name,
-                                        "item": {"name": obj.item.name},
-                                        "due": obj.due.strftime("%Y-%m-%dT%H:%M:%S"),
-                                    },
-                                    "quantity": q,
-                                }
-                            )
-                        except Demand.DoesNotExist:
+                        obj = demands.get(d, None)
+                        if not obj:
                             # Looks like this demand was deleted since the plan was generated
                             continue
+                        res["pegging_demand"].append(
+                            {
+                                "demand": {
+                                    "name": obj[0],
+                                    "item": {"name": obj[1]},
+                                    "due": obj[2].strftime("%Y-%m-%dT%H:%M:%S"),
+                                },
+                                "quantity": q,
+                            }
+                        )
                     res["pegging_demand"].sort(
                         key=lambda f: (f["demand"]["name"], f["demand"]["due"])
                     )
@@ -6598,31 +6826,10 @@ class OperationPlanDetail(View):
                     }
 
                 # Information on materials
-                if view_OpplanMaterial:
-                    # Retrieve information about eventual alternates
-                    alts = {}
-                    if opplan.operation:
-                        cursor.execute(
-                            """
-                            select a.item_id, b.item_id
-                            from operationmaterial a 
-                            inner join operationmaterial b on a.operation_id = b.operation_id and a.name = b.name
-                            where a.operation_id = %s
-                            and a.id != b.id
-                            """,
-                            (opplan.operation.name,),
-                        )
-                        for i in cursor.fetchall():
-                            if i[0] not in alts:
-                                alts[i[0]] = set()
-                            alts[i[0]].add(i[1])
-                    firstmat = True
-                    for m in opplanmats:
-                        if m["operationplan_id"] != opplan.reference:
-                            continue
-                        if firstmat:
-                            firstmat = False
-                            res["flowplans"] = []
+                if view_OpplanMaterial and opplan.reference in opplanmats:
+                    alts = matalts.get(opplan.operation_id, {})
+                    res["flowplans"] = []
+                    for m in opplanmats[opplan.reference]:
                         flowplan = {
                             "date": m["flowdate"].strftime("%Y-%m-%dT%H:%M:%S"),
                             "quantity": float(m["quantity"]),
@@ -6638,48 +6845,10 @@ class OperationPlanDetail(View):
                         res["flowplans"].append(flowplan)
 
                 # Information on resources
-                if view_OpplanResource:
-                    # Retrieve information about eventual alternates
-                    alts = {}
-                    if opplan.operation:
-                        cursor.execute(
-                            """
-                            select res_children.name, alt_res_children.name
-                            from operationresource
-                            inner join resource
-                              on  resource.name = operationresource.resource_id
-                            inner join resource res_children
-                              on  res_children.lft between resource.lft and resource.rght
-                              and res_children.rght = res_children.lft + 1
-                            inner join operationresource alt_opres
-                              on ((operationresource.name is not null and operationresource.name = alt_opres.name)
-                              or (operationresource.name is null and operationresource.id = alt_opres.id))
-                              and operationresource.operation_id = alt_opres.operation_id
-                            inner join resource alt_res
-                              on alt_opres.resource_id = alt_res.name
-                            inner join resource alt_res_children
-                               on alt_res_children.lft between alt_res.lft and alt_res.rght
-                               and alt_res_children.rght = alt_res_children.lft + 1
-                            where (operationresource.skill_id is null or exists (
-                               select 1 from resourceskill
-                               where resourceskill.resource_id = alt_res_children.name
-                               and resourceskill.skill_id = alt_opres.skill_id
-                               ))
-                            and operationresource.operation_id = %s
-                            """,
-                            (opplan.operation.name,),
-                        )
-                        for i in cursor.fetchall():
-                            if i[0] not in alts:
-                                alts[i[0]] = set()
-                            alts[i[0]].add(i[1])
-                    firstres = True
-                    for m in opplanrscs:
-                        if m["operationplan_id"] != opplan.reference:
-                            continue
-                        if firstres:
-                            firstres = False
-                            res["loadplans"] = []
+                if view_OpplanResource and opplan.reference in opplanrscs:
+                    alts = rscalts.get(opplan.operation_id, {})
+                    res["loadplans"] = []
+                    for m in opplanrscs[opplan.reference]:
                         ldplan = {
                             "date": m["startdate"].strftime("%Y-%m-%dT%H:%M:%S"),
                             "quantity": float(m["quantity"]),
@@ -6694,212 +6863,33 @@ class OperationPlanDetail(View):
                                 break
                         res["loadplans"].append(ldplan)
 
-                # Retrieve network status
+                # Network status
                 if opplan.item_id:
-                    cursor.execute(
-                        """
-                        with items as (
-                           select name from item where name = %s
-                           )
-                        select
-                          items.name,
-                          false,
-                          location.name,
-                          coalesce(onhand.qty,0) + coalesce(completed.quantity,0),
-                          orders_plus.PO,
-                          coalesce(orders_plus.DO, 0) - coalesce(orders_minus.DO, 0),
-                          orders_plus.MO, sales.BO, sales.SO
-                        from items
-                        cross join location
-                        left outer join (
-                          select item_id, location_id, onhand as qty
-                          from buffer
-                          inner join items on items.name = buffer.item_id
-                          ) onhand
-                        on onhand.item_id = items.name and onhand.location_id = location.name
-                        left outer join (
-                           select opm.item_id, opm.location_id, sum(opm.quantity) as quantity
-                           from operationplanmaterial opm
-                           inner join operationplan op on opm.operationplan_id = op.reference
-                           where op.status = 'completed'
-                           group by opm.item_id, opm.location_id
-                        ) completed
-                        on completed.item_id = items.name and completed.location_id = location.name
-                        left outer join (
-                          select item_id, coalesce(location_id, destination_id) as location_id,
-                          sum(case when type = 'MO' then quantity end) as MO,
-                          sum(case when type = 'PO' then quantity end) as PO,
-                          sum(case when type = 'DO' then quantity end) as DO
-                          from operationplan
-                          inner join items on items.name = operationplan.item_id
-                          and status in ('approved', 'confirmed')
-                          group by item_id, coalesce(location_id, destination_id)
-                          ) orders_plus
-                        on orders_plus.item_id = items.name and orders_plus.location_id = location.name
-                        left outer join (
-                          select item_id, origin_id as location_id,
-                          sum(quantity) as DO
-                          from operationplan
-                          inner join items on items.name = operationplan.item_id
-                          and status in ('approved', 'confirmed')
-                          and type = 'DO'
-                          group by item_id, origin_id
-                          ) orders_minus
-                        on orders_minus.item_id = items.name and orders_minus.location_id = location.name
-                        left outer join (
-                          select item_id, location_id,
-                          sum(case when due < %s then quantity end) as BO,
-                          sum(case when due >= %s then quantity end) as SO
-                          from demand
-                          inner join items on items.name = demand.item_id
-                          where status in ('open', 'quote')
-                          group by item_id, location_id
-                          ) sales
-                        on sales.item_id = items.name and sales.location_id = location.name
-                        where
-                          (coalesce(onhand.qty,0) + coalesce(completed.quantity,0)) > 0
-                          or orders_plus.MO is not null
-                          or orders_plus.PO is not null
-                          or orders_plus.DO is not null
-                          or orders_minus.DO is not null
-                          or sales.BO is not null
-                          or sales.SO is not null
-                          or (items.name = %s and location.name = %s)
-                        order by items.name, location.name
-                        """,
-                        (
-                            opplan.item_id,
-                            current_date,
-                            current_date,
-                            opplan.item_id,
-                            opplan.location_id,
-                        ),
-                    )
-                    res["network"] = []
-                    for a in cursor.fetchall():
-                        res["network"].append(
-                            [
-                                a[0],
-                                a[1],
-                                a[2],
-                                float(a[3] or 0),
-                                float(a[4] or 0),
-                                float(a[5] or 0),
-                                float(a[6] or 0),
-                                float(a[7] or 0),
-                                float(a[8] or 0),
-                            ]
-                        )
-
-                # Downstream operationplans
-
-                cursor.execute(
-                    """
-                with cte as
-                (
-                select (value->>0)::int as level,
-                value->>1 as reference,
-                (value->>2)::numeric as quantity,
-                row_number() over() as rownum
-                from jsonb_array_elements((select plan->'downstream_opplans' from operationplan where reference = %%s))
-                )
-                select cte.level,
-                cte.reference,
-                operationplan.type,
-                case when operationplan.type = 'PO' then 'Purchase '||operationplan.item_id||' @ '||operationplan.location_id||' from '||operationplan.supplier_id
-                     when operationplan.type = 'DO' then 'Ship '||operationplan.item_id||' from '||operationplan.origin_id||' to '||operationplan.destination_id
-                     %s
-                else operationplan.operation_id end,
-                operationplan.status,
-                operationplan.item_id,
-                coalesce(operationplan.location_id, operationplan.destination_id),
-                to_char(operationplan.startdate,'YYYY-MM-DD hh24:mi:ss'),
-                to_char(operationplan.enddate,'YYYY-MM-DD hh24:mi:ss'),
-                trim(trailing '.' from (trim(trailing '0' from round(cte.quantity,8)::text)))||'/'||
-                trim(trailing '.' from (trim(trailing '0' from round(operationplan.quantity,8)::text)))
-                from cte
-                inner join operationplan on operationplan.reference = cte.reference
-                order by cte.rownum
-                """
-                    % (
-                        "when operationplan.demand_id is not null then 'Deliver '||operationplan.demand_id"
-                        if "freppledb.forecast" not in settings.INSTALLED_APPS
-                        else """
-                        when coalesce(operationplan.demand_id, operationplan.forecast) is not null then 'Deliver '||coalesce(operationplan.demand_id, operationplan.forecast)
-                        """
-                    ),
-                    (opplan.reference,),
-                )
-
-                if cursor.rowcount > 0:
-                    res["downstreamoperationplans"] = []
-                    for a in cursor.fetchall():
-                        res["downstreamoperationplans"].append(
-                            [
-                                a[0],  # level
-                                a[1],  # reference
-                                a[2],  # type
-                                a[3],  # operation
-                                a[4],  # status
-                                a[5],  # item
-                                a[6],  # location
-                                a[7],  # startdate
-                                a[8],  # enddate
-                                a[9],  # quantity,
-                                0 if a[0] == 1 else 2,
-                            ]
-                        )
-
-                # Upstream operationplans
-
-                cursor.execute(
-                    """
-                with cte as
-                (
-                select (value->>0)::int as level,
-                value->>1 as reference,
-                (value->>2)::numeric as quantity,
-                row_number() over() as rownum
-                from jsonb_array_elements((select plan->'upstream_opplans' from operationplan where reference = %s))
-                )
-                select cte.level,
-                cte.reference,
-                operationplan.type,
-                case when operationplan.type = 'PO' then 'Purchase '||operationplan.item_id||' @ '||operationplan.location_id||' from '||operationplan.supplier_id
-                     when operationplan.type = 'DO' then 'Ship '||operationplan.item_id||' from '||operationplan.origin_id||' to '||operationplan.destination_id
-                else operationplan.operation_id end,
-                operationplan.status,
-                operationplan.item_id,
-                coalesce(operationplan.location_id, operationplan.destination_id),
-                case when operationplan.type = 'STCK' then '' else to_char(operationplan.startdate,'YYYY-MM-DD hh24:mi:ss') end,
-                case when operationplan.type = 'STCK' then '' else to_char(operationplan.enddate,'YYYY-MM-DD hh24:mi:ss') end,
-                trim(trailing '.' from (trim(trailing '0' from round(cte.quantity,8)::text)))||'/'||
-                trim(trailing '.' from (trim(trailing '0' from round(operationplan.quantity,8)::text)))
-                from cte
-                inner join operationplan on operationplan.reference = cte.reference
-                order by cte.rownum
-                """,
-                    (opplan.reference,),
-                )
+                    res["network"] = [
+                        [
+                            a[0],
+                            a[1],
+                            a[2],
+                            float(a[3] or 0),
+                            float(a[4] or 0),
+                            float(a[5] or 0),
+                            float(a[6] or 0),
+                            float(a[7] or 0),
+                            float(a[8] or 0),
+                        ]
+                        for a in network.get(opplan.item_id, [])
+                        if a[9] or a[2] == opplan.location_id
+                    ]
 
-                if cursor.rowcount > 0:
-                    res["upstreamoperationplans"] = []
-                    for a in cursor.fetchall():
-                        res["upstreamoperationplans"].append(
-                            [
-                                a[0],  # level
-                                a[1],  # reference
-                                a[2],  # type
-                                a[3] or "",  # operation (null if optype is STCK)
-                                a[4],  # status
-                                a[5],  # item
-                                a[6],  # location
-                                a[7],  # startdate
-                                a[8],  # enddate
-                                a[9],  # quantity,
-                                0 if a[0] == 1 else 2,
-                            ]
-                        )
+                # Downstream and upstream operationplans
+                if opplan.reference in linked["downstream_opplans"]:
+                    res["downstreamoperationplans"] = linked["downstream_opplans"][
+                        opplan.reference
+                    ]
+                if opplan.reference in linked["upstream_opplans"]:
+                    res["upstreamoperationplans"] = linked["upstream_opplans"][
+                        opplan.reference
+                    ]
 
                 # Final result
                 if first:
@@ -6907,10 +6897,10 @@ class OperationPlanDetail(View):
                     first = False
                 else:
                     yield ",%s" % json.dumps(res)
-                yield "]"
             except Exception as e:
                 # Ignore exceptions and move on
                 logger.error("Error retrieving operationplan: %s" % e)
+        yield "[]" if first else "]"
 
     @method_decorator(csrf_exempt)
     def dispatch(self, request, *args, **kwargs):
@@ -6951,67 +6941,68 @@ class OperationPlanDetail(View):
         update_MO = request.user.has_perm("input.change_manufacturingorder")
         update_DO = request.user.has_perm("input.change_distributionorder")
 
-        for opplan_data in data:
-            try:
-                # Read the object from the database
-                opplan = (
-                    OperationPlan.objects.all()
-                    .using(request.database)
-                    .get(reference=opplan_data.get("id", None))
-                )
-
-                # Check permissions
-                if opplan.type == "DO" and not update_DO:
-                    continue
-                if opplan.type == "PO" and not update_PO:
-                    continue
-                if opplan.type == "MO" and not update_MO:
-                    continue
-
-                # Update fields
-                save = False
-                if "start" in opplan_data:
-                    # Update start date
-                    opplan.startdate = datetime.strptime(
-                        opplan_data["start"], "%Y-%m-%dT%H:%M:%S"
-                    )
-                    save = True
-                if "end" in opplan_data:
-                    # Update end date
-                    opplan.enddate = datetime.strptime(
-                        opplan_data["end"], "%Y-%m-%dT%H:%M:%S"
-                    )
-                    save = True
-                if "quantity" in opplan_data:
-                    # Update quantity
-                    opplan.quantity = opplan_data["quantity"]
-                    save = True
-                if "status" in opplan_data:
-                    # Status quantity
-                    opplan.status = opplan_data["status"]
-                    save = True
-
-                if "reference" in opplan_data:
-                    # Update reference
-                    opplan.reference = opplan_data["reference"]
-                    save = True
-
-                # Save if changed
-                if save:
-                    opplan.save(
-                        using=request.database,
-                        update_fields=[
-                            "startdate",
-                            "enddate",
-                            "quantity",
-                            "reference",
-                            "lastmodified",
-                        ],
+        with OperationPlan.deferPropagation(request.database):
+            for opplan_data in data:
+                try:
+                    # Read the object from the database
+                    opplan = (
+                        OperationPlan.objects.all()
+                        .using(request.database)
+                        .get(reference=opplan_data.get("id", None))
                     )
-            except OperationPlan.DoesNotExist:
-                # Silently ignore
-                pass
-            except Exception as e:
-                # Swallow the exception and move on
-                logger.error("Error updating operationplan: %s" % e)
+
+                    # Check permissions
+                    if opplan.type == "DO" and not update_DO:
+                        continue
+                    if opplan.type == "PO" and not update_PO:
+                        continue
+                    if opplan.type == "MO" and not update_MO:
+                        continue
+
+                    # Update fields
+                    save = False
+                    if "start" in opplan_data:
+                        # Update start date
+                        opplan.startdate = datetime.strptime(
+                            opplan_data["start"], "%Y-%m-%dT%H:%M:%S"
+                        )
+                        save = True
+                    if "end" in opplan_data:
+                        # Update end date
+                        opplan.enddate = datetime.strptime(
+                            opplan_data["end"], "%Y-%m-%dT%H:%M:%S"
+                        )
+                        save = True
+                    if "quantity" in opplan_data:
+                        # Update quantity
+                        opplan.quantity = opplan_data["quantity"]
+                        save = True
+                    if "status" in opplan_data:
+                        # Status quantity
+                        opplan.status = opplan_data["status"]
+                        save = True
+
+                    if "reference" in opplan_data:
+                        # Update reference
+                        opplan.reference = opplan_data["reference"]
+                        save = True
+
+                    # Save if changed
+                    if save:
+                        opplan.save(
+                            using=request.database,
+                            update_fields=[
+                                "startdate",
+                                "enddate",
+                                "quantity",
+                                "reference",
+                                "lastmodified",
+                            ],
+                        )
+                except OperationPlan.DoesNotExist:
+                    # Silently ignore
+                    pass
+                except Exception as e:
+                    # Swallow the exception and move on
+                    logger.error("Error updating operationplan: %s" % e)
         return HttpResponse(content="OK")
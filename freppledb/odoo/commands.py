@@ -20,8 +20,11 @@ import jwt
 import os
 import time
 import logging
+from queue import Empty, Full, Queue
+from threading import Event, Thread
 from urllib.request import urlopen, HTTPError, Request
 from xml.sax.saxutils import quoteattr
+import zlib
 
 from django.utils.http import urlencode
 
@@ -41,6 +44,107 @@ from freppledb.input.commands import LoadTask
 logger = logging.getLogger(__name__)
 
 
+class OdooStream:
+    """
+    File-like object to read the XML data from the Odoo server while it is
+    being downloaded.
+
+    A background thread reads the HTTP response in chunks, decompresses them
+    when the server sent gzip-compressed content, and hands them over to the
+    parser through a bounded queue. The download thus overlaps with the
+    parsing, and only a limited number of chunks are kept in memory.
+
+    The stream must be closed when the parser stops reading, to release the
+    background thread.
+    """
+
+    def __init__(self, response, chunksize=256 * 1024, maxchunks=16):
+        self.response = response
+        self.chunksize = chunksize
+        self.queue = Queue(maxsize=maxchunks)
+        self.buffer = b""
+        self.offset = 0
+        self.done = False
+        self.size = 0
+        self.closed = Event()
+        if (response.headers.get("Content-Encoding") or "").lower() in (
+            "gzip",
+            "x-gzip",
+        ):
+            self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        else:
+            self.decompressor = None
+        self.thread = Thread(target=self._download, daemon=True)
+        self.thread.start()
+
+    def _put(self, data):
+        """
+        Hands over data to the parser. Returns False when the stream is closed.
+        """
+        while not self.closed.is_set():
+            try:
+                self.queue.put(data, timeout=1)
+                return True
+            except Full:
+                pass
+        return False
+
+    def _download(self):
+        try:
+            while not self.closed.is_set():
+                data = self.response.read(self.chunksize)
+                if not data:
+                    break
+                self.size += len(data)
+                if self.decompressor:
+                    data = self.decompressor.decompress(data)
+                if data and not self._put(data):
+                    return
+            if self.decompressor:
+                data = self.decompressor.flush()
+                if data and not self._put(data):
+                    return
+            self._put(None)
+        except Exception as e:
+            self._put(e)
+
+    def close(self):
+        """
+        Stops the download, and releases the background thread when it's
+        waiting for the parser.
+        """
+        self.closed.set()
+        while True:
+            try:
+                self.queue.get_nowait()
+            except Empty:
+                break
+
+    def read(self, size=-1):
+        result = []
+        while size != 0:
+            if self.offset >= len(self.buffer):
+                if self.done:
+                    break
+                data = self.queue.get()
+                if data is None:
+                    self.done = True
+                    break
+                if isinstance(data, Exception):
+                    self.done = True
+                    raise data
+                self.buffer = data
+                self.offset = 0
+            if size < 0:
+                end = len(self.buffer)
+            else:
+                end = min(self.offset + size, len(self.buffer))
+                size -= end - self.offset
+            result.append(self.buffer[self.offset : end])
+            self.offset = end
+        return b"".join(result)
+
+
 @PlanTaskRegistry.register
 class OdooReadData(PlanTask):
     """
@@ -153,17 +257,28 @@ class OdooReadData(PlanTask):
                 request.add_header(
                     "Authorization", "Basic %s" % encoded.decode("ascii")
                 )
+                request.add_header("Accept-Encoding", "gzip")
             except HTTPError as e:
                 logger.error("Error connecting to odoo at %s: %s" % (url, e))
                 raise e
 
             # Download and parse XML data
+            # The data is parsed while it's being downloaded.
+            starttime = time.time()
             with urlopen(request) as f:
-                frepple.readXMLdata(f.read().decode("utf-8"), False, False, loglevel)
+                stream = OdooStream(f)
+                try:
+                    frepple.readXMLdata(stream, False, False, loglevel)
+                finally:
+                    stream.close()
+            logger.info(
+                "Read %s bytes of Odoo data in %.2f seconds"
+                % (stream.size, time.time() - starttime)
+            )
         else:
-            # Download and parse XML data
-            with open(debugFile) as f:
-                frepple.readXMLdata(f.read(), False, False, loglevel)
+            # Parse XML data
+            with open(debugFile, "rb") as f:
+                frepple.readXMLdata(f, False, False, loglevel)
 
         # Hierarchy correction: Count how many items/locations/customers have no owner
         # If we find 2+ then we use All items/All customers/All locations as root
@@ -0,0 +1,108 @@
+#
+# Copyright (C) 2020 by frePPLe bv
+#
+# This library is free software; you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero
+# General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import gzip
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from threading import Thread
+from urllib.request import urlopen, Request
+
+from django.test import SimpleTestCase
+
+from freppledb.odoo.commands import OdooStream
+
+
+def generateXML(count):
+    yield '<?xml version="1.0" encoding="UTF-8" ?><plan><items>'
+    for i in range(count):
+        yield '<item name="item %s" description="Item number %s é"/>' % (i, i)
+    yield "</items></plan>"
+
+
+class OdooHandler(BaseHTTPRequestHandler):
+    """
+    Stand-in for the Odoo server, serving a large generated XML document.
+    """
+
+    data = "".join(generateXML(200000)).encode("utf-8")
+
+    def do_GET(self):
+        compress = "gzip" in (self.headers.get("Accept-Encoding") or "")
+        data = gzip.compress(self.data) if compress else self.data
+        self.send_response(200)
+        self.send_header("Content-Type", "application/xml")
+        if compress:
+            self.send_header("Content-Encoding", "gzip")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        for i in range(0, len(data), 10000):
+            self.wfile.write(data[i : i + 10000])
+
+    def log_message(self, format, *args):
+        pass
+
+
+class OdooStreamTest(SimpleTestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.server = HTTPServer(("localhost", 0), OdooHandler)
+        Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.url = "http://localhost:%s/frepple/xml" % cls.server.server_port
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+        super().tearDownClass()
+
+    def readStream(self, compressed, size):
+        request = Request(self.url)
+        if compressed:
+            request.add_header("Accept-Encoding", "gzip")
+        chunks = []
+        with urlopen(request) as f:
+            stream = OdooStream(f, chunksize=4096, maxchunks=4)
+            while True:
+                data = stream.read(size)
+                if not data:
+                    break
+                self.assertTrue(size < 0 or len(data) <= size)
+                chunks.append(data)
+        return b"".join(chunks), stream.size
+
+    def test_plain(self):
+        data, size = self.readStream(False, 65536)
+        self.assertEqual(data, OdooHandler.data)
+        self.assertEqual(size, len(OdooHandler.data))
+
+    def test_gzip(self):
+        data, size = self.readStream(True, 1000)
+        self.assertEqual(data, OdooHandler.data)
+        self.assertLess(size, len(OdooHandler.data))
+
+    def test_read_all(self):
+        data, size = self.readStream(True, -1)
+        self.assertEqual(data, OdooHandler.data)
+
+    def test_close(self):
+        # A parser that stops reading doesn't leave the download thread blocked
+        with urlopen(self.url) as f:
+            stream = OdooStream(f, chunksize=4096, maxchunks=4)
+            self.assertTrue(stream.read(100))
+            stream.close()
+        stream.thread.join(10)
+        self.assertFalse(stream.thread.is_alive())
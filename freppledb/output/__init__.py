@@ -21,3 +21,5 @@ An application that handles the frePPLe output.
 It defines the database structure to store the plan information and provides
 reports to summarize the results.
 """
+
+default_app_config = "freppledb.output.apps.OutputConfig"
@@ -0,0 +1,90 @@
+#
+# Copyright (C) 2020 by frePPLe bv
+#
+# This library is free software; you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero
+# General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+from django.apps import AppConfig
+from django.db.models.signals import post_save, pre_delete, pre_save
+
+
+# Fields of an operationplan that don't influence its material flows
+nonflow_fields = {"criticality", "delay", "plan", "color", "source", "lastmodified"}
+
+
+def markBufferSummaryPreSave(sender, instance, update_fields=None, **kwargs):
+    """
+    Marks the bucket summary of the current buffers of an operationplan
+    for refresh, before the save can move its material flows to other
+    buffers.
+    """
+    from freppledb.input.models import OperationPlan
+    from freppledb.output.models import BufferBucketRefresh
+
+    if (
+        not isinstance(instance, OperationPlan)
+        or not instance.reference
+        or instance._state.adding
+    ):
+        return
+    if update_fields is not None and not set(update_fields) - nonflow_fields:
+        return
+    BufferBucketRefresh.markOperationPlans(
+        [instance.reference], database=kwargs.get("using", instance._state.db)
+    )
+
+
+def markBufferSummary(sender, instance, update_fields=None, **kwargs):
+    """
+    Marks the bucket summary of the buffers of a saved operationplan
+    for refresh, once the transaction is committed.
+    """
+    from freppledb.input.models import OperationPlan
+    from freppledb.output.models import BufferBucketRefresh
+
+    if not isinstance(instance, OperationPlan) or not instance.reference:
+        return
+    if update_fields is not None and not set(update_fields) - nonflow_fields:
+        return
+    BufferBucketRefresh.markOperationPlanOnCommit(
+        instance.reference, database=kwargs.get("using", instance._state.db)
+    )
+
+
+def markBufferSummaryDelete(sender, instance, **kwargs):
+    """
+    Marks the bucket summary of the buffers of a deleted operationplan for
+    refresh. This is done immediately, before its material flows are deleted.
+    """
+    from freppledb.input.models import OperationPlan
+    from freppledb.output.models import BufferBucketRefresh
+
+    if isinstance(instance, OperationPlan) and instance.reference:
+        BufferBucketRefresh.markOperationPlans(
+            [instance.reference], database=kwargs.get("using", instance._state.db)
+        )
+
+
+class OutputConfig(AppConfig):
+    name = "freppledb.output"
+    verbose_name = "output"
+
+    def ready(self):
+        pre_save.connect(
+            markBufferSummaryPreSave, dispatch_uid="output_buffersummary_presave"
+        )
+        post_save.connect(markBufferSummary, dispatch_uid="output_buffersummary_save")
+        pre_delete.connect(
+            markBufferSummaryDelete, dispatch_uid="output_buffersummary_delete"
+        )
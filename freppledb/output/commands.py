@@ -19,21 +19,121 @@ from datetime import timedelta, datetime, date
 import json
 import logging
 import os
-from psycopg2.extensions import adapt
-from psycopg2.extras import execute_batch
+from queue import Queue
+from threading import Thread
+from time import time
+from zlib import crc32
 
 from django.db import connections, DEFAULT_DB_ALIAS, transaction
 
 from freppledb.common.commands import (
     PlanTaskRegistry,
     PlanTask,
-    clean_value,
-    CopyFromGenerator,
+    copy_records,
 )
+from freppledb.common.models import Parameter
+from freppledb.output.models import BufferBucketSummary, ResourceBucketSummary
 
 logger = logging.getLogger(__name__)
 
 
+def useBinaryCopy(database=DEFAULT_DB_ALIAS):
+    """
+    The plan is exported with binary COPY commands, unless the parameter
+    plan.export.copyformat is set to "text".
+    """
+    return (
+        Parameter.getValue("plan.export.copyformat", database, "binary").lower()
+        != "text"
+    )
+
+
+def useIncrementalExport(database=DEFAULT_DB_ALIAS, cluster=-1):
+    """
+    When the parameter plan.export.incremental is set to "true", a complete
+    export only writes the operationplans, operationplanmaterials and
+    operationplanresources that were inserted, changed or deleted since the
+    previous export. Unchanged records are left untouched.
+    A partial export for a single cluster always rewrites the cluster.
+    """
+    return (
+        cluster == -1
+        and Parameter.getValue("plan.export.incremental", database, "false")
+        .strip()
+        .lower()
+        == "true"
+    )
+
+
+def exportIncremental(cursor, table, key, columns, types, records, binary=True):
+    """
+    Merges the records into a table, only touching the rows of the keys
+    for which the set of records changed.
+
+    The records are copied in a temporary table, which is compared with the
+    table contents. For the keys with any difference, all rows are deleted and
+    inserted again. The lastmodified field isn't taken into account.
+    """
+    tmp = "tmp_%s" % table
+    compared = ",".join(c for c in columns if c != "lastmodified")
+    cursor.execute(
+        "create temporary table %s as select %s from %s with no data"
+        % (tmp, ",".join(columns), table)
+    )
+    copy_records(cursor, tmp, columns, types, records, binary=binary)
+    cursor.execute(
+        """
+        create temporary table %s_changed as
+        select distinct %s as key
+        from (
+          (select %s from %s except all select %s from %s)
+          union all
+          (select %s from %s except all select %s from %s)
+        ) diff
+        """
+        % (
+            tmp,
+            key,
+            compared,
+            tmp,
+            compared,
+            table,
+            compared,
+            table,
+            compared,
+            tmp,
+        )
+    )
+    cursor.execute(
+        "delete from %s using %s_changed where %s.%s = %s_changed.key"
+        % (table, tmp, table, key, tmp)
+    )
+    deleted = cursor.rowcount
+    cursor.execute(
+        """
+        insert into %s (%s)
+        select %s from %s
+        inner join %s_changed on %s.%s = %s_changed.key
+        """
+        % (
+            table,
+            ",".join(columns),
+            ",".join("%s.%s" % (tmp, c) for c in columns),
+            tmp,
+            tmp,
+            tmp,
+            key,
+            tmp,
+        )
+    )
+    inserted = cursor.rowcount
+    cursor.execute("drop table %s, %s_changed" % (tmp, tmp))
+    logger.info(
+        "Incremental export of %s: %d records deleted, %d records inserted"
+        % (table, deleted, inserted)
+    )
+
+
 @PlanTaskRegistry.register
 class TruncatePlan(PlanTask):
 
@@ -53,10 +153,17 @@ class TruncatePlan(PlanTask):
         import frepple
 
         cursor = connections[database].cursor()
-        if cluster == -1:
+        if useIncrementalExport(database, cluster):
+            # Incremental export: the export tasks compute the differences
+            # with the operationplans, operationplanmaterials and
+            # operationplanresources already in the database.
+            cursor.execute(
+                "truncate table out_problem, out_resourceplan, out_constraint, out_pegging"
+            )
+        elif cluster == -1:
             # Complete export for the complete model
             cursor.execute(
-                "truncate table out_problem, out_resourceplan, out_constraint"
+                "truncate table out_problem, out_resourceplan, out_constraint, out_pegging"
             )
             cursor.execute(
                 """
@@ -84,123 +191,125 @@ class TruncatePlan(PlanTask):
             )
         else:
             # Partial export for a single cluster
-            cursor.execute(
-                "create temporary table cluster_keys (name character varying(300), constraint cluster_key_pkey primary key (name))"
-            )
-            for i in frepple.items():
-                if i.cluster == cluster:
-                    cursor.execute(
-                        (
-                            "insert into cluster_keys (name) values (%s);\n"
-                            % adapt(i.name).getquoted().decode("UTF8")
-                        )
-                    )
+            # The keys of the items, resources and operations in the cluster
+            # are sent in bulk, with a single COPY statement per entity type.
+            binary = useBinaryCopy(database)
+            for tablename, entities in (
+                ("cluster_items", frepple.items()),
+                ("cluster_resources", frepple.resources()),
+                ("cluster_operations", frepple.operations()),
+            ):
+                cursor.execute(
+                    "create temporary table %s (name character varying(300), constraint %s_pkey primary key (name))"
+                    % (tablename, tablename)
+                )
+                copy_records(
+                    cursor,
+                    tablename,
+                    ["name"],
+                    ["text"],
+                    ((i.name,) for i in entities if i.cluster == cluster),
+                    binary=binary,
+                )
+                cursor.execute("analyze %s" % tablename)
+
             cursor.execute(
                 """
                 delete from out_constraint
-                where demand in (
-                  select demand.name
-                  from demand
-                  inner join cluster_keys
-                    on cluster_keys.name = demand.item_id
-                  )
+                using demand, cluster_items
+                where out_constraint.demand = demand.name
+                and demand.item_id = cluster_items.name
                 """
             )
-
             cursor.execute(
                 """
-                delete from out_problem
-                where entity = 'demand' and owner in (
-                  select demand.name from demand inner join cluster_keys on cluster_keys.name = demand.item_id
-                  )
+                delete from out_pegging
+                using demand, cluster_items
+                where out_pegging.demand = demand.name
+                and demand.item_id = cluster_items.name
                 """
             )
             cursor.execute(
                 """
                 delete from out_problem
-                where entity = 'material'
-                and owner in (
-                   select buffer.item_id || ' @ ' || buffer.location_id
-                   from buffer
-                   inner join cluster_keys on cluster_keys.name = buffer.item_id
-                   )
+                using demand, cluster_items
+                where out_problem.entity = 'demand'
+                and out_problem.owner = demand.name
+                and demand.item_id = cluster_items.name
                 """
             )
-
             cursor.execute(
                 """
-                delete from operationplan
-                using cluster_keys
-                where owner_id in (
-                  select oplan_parent.reference
-                  from operationplan as oplan_parent
-                  where (oplan_parent.status='proposed' or oplan_parent.status is null or oplan_parent.type='STCK')
-                  and oplan_parent.item_id = cluster_keys.name
-                  )
+                delete from out_problem
+                using buffer, cluster_items
+                where out_problem.entity = 'material'
+                and out_problem.owner = buffer.item_id || ' @ ' || buffer.location_id
+                and buffer.item_id = cluster_items.name
                 """
             )
             cursor.execute(
                 """
-                delete from operationplan
-                using cluster_keys
-                where (status='proposed' or status is null or type='STCK')
-                and item_id = cluster_keys.name
+                delete from out_problem
+                using cluster_resources
+                where entity = 'capacity' and owner = cluster_resources.name
                 """
             )
-            cursor.execute("truncate table cluster_keys")
-            for i in frepple.resources():
-                if i.cluster == cluster:
-                    cursor.execute(
-                        (
-                            "insert into cluster_keys (name) values (%s)"
-                            % adapt(i.name).getquoted().decode("UTF8")
-                        )
-                    )
             cursor.execute(
                 """
                 delete from out_problem
-                where entity = 'demand'
-                and owner in (
-                  select demand.name
-                  from demand
-                  inner join cluster_keys on cluster_keys.name = demand.item_id
-                  )
+                using cluster_operations
+                where entity = 'operation' and owner = cluster_operations.name
                 """
             )
             cursor.execute(
-                "delete from operationplanresource using cluster_keys where resource_id = cluster_keys.name"
+                """
+                delete from out_resourceplan
+                using cluster_resources
+                where resource = cluster_resources.name
+                """
             )
             cursor.execute(
-                "delete from out_resourceplan using cluster_keys where resource = cluster_keys.name"
+                """
+                delete from operationplanresource
+                using cluster_resources
+                where resource_id = cluster_resources.name
+                """
             )
             cursor.execute(
-                "delete from out_problem using cluster_keys where entity = 'capacity' and owner = cluster_keys.name"
+                """
+                with parents as (
+                  select oplan_parent.reference
+                  from operationplan as oplan_parent
+                  inner join cluster_items
+                    on oplan_parent.item_id = cluster_items.name
+                  where oplan_parent.status = 'proposed'
+                    or oplan_parent.status is null
+                    or oplan_parent.type = 'STCK'
+                  )
+                delete from operationplan
+                using parents
+                where operationplan.owner_id = parents.reference
+                """
             )
-            cursor.execute("truncate table cluster_keys")
-            for i in frepple.operations():
-                if i.cluster == cluster:
-                    cursor.execute(
-                        (
-                            "insert into cluster_keys (name) values (%s)"
-                            % adapt(i.name).getquoted().decode("UTF8")
-                        )
-                    )
             cursor.execute(
-                """"
-                delete from out_problem
-                using cluster_keys
-                where entity = 'operation' and owner = cluster_keys.name
+                """
+                delete from operationplan
+                using cluster_items
+                where (status = 'proposed' or status is null or type = 'STCK')
+                and item_id = cluster_items.name
                 """
             )
             cursor.execute(
                 """
                 delete from operationplan
-                using cluster_keys
-                where (status='proposed' or status is null)
-                and operationplan.name = cluster_keys.name
+                using cluster_operations
+                where (status = 'proposed' or status is null)
+                and operationplan.name = cluster_operations.name
                 """
             )
-            cursor.execute("drop table cluster_keys")
+            cursor.execute(
+                "drop table cluster_items, cluster_resources, cluster_operations"
+            )
 
 
 @PlanTaskRegistry.register
@@ -259,33 +368,36 @@ class ExportProblems(PlanTask):
                 owner = i.owner
             if cluster != -1 and owner.cluster != cluster:
                 continue
-            yield "%s\v%s\v%s\v%s\v%s\v%s\v%s\n" % (
-                clean_value(i.entity),
-                clean_value(i.name),
-                clean_value(owner.name),
-                clean_value(i.description),
-                str(i.start),
-                str(i.end),
+            yield (
+                i.entity,
+                i.name,
+                owner.name,
+                i.description,
+                i.start,
+                i.end,
                 round(i.weight, 8),
             )
 
+    columns = (
+        ("entity", "text"),
+        ("name", "text"),
+        ("owner", "text"),
+        ("description", "text"),
+        ("startdate", "timestamp"),
+        ("enddate", "timestamp"),
+        ("weight", "numeric"),
+    )
+
     @classmethod
     def run(cls, cluster=-1, database=DEFAULT_DB_ALIAS, **kwargs):
         cursor = connections[database].cursor()
-        cursor.copy_from(
-            CopyFromGenerator(cls.getData(cluster)),
+        copy_records(
+            cursor,
             "out_problem",
-            columns=(
-                "entity",
-                "name",
-                "owner",
-                "description",
-                "startdate",
-                "enddate",
-                "weight",
-            ),
-            size=1024,
-            sep="\v",
+            [c[0] for c in cls.columns],
+            [c[1] for c in cls.columns],
+            cls.getData(cluster),
+            binary=useBinaryCopy(database),
         )
 
 
@@ -311,45 +423,44 @@ class ExportConstraints(PlanTask):
             if cluster != -1 and cluster != d.cluster:
                 continue
             for i in d.constraints:
-                yield "%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\n" % (
-                    clean_value(d.name)
-                    if isinstance(d, frepple.demand_default)
-                    else "\\N",
-                    "\\N"
-                    if isinstance(d, frepple.demand_default)
-                    else clean_value(d.owner.name),
-                    clean_value(d.item.name),
-                    clean_value(i.entity),
-                    clean_value(i.name),
+                yield (
+                    d.name if isinstance(d, frepple.demand_default) else None,
+                    None if isinstance(d, frepple.demand_default) else d.owner.name,
+                    d.item.name,
+                    i.entity,
+                    i.name,
                     isinstance(i.owner, frepple.operationplan)
-                    and clean_value(i.owner.operation.name)
-                    or clean_value(i.owner.name),
-                    clean_value(i.description),
-                    str(i.start),
-                    str(i.end),
+                    and i.owner.operation.name
+                    or i.owner.name,
+                    i.description,
+                    i.start,
+                    i.end,
                     round(i.weight, 8),
                 )
 
+    columns = (
+        ("demand", "text"),
+        ("forecast", "text"),
+        ("item", "text"),
+        ("entity", "text"),
+        ("name", "text"),
+        ("owner", "text"),
+        ("description", "text"),
+        ("startdate", "timestamp"),
+        ("enddate", "timestamp"),
+        ("weight", "numeric"),
+    )
+
     @classmethod
     def run(cls, cluster=-1, database=DEFAULT_DB_ALIAS, **kwargs):
         cursor = connections[database].cursor()
-        cursor.copy_from(
-            CopyFromGenerator(cls.getData(cluster=cluster)),
+        copy_records(
+            cursor,
             "out_constraint",
-            columns=(
-                "demand",
-                "forecast",
-                "item",
-                "entity",
-                "name",
-                "owner",
-                "description",
-                "startdate",
-                "enddate",
-                "weight",
-            ),
-            size=1024,
-            sep="\v",
+            [c[0] for c in cls.columns],
+            [c[1] for c in cls.columns],
+            cls.getData(cluster=cluster),
+            binary=useBinaryCopy(database),
         )
 
 
@@ -405,15 +516,24 @@ class ExportOperationPlans(PlanTask):
                 pln["item"] = buffer.item.name
             if buffer.location:
                 pln["location"] = buffer.location.name
-        # We need to double any backslash to assure that the string remains
-        # valid when passing it through postgresql (which eats them away)
-        return json.dumps(pln).replace("\\", "\\\\")
+        return json.dumps(pln)
+
+    @staticmethod
+    def getShard(operation, shards, sharding="hash"):
+        """
+        Returns the shard number an operation is exported in.
+        All operationplans of an operation always end up in the same shard.
+        """
+        if sharding == "cluster":
+            return operation.cluster % shards
+        else:
+            return crc32(operation.name.encode("utf-8")) % shards
 
     @classmethod
-    def getData(cls, timestamp, cluster=-1):
+    def getData(cls, timestamp, cluster=-1, operations=None):
         import frepple
 
-        for i in frepple.operations():
+        for i in frepple.operations() if operations is None else operations:
             if cluster != -1 and cluster != i.cluster:
                 continue
 
@@ -428,227 +548,264 @@ class ExportOperationPlans(PlanTask):
 
                 if isinstance(i, frepple.operation_inventory):
                     # Export inventory
-                    yield "%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\n" % (
-                        clean_value(i.name),
+                    yield (
+                        i.name,
                         "STCK",
                         status,
                         round(j.quantity, 8),
-                        str(j.start),
-                        str(j.end),
+                        j.start,
+                        j.end,
                         round(j.criticality, 8),
                         j.delay,
                         cls.getPegging(j),
-                        clean_value(j.source),
+                        j.source,
                         timestamp,
-                        "\\N",
-                        clean_value(j.owner.reference)
+                        None,
+                        j.owner.reference
                         if j.owner and not j.owner.operation.hidden
-                        else "\\N",
-                        clean_value(j.operation.buffer.item.name),
-                        clean_value(j.operation.buffer.location.name),
-                        "\\N",
-                        "\\N",
-                        "\\N",
-                        clean_value(j.demand.name)
+                        else None,
+                        j.operation.buffer.item.name,
+                        j.operation.buffer.location.name,
+                        None,
+                        None,
+                        None,
+                        j.demand.name
                         if j.demand
-                        else clean_value(j.owner.demand.name)
+                        else j.owner.demand.name
                         if j.owner and j.owner.demand
-                        else "\\N",
+                        else None,
                         j.demand.due
                         if j.demand
                         else j.owner.demand.due
                         if j.owner and j.owner.demand
-                        else "\\N",
-                        "\\N",  # color is empty for stock
-                        clean_value(j.reference),
-                        clean_value(j.batch),
+                        else None,
+                        None,  # color is empty for stock
+                        j.reference,
+                        j.batch,
                     )
                 elif isinstance(i, frepple.operation_itemdistribution):
                     # Export DO
-                    yield "%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\n" % (
-                        clean_value(i.name),
+                    yield (
+                        i.name,
                         "DO",
                         status,
                         round(j.quantity, 8),
-                        str(j.start),
-                        str(j.end),
+                        j.start,
+                        j.end,
                         round(j.criticality, 8),
                         j.delay,
                         cls.getPegging(j),
-                        clean_value(j.source),
+                        j.source,
                         timestamp,
-                        "\\N",
-                        clean_value(j.owner.reference)
+                        None,
+                        j.owner.reference
                         if j.owner and not j.owner.operation.hidden
-                        else "\\N",
-                        clean_value(j.operation.destination.item.name)
+                        else None,
+                        j.operation.destination.item.name
                         if j.operation.destination
                         else j.operation.origin.item.name,
-                        clean_value(j.operation.destination.location.name)
+                        j.operation.destination.location.name
                         if j.operation.destination
-                        else "\\N",
-                        clean_value(j.operation.origin.location.name)
+                        else None,
+                        j.operation.origin.location.name
                         if j.operation.origin
-                        else "\\N",
-                        "\\N",
-                        "\\N",
-                        clean_value(j.demand.name)
+                        else None,
+                        None,
+                        None,
+                        j.demand.name
                         if j.demand
-                        else clean_value(j.owner.demand.name)
+                        else j.owner.demand.name
                         if j.owner and j.owner.demand
-                        else "\\N",
+                        else None,
                         j.demand.due
                         if j.demand
                         else j.owner.demand.due
                         if j.owner and j.owner.demand
-                        else "\\N",
+                        else None,
                         color
                         if (proposedFound is False and status == "proposed")
                         or (status == "proposed" and j.start == proposedFoundDate)
                         or status in ("confirmed", "approved")
-                        else "\\N",  # color
-                        clean_value(j.reference),
-                        clean_value(j.batch),
+                        else None,  # color
+                        j.reference,
+                        j.batch,
                     )
                 elif isinstance(i, frepple.operation_itemsupplier):
                     # Export PO
-                    yield "%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\n" % (
-                        clean_value(i.name),
+                    yield (
+                        i.name,
                         "PO",
                         status,
                         round(j.quantity, 8),
-                        str(j.start),
-                        str(j.end),
+                        j.start,
+                        j.end,
                         round(j.criticality, 8),
                         j.delay,
                         cls.getPegging(j),
-                        clean_value(j.source),
+                        j.source,
                         timestamp,
-                        "\\N",
-                        clean_value(j.owner.reference)
+                        None,
+                        j.owner.reference
                         if j.owner and not j.owner.operation.hidden
-                        else "\\N",
-                        clean_value(j.operation.buffer.item.name),
-                        "\\N",
-                        "\\N",
-                        clean_value(j.operation.buffer.location.name),
-                        clean_value(j.operation.itemsupplier.supplier.name),
-                        clean_value(j.demand.name)
+                        else None,
+                        j.operation.buffer.item.name,
+                        None,
+                        None,
+                        j.operation.buffer.location.name,
+                        j.operation.itemsupplier.supplier.name,
+                        j.demand.name
                         if j.demand
-                        else clean_value(j.owner.demand.name)
+                        else j.owner.demand.name
                         if j.owner and j.owner.demand
-                        else "\\N",
+                        else None,
                         j.demand.due
                         if j.demand
                         else j.owner.demand.due
                         if j.owner and j.owner.demand
-                        else "\\N",
+                        else None,
                         color
                         if (proposedFound is False and status == "proposed")
                         or (status == "proposed" and j.start == proposedFoundDate)
                         or status in ("confirmed", "approved")
-                        else "\\N",  # color
-                        clean_value(j.reference),
-                        clean_value(j.batch),
+                        else None,  # color
+                        j.reference,
+                        j.batch,
                     )
                 elif not i.hidden:
                     # Export MO
-                    yield "%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\n" % (
-                        clean_value(i.name),
+                    yield (
+                        i.name,
                         "MO",
                         status,
                         round(j.quantity, 8),
-                        str(j.start),
-                        str(j.end),
+                        j.start,
+                        j.end,
                         round(j.criticality, 8),
                         j.delay,
                         cls.getPegging(j),
-                        clean_value(j.source),
+                        j.source,
                         timestamp,
-                        clean_value(i.name),
-                        clean_value(j.owner.reference)
+                        i.name,
+                        j.owner.reference
                         if j.owner and not j.owner.operation.hidden
-                        else "\\N",
-                        clean_value(i.item.name)
+                        else None,
+                        i.item.name
                         if i.item
-                        else clean_value(i.owner.item.name)
+                        else i.owner.item.name
                         if i.owner and i.owner.item
-                        else clean_value(j.demand.item.name)
+                        else j.demand.item.name
                         if j.demand and j.demand.item
-                        else clean_value(j.owner.demand.item.name)
+                        else j.owner.demand.item.name
                         if j.owner and j.owner.demand and j.owner.demand.item
-                        else "\\N",
-                        "\\N",
-                        "\\N",
-                        clean_value(i.location.name) if i.location else "\\N",
-                        "\\N",
-                        clean_value(j.demand.name)
+                        else None,
+                        None,
+                        None,
+                        i.location.name if i.location else None,
+                        None,
+                        j.demand.name
                         if j.demand
-                        else clean_value(j.owner.demand.name)
+                        else j.owner.demand.name
                         if j.owner and j.owner.demand
-                        else "\\N",
+                        else None,
                         j.demand.due
                         if j.demand
                         else j.owner.demand.due
                         if j.owner and j.owner.demand
-                        else "\\N",
+                        else None,
                         color
                         if (proposedFound is False and status == "proposed")
                         or (status == "proposed" and j.start == proposedFoundDate)
                         or status in ("confirmed", "approved")
-                        else "\\N",  # color
-                        clean_value(j.reference),
-                        clean_value(j.batch),
+                        else None,  # color
+                        j.reference,
+                        j.batch,
                     )
                 elif j.demand or (j.owner and j.owner.demand):
                     # Export shipments (with automatically created delivery operations)
-                    yield "%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\n" % (
-                        clean_value(i.name),
+                    yield (
+                        i.name,
                         "DLVR",
                         status,
                         round(j.quantity, 8),
-                        str(j.start),
-                        str(j.end),
+                        j.start,
+                        j.end,
                         round(j.criticality, 8),
                         j.delay,
                         cls.getPegging(j),
-                        clean_value(j.source),
+                        j.source,
                         timestamp,
-                        "\\N",
-                        clean_value(j.owner.reference)
+                        None,
+                        j.owner.reference
                         if j.owner and not j.owner.operation.hidden
-                        else "\\N",
-                        clean_value(j.operation.buffer.item.name),
-                        "\\N",
-                        "\\N",
-                        clean_value(j.operation.buffer.location.name),
-                        "\\N",
-                        clean_value(j.demand.name)
+                        else None,
+                        j.operation.buffer.item.name,
+                        None,
+                        None,
+                        j.operation.buffer.location.name,
+                        None,
+                        j.demand.name
                         if j.demand
-                        else clean_value(j.owner.demand.name)
+                        else j.owner.demand.name
                         if j.owner and j.owner.demand
-                        else "\\N",
+                        else None,
                         j.demand.due
                         if j.demand
                         else j.owner.demand.due
                         if j.owner and j.owner.demand
-                        else "\\N",
-                        "\\N",  # color is empty for deliver operation
-                        clean_value(j.reference),
-                        clean_value(j.batch),
+                        else None,
+                        None,  # color is empty for deliver operation
+                        j.reference,
+                        j.batch,
                     )
 
                 if status == "proposed":
                     proposedFound = True
                     proposedFoundDate = j.start
 
+    columns = (
+        ("name", "text"),
+        ("type", "text"),
+        ("status", "text"),
+        ("quantity", "numeric"),
+        ("startdate", "timestamp"),
+        ("enddate", "timestamp"),
+        ("criticality", "numeric"),
+        ("delay", "numeric"),
+        ("plan", "json"),
+        ("source", "text"),
+        ("lastmodified", "timestamp"),
+        ("operation_id", "text"),
+        ("owner_id", "text"),
+        ("item_id", "text"),
+        ("destination_id", "text"),
+        ("origin_id", "text"),
+        ("location_id", "text"),
+        ("supplier_id", "text"),
+        ("demand_id", "text"),
+        ("due", "timestamp"),
+        ("color", "numeric"),
+        ("reference", "text"),
+        ("batch", "text"),
+    )
+
     @classmethod
-    def run(cls, cluster=-1, database=DEFAULT_DB_ALIAS, **kwargs):
-        # Export operationplans to a temporary table
-        cursor = connections[database].cursor()
+    def copyToTempTable(
+        cls, cursor, records, tablename="tmp_operationplan", binary=True
+    ):
+        copy_records(
+            cursor,
+            tablename,
+            [c[0] for c in cls.columns],
+            [c[1] for c in cls.columns],
+            records,
+            binary=binary,
+        )
+
+    @staticmethod
+    def createTempTable(cursor, tablename="tmp_operationplan"):
         cursor.execute(
             """
-            create temporary table tmp_operationplan (
+            create temporary table %s (
                 name character varying(1000),
                 type character varying(5) NOT NULL,
                 status character varying(20),
@@ -674,15 +831,18 @@ class ExportOperationPlans(PlanTask):
                 batch character varying(300)
             )
             """
-        )
-        cursor.copy_from(
-            CopyFromGenerator(cls.getData(cls.parent.timestamp, cluster=cluster)),
-            table="tmp_operationplan",
-            size=1024,
-            sep="\v",
+            % tablename
         )
 
-        # Merge temp table into the actual table
+    @staticmethod
+    def updateFromTempTable(cursor, tablename="tmp_operationplan", incremental=False):
+        """
+        Updates the existing operationplans.
+        In incremental mode only the operationplans with a different
+        fingerprint are updated. The fingerprint is the tuple of all exported
+        fields, including the pegging information in the plan field, but
+        excluding the lastmodified timestamp.
+        """
         cursor.execute(
             """
             update operationplan
@@ -694,19 +854,38 @@ class ExportOperationPlans(PlanTask):
                 item_id=tmp.item_id, destination_id=tmp.destination_id, origin_id=tmp.origin_id,
                 location_id=tmp.location_id, supplier_id=tmp.supplier_id, demand_id=tmp.demand_id,
                 due=tmp.due, color=tmp.color, batch=tmp.batch
-            from tmp_operationplan as tmp
-            where operationplan.reference = tmp.reference;
-            """
-        )
-        cursor.execute(
-            """
-            delete from operationplan
-            where status in ('confirmed','approved','completed')
-            and type = 'MO'
-            and not exists (select 1 from tmp_operationplan where reference = operationplan.reference)
+            from %s as tmp
+            where operationplan.reference = tmp.reference %s;
             """
+            % (
+                tablename,
+                """
+                and (
+                  operationplan.name, operationplan.type, operationplan.status,
+                  operationplan.quantity, operationplan.startdate, operationplan.enddate,
+                  operationplan.criticality, operationplan.delay, operationplan.plan,
+                  operationplan.source, operationplan.operation_id, operationplan.owner_id,
+                  operationplan.item_id, operationplan.destination_id, operationplan.origin_id,
+                  operationplan.location_id, operationplan.supplier_id, operationplan.demand_id,
+                  operationplan.due, operationplan.color, operationplan.batch
+                ) is distinct from (
+                  tmp.name, tmp.type, tmp.status,
+                  tmp.quantity, tmp.startdate, tmp.enddate,
+                  tmp.criticality, tmp.delay * interval '1 second', tmp.plan::jsonb,
+                  tmp.source, tmp.operation_id, tmp.owner_id,
+                  tmp.item_id, tmp.destination_id, tmp.origin_id,
+                  tmp.location_id, tmp.supplier_id, tmp.demand_id,
+                  tmp.due, tmp.color, tmp.batch
+                )
+                """
+                if incremental
+                else "",
+            )
         )
+        return cursor.rowcount
 
+    @staticmethod
+    def insertFromTempTable(cursor, tablename="tmp_operationplan"):
         cursor.execute(
             """
             insert into operationplan
@@ -722,14 +901,275 @@ class ExportOperationPlans(PlanTask):
               item_id,destination_id,origin_id,
               location_id,supplier_id,
               demand_id,due,color,reference,batch
-            from tmp_operationplan
+            from %s
             where not exists (
               select 1
               from operationplan
-              where operationplan.reference = tmp_operationplan.reference
+              where operationplan.reference = %s.reference
               );
             """
+            % (tablename, tablename)
         )
+        return cursor.rowcount
+
+    @staticmethod
+    def deleteObsolete(cursor, tablename="tmp_operationplan"):
+        """
+        Deletes the operationplans managed by the export that weren't
+        exported any longer, ie proposed operationplans, stock operationplans
+        and confirmed manufacturing orders.
+        The table passed as argument contains the references of all exported
+        operationplans.
+        """
+        cursor.execute(
+            """
+            create temporary table tmp_obsolete as
+            select reference
+            from operationplan
+            where (
+              status = 'proposed' or status is null or type = 'STCK'
+              or (status in ('confirmed','approved','completed') and type = 'MO')
+              )
+            and not exists (
+              select 1 from %s where %s.reference = operationplan.reference
+              )
+            """
+            % (tablename, tablename)
+        )
+        cursor.execute(
+            """
+            update operationplan
+            set owner_id = null
+            where owner_id in (select reference from tmp_obsolete)
+            """
+        )
+        cursor.execute(
+            """
+            delete from operationplan
+            using tmp_obsolete
+            where operationplan.reference = tmp_obsolete.reference
+            """
+        )
+        deleted = cursor.rowcount
+        cursor.execute("drop table tmp_obsolete")
+        return deleted
+
+    class _ExportShardThread(Thread):
+        """
+        Copies the operationplans of a single shard over its own database
+        connection, and merges them into the operationplan table.
+
+        The rows are generated in the main thread and handed over in batches
+        through a queue: the engine is never accessed from this thread.
+        """
+
+        def __init__(self, task, shard, database, incremental=False):
+            super().__init__()
+            self.task = task
+            self.shard = shard
+            self.database = database
+            self.incremental = incremental
+            self.queue = Queue(maxsize=10)
+            self.finished = False
+            self.aborted = False
+            self.exception = None
+            self.rows = 0
+            self.references = []
+
+        def getData(self):
+            while True:
+                batch = self.queue.get()
+                if batch is None:
+                    self.finished = True
+                    if self.aborted:
+                        raise Exception("Export aborted")
+                    return
+                for rec in batch:
+                    self.rows += 1
+                    if self.incremental:
+                        self.references.append((rec[21],))
+                    yield rec
+
+        def run(self):
+            try:
+                start = time()
+                tablename = "tmp_operationplan_%s" % self.shard
+                with connections[self.database].cursor() as cursor:
+                    self.task.createTempTable(cursor, tablename)
+                    self.task.copyToTempTable(
+                        cursor,
+                        self.getData(),
+                        tablename=tablename,
+                        binary=useBinaryCopy(self.database),
+                    )
+                    copied = time()
+                    self.task.updateFromTempTable(
+                        cursor, tablename, incremental=self.incremental
+                    )
+                    self.task.insertFromTempTable(cursor, tablename)
+                    cursor.execute("drop table %s" % tablename)
+                duration = time() - start
+                logger.info(
+                    "Shard %s: exported %d operationplans in %.2f seconds (%d rows/s, merge %.2f seconds)"
+                    % (
+                        self.shard,
+                        self.rows,
+                        duration,
+                        self.rows / (copied - start) if copied > start else 0,
+                        time() - copied,
+                    )
+                )
+            except Exception as e:
+                self.exception = e
+                # Keep consuming the batches, to avoid blocking the main thread
+                while not self.finished:
+                    if self.queue.get() is None:
+                        self.finished = True
+            finally:
+                connections[self.database].close()
+
+    @classmethod
+    def runSharded(
+        cls,
+        shards,
+        sharding,
+        cluster=-1,
+        database=DEFAULT_DB_ALIAS,
+        incremental=False,
+        batchsize=1000,
+    ):
+        """
+        Export the operationplans in parallel shards, each using its own
+        connection, COPY stream and merge statements.
+        The rows are generated only once, in the calling thread, and
+        distributed over the shards.
+        """
+        import frepple
+
+        threads = [
+            cls._ExportShardThread(cls, i, database, incremental=incremental)
+            for i in range(shards)
+        ]
+        for t in threads:
+            t.start()
+        batches = [[] for t in threads]
+        try:
+            for op in frepple.operations():
+                if cluster != -1 and cluster != op.cluster:
+                    continue
+                shard = cls.getShard(op, shards, sharding)
+                batches[shard].extend(
+                    cls.getData(cls.parent.timestamp, operations=(op,))
+                )
+                if len(batches[shard]) >= batchsize:
+                    threads[shard].queue.put(batches[shard])
+                    batches[shard] = []
+            for t, batch in zip(threads, batches):
+                if batch:
+                    t.queue.put(batch)
+        except Exception:
+            for t in threads:
+                t.aborted = True
+            raise
+        finally:
+            for t in threads:
+                t.queue.put(None)
+            for t in threads:
+                t.join()
+        for t in threads:
+            if t.exception:
+                logger.error("Exception caught on export shard %s" % t.shard)
+                raise t.exception
+
+        cursor = connections[database].cursor()
+        if incremental:
+            # Unchanged operationplans keep their lastmodified timestamp, so
+            # we collect the references exported by the shards instead.
+            cursor.execute(
+                "create temporary table tmp_operationplan_refs (reference character varying(300))"
+            )
+            copy_records(
+                cursor,
+                "tmp_operationplan_refs",
+                ["reference"],
+                ["text"],
+                (r for t in threads for r in t.references),
+                binary=useBinaryCopy(database),
+            )
+            deleted = cls.deleteObsolete(cursor, "tmp_operationplan_refs")
+            cursor.execute("drop table tmp_operationplan_refs")
+            logger.info("Incremental export: %d operationplans deleted" % deleted)
+            return
+
+        # Confirmed manufacturing orders that weren't exported by any shard
+        # are no longer present in the plan
+        cursor.execute(
+            """
+            delete from operationplan
+            where status in ('confirmed','approved','completed')
+            and type = 'MO'
+            and lastmodified is distinct from %s
+            """,
+            (cls.parent.timestamp,),
+        )
+
+    @classmethod
+    def run(cls, cluster=-1, database=DEFAULT_DB_ALIAS, **kwargs):
+        try:
+            shards = int(Parameter.getValue("plan.export.shards", database, "1"))
+        except ValueError:
+            shards = 1
+        incremental = useIncrementalExport(database, cluster)
+        if shards > 1:
+            sharding = Parameter.getValue("plan.export.sharding", database, "hash")
+            cls.runSharded(
+                shards,
+                sharding,
+                cluster=cluster,
+                database=database,
+                incremental=incremental,
+            )
+            cursor = connections[database].cursor()
+        elif incremental:
+            # Export operationplans to a temporary table
+            cursor = connections[database].cursor()
+            cls.createTempTable(cursor)
+            cls.copyToTempTable(
+                cursor,
+                cls.getData(cls.parent.timestamp, cluster=cluster),
+                binary=useBinaryCopy(database),
+            )
+
+            # Only write the differences to the actual table
+            updated = cls.updateFromTempTable(cursor, incremental=True)
+            inserted = cls.insertFromTempTable(cursor)
+            deleted = cls.deleteObsolete(cursor)
+            cursor.execute("drop table tmp_operationplan")
+            logger.info(
+                "Incremental export: %d operationplans updated, %d inserted, %d deleted"
+                % (updated, inserted, deleted)
+            )
+        else:
+            # Export operationplans to a temporary table
+            cursor = connections[database].cursor()
+            cls.createTempTable(cursor)
+            cls.copyToTempTable(
+                cursor,
+                cls.getData(cls.parent.timestamp, cluster=cluster),
+                binary=useBinaryCopy(database),
+            )
+
+            # Merge temp table into the actual table
+            cls.updateFromTempTable(cursor)
+            cursor.execute(
+                """
+                delete from operationplan
+                where status in ('confirmed','approved','completed')
+                and type = 'MO'
+                and not exists (select 1 from tmp_operationplan where reference = operationplan.reference)
+                """
+            )
+            cls.insertFromTempTable(cursor)
 
         # update demand table specific fields
         cursor.execute(
@@ -746,6 +1186,8 @@ class ExportOperationPlans(PlanTask):
               deliverydate = cte.deliverydate
             from cte
             where cte.demand_id = demand.name
+            and (demand.delay, demand.plannedquantity, demand.deliverydate)
+              is distinct from (cte.delay, cte.plannedquantity, cte.deliverydate)
             """
         )
         cursor.execute(
@@ -804,12 +1246,12 @@ class ExportOperationPlanMaterials(PlanTask):
                         )
                     )
                 else:
-                    yield "%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\n" % (
-                        clean_value(j.operationplan.reference),
-                        clean_value(j.buffer.item.name),
-                        clean_value(j.buffer.location.name),
+                    yield (
+                        j.operationplan.reference,
+                        j.buffer.item.name,
+                        j.buffer.location.name,
                         round(j.quantity, 8),
-                        str(j.date),
+                        j.date,
                         round(j.onhand, 8),
                         round(j.minimum, 8),
                         round(j.period_of_cover, 8),
@@ -817,32 +1259,41 @@ class ExportOperationPlanMaterials(PlanTask):
                         timestamp,
                     )
 
+    columns = (
+        ("operationplan_id", "text"),
+        ("item_id", "text"),
+        ("location_id", "text"),
+        ("quantity", "numeric"),
+        ("flowdate", "timestamp"),
+        ("onhand", "numeric"),
+        ("minimum", "numeric"),
+        ("periodofcover", "numeric"),
+        ("status", "text"),
+        ("lastmodified", "timestamp"),
+    )
+
     @classmethod
     def run(cls, cluster=-1, database=DEFAULT_DB_ALIAS, **kwargs):
         cursor = connections[database].cursor()
-        updates = []
-        cursor.copy_from(
-            CopyFromGenerator(
-                cls.getData(timestamp=cls.parent.timestamp, cluster=cluster)
-            ),
-            "operationplanmaterial",
-            columns=(
+        if useIncrementalExport(database, cluster):
+            exportIncremental(
+                cursor,
+                "operationplanmaterial",
                 "operationplan_id",
-                "item_id",
-                "location_id",
-                "quantity",
-                "flowdate",
-                "onhand",
-                "minimum",
-                "periodofcover",
-                "status",
-                "lastmodified",
-            ),
-            size=1024,
-            sep="\v",
+                [c[0] for c in cls.columns],
+                [c[1] for c in cls.columns],
+                cls.getData(timestamp=cls.parent.timestamp, cluster=cluster),
+                binary=useBinaryCopy(database),
+            )
+            return
+        copy_records(
+            cursor,
+            "operationplanmaterial",
+            [c[0] for c in cls.columns],
+            [c[1] for c in cls.columns],
+            cls.getData(timestamp=cls.parent.timestamp, cluster=cluster),
+            binary=useBinaryCopy(database),
         )
-        if len(updates) > 0:
-            cursor.execute("\n".join(updates))
 
 
 @PlanTaskRegistry.register
@@ -880,37 +1331,49 @@ class ExportOperationPlanResources(PlanTask):
                         )
                     )
                 else:
-                    yield "%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\n" % (
-                        clean_value(j.operationplan.reference),
-                        clean_value(j.resource.name),
+                    yield (
+                        j.operationplan.reference,
+                        j.resource.name,
                         round(-j.quantity, 8),
-                        str(j.startdate),
-                        str(j.enddate),
-                        clean_value(j.setup),
+                        j.startdate,
+                        j.enddate,
+                        j.setup,
                         j.status,
                         timestamp,
                     )
 
+    columns = (
+        ("operationplan_id", "text"),
+        ("resource_id", "text"),
+        ("quantity", "numeric"),
+        ("startdate", "timestamp"),
+        ("enddate", "timestamp"),
+        ("setup", "text"),
+        ("status", "text"),
+        ("lastmodified", "timestamp"),
+    )
+
     @classmethod
     def run(cls, cluster=-1, database=DEFAULT_DB_ALIAS, **kwargs):
         cursor = connections[database].cursor()
-        cursor.copy_from(
-            CopyFromGenerator(
-                cls.getData(timestamp=cls.parent.timestamp, cluster=cluster)
-            ),
-            "operationplanresource",
-            columns=(
+        if useIncrementalExport(database, cluster):
+            exportIncremental(
+                cursor,
+                "operationplanresource",
                 "operationplan_id",
-                "resource_id",
-                "quantity",
-                "startdate",
-                "enddate",
-                "setup",
-                "status",
-                "lastmodified",
-            ),
-            size=1024,
-            sep="\v",
+                [c[0] for c in cls.columns],
+                [c[1] for c in cls.columns],
+                cls.getData(timestamp=cls.parent.timestamp, cluster=cluster),
+                binary=useBinaryCopy(database),
+            )
+            return
+        copy_records(
+            cursor,
+            "operationplanresource",
+            [c[0] for c in cls.columns],
+            [c[1] for c in cls.columns],
+            cls.getData(timestamp=cls.parent.timestamp, cluster=cluster),
+            binary=useBinaryCopy(database),
         )
 
 
@@ -928,6 +1391,16 @@ class ExportResourcePlans(PlanTask):
         else:
             return -1
 
+    columns = (
+        ("resource", "text"),
+        ("startdate", "timestamp"),
+        ("available", "numeric"),
+        ("unavailable", "numeric"),
+        ("setup", "numeric"),
+        ("load", "numeric"),
+        ("free", "numeric"),
+    )
+
     @classmethod
     def run(cls, cluster=-1, database=DEFAULT_DB_ALIAS, **kwargs):
         import frepple
@@ -976,9 +1449,9 @@ class ExportResourcePlans(PlanTask):
             # Loop over all reporting buckets of all resources
             for i in frepple.resources():
                 for j in i.plan(buckets):
-                    yield "%s\v%s\v%s\v%s\v%s\v%s\v%s\n" % (
-                        clean_value(i.name),
-                        str(j["start"]),
+                    yield (
+                        i.name,
+                        j["start"],
                         round(j["available"], 8),
                         round(j["unavailable"], 8),
                         round(j["setup"], 8),
@@ -986,20 +1459,13 @@ class ExportResourcePlans(PlanTask):
                         round(j["free"], 8),
                     )
 
-        cursor.copy_from(
-            CopyFromGenerator(getData()),
+        copy_records(
+            cursor,
             "out_resourceplan",
-            columns=(
-                "resource",
-                "startdate",
-                "available",
-                "unavailable",
-                "setup",
-                "load",
-                "free",
-            ),
-            size=1024,
-            sep="\v",
+            [c[0] for c in cls.columns],
+            [c[1] for c in cls.columns],
+            getData(),
+            binary=useBinaryCopy(database),
         )
 
 
@@ -1017,8 +1483,16 @@ class ExportPegging(PlanTask):
         else:
             return -1
 
+    columns = (
+        ("demand", "text"),
+        ("operationplan", "text"),
+        ("seq", "integer"),
+        ("level", "integer"),
+        ("quantity", "numeric"),
+    )
+
     @staticmethod
-    def getDemandPlan(cluster=-1):
+    def getData(cluster=-1):
         import frepple
 
         for i in frepple.demands():
@@ -1026,27 +1500,53 @@ class ExportPegging(PlanTask):
                 continue
             if i.hidden or not isinstance(i, frepple.demand_default):
                 continue
-            peg = []
-            for j in i.pegging:
-                peg.append(
-                    {
-                        "level": j.level,
-                        "opplan": j.operationplan.reference,
-                        "quantity": j.quantity,
-                    }
+            for seq, j in enumerate(i.pegging):
+                yield (
+                    i.name,
+                    j.operationplan.reference,
+                    seq,
+                    j.level,
+                    round(j.quantity, 8),
                 )
-            yield (json.dumps({"pegging": peg}), i.name)
 
     @classmethod
     def run(cls, cluster=-1, database=DEFAULT_DB_ALIAS, **kwargs):
+        # The previous pegging records are erased by the TruncatePlan task
         with transaction.atomic(using=database, savepoint=False):
             cursor = connections[database].cursor()
-            execute_batch(
+            copy_records(
                 cursor,
-                "update demand set plan=%s where name=%s",
-                cls.getDemandPlan(cluster=cluster),
-                page_size=200,
+                "out_pegging",
+                [c[0] for c in cls.columns],
+                [c[1] for c in cls.columns],
+                cls.getData(cluster=cluster),
+                binary=useBinaryCopy(database),
             )
+            cursor.execute("analyze out_pegging")
+
+
+@PlanTaskRegistry.register
+class ExportBucketSummaries(PlanTask):
+
+    description = "Summarizing plan per time bucket"
+    sequence = 401.5
+    export = True
+
+    @classmethod
+    def getWeight(cls, **kwargs):
+        if "supply" in os.environ:
+            return 1
+        else:
+            return -1
+
+    @classmethod
+    def run(cls, cluster=-1, database=DEFAULT_DB_ALIAS, **kwargs):
+        starttime = time()
+        ResourceBucketSummary.rebuild(database)
+        BufferBucketSummary.rebuild(database)
+        logger.info(
+            "Summarized the plan per time bucket in %.2f seconds" % (time() - starttime)
+        )
 
 
 @PlanTaskRegistry.register
@@ -0,0 +1,171 @@
+#
+# Copyright (C) 2020 by frePPLe bv
+#
+# This library is free software; you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero
+# General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+from django.conf import settings
+from django.db import migrations, models, connections
+
+
+def grant_read_access(apps, schema_editor):
+    db = schema_editor.connection.alias
+    role = settings.DATABASES[db].get("SQL_ROLE", "report_role")
+    if role:
+        with connections[db].cursor() as cursor:
+            cursor.execute("select count(*) from pg_roles where rolname = %s", (role,))
+            if cursor.fetchone()[0]:
+                for table in ["out_resourceplan_bucket", "out_buffer_bucket"]:
+                    cursor.execute("grant select on table %s to %s" % (table, role))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [("output", "0009_constraint_item")]
+
+    operations = [
+        migrations.CreateModel(
+            name="ResourceBucketSummary",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("resource", models.CharField(max_length=300, verbose_name="resource")),
+                ("bucket", models.CharField(max_length=300, verbose_name="bucket")),
+                ("startdate", models.DateTimeField(verbose_name="startdate")),
+                (
+                    "available",
+                    models.DecimalField(
+                        decimal_places=8,
+                        max_digits=20,
+                        null=True,
+                        verbose_name="available",
+                    ),
+                ),
+                (
+                    "unavailable",
+                    models.DecimalField(
+                        decimal_places=8,
+                        max_digits=20,
+                        null=True,
+                        verbose_name="unavailable",
+                    ),
+                ),
+                (
+                    "setup",
+                    models.DecimalField(
+                        decimal_places=8, max_digits=20, null=True, verbose_name="setup"
+                    ),
+                ),
+                (
+                    "load",
+                    models.DecimalField(
+                        decimal_places=8, max_digits=20, null=True, verbose_name="load"
+                    ),
+                ),
+            ],
+            options={
+                "verbose_name": "resource bucket summary",
+                "verbose_name_plural": "resource bucket summaries",
+                "db_table": "out_resourceplan_bucket",
+                "ordering": ["resource", "bucket", "startdate"],
+                "default_permissions": [],
+                "unique_together": {("resource", "bucket", "startdate")},
+            },
+        ),
+        migrations.CreateModel(
+            name="BufferBucketSummary",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("item", models.CharField(max_length=300, verbose_name="item")),
+                ("location", models.CharField(max_length=300, verbose_name="location")),
+                (
+                    "batch",
+                    models.CharField(max_length=300, null=True, verbose_name="batch"),
+                ),
+                ("bucket", models.CharField(max_length=300, verbose_name="bucket")),
+                ("startdate", models.DateTimeField(verbose_name="startdate")),
+                (
+                    "work_in_progress_mo",
+                    models.DecimalField(decimal_places=8, max_digits=20),
+                ),
+                ("on_order_po", models.DecimalField(decimal_places=8, max_digits=20)),
+                ("in_transit_do", models.DecimalField(decimal_places=8, max_digits=20)),
+                (
+                    "total_in_progress",
+                    models.DecimalField(decimal_places=8, max_digits=20),
+                ),
+                ("consumed", models.DecimalField(decimal_places=8, max_digits=20)),
+                ("consumed_mo", models.DecimalField(decimal_places=8, max_digits=20)),
+                ("consumed_do", models.DecimalField(decimal_places=8, max_digits=20)),
+                ("consumed_so", models.DecimalField(decimal_places=8, max_digits=20)),
+                ("produced", models.DecimalField(decimal_places=8, max_digits=20)),
+                ("produced_mo", models.DecimalField(decimal_places=8, max_digits=20)),
+                ("produced_do", models.DecimalField(decimal_places=8, max_digits=20)),
+                ("produced_po", models.DecimalField(decimal_places=8, max_digits=20)),
+            ],
+            options={
+                "verbose_name": "buffer bucket summary",
+                "verbose_name_plural": "buffer bucket summaries",
+                "db_table": "out_buffer_bucket",
+                "ordering": ["item", "location", "bucket", "startdate"],
+                "default_permissions": [],
+            },
+        ),
+        migrations.AddIndex(
+            model_name="bufferbucketsummary",
+            index=models.Index(
+                fields=["item", "location", "bucket", "startdate"],
+                name="out_buffer_bucket_idx",
+            ),
+        ),
+        migrations.CreateModel(
+            name="BufferBucketRefresh",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("item", models.CharField(max_length=300, verbose_name="item")),
+                ("location", models.CharField(max_length=300, verbose_name="location")),
+            ],
+            options={
+                "verbose_name": "buffer bucket refresh",
+                "verbose_name_plural": "buffer bucket refreshes",
+                "db_table": "out_buffer_bucket_refresh",
+                "default_permissions": [],
+                "unique_together": {("item", "location")},
+            },
+        ),
+        migrations.RunPython(grant_read_access),
+    ]
@@ -0,0 +1,88 @@
+#
+# Copyright (C) 2020 by frePPLe bv
+#
+# This library is free software; you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero
+# General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+from django.conf import settings
+from django.db import migrations, models, connections
+
+
+def grant_read_access(apps, schema_editor):
+    db = schema_editor.connection.alias
+    role = settings.DATABASES[db].get("SQL_ROLE", "report_role")
+    if role:
+        with connections[db].cursor() as cursor:
+            cursor.execute("select count(*) from pg_roles where rolname = %s", (role,))
+            if cursor.fetchone()[0]:
+                cursor.execute("grant select on table out_pegging to %s" % role)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("output", "0010_bucket_summary"),
+        ("input", "0050_operationmaterial_offset"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="Pegging",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("demand", models.CharField(max_length=300, verbose_name="demand")),
+                (
+                    "operationplan",
+                    models.CharField(max_length=300, verbose_name="operationplan"),
+                ),
+                ("seq", models.IntegerField(verbose_name="sequence")),
+                ("level", models.IntegerField(verbose_name="level")),
+                (
+                    "quantity",
+                    models.DecimalField(
+                        decimal_places=8, max_digits=20, verbose_name="quantity"
+                    ),
+                ),
+            ],
+            options={
+                "verbose_name": "pegging",
+                "verbose_name_plural": "peggings",
+                "db_table": "out_pegging",
+                "ordering": ["demand", "seq"],
+                "default_permissions": [],
+            },
+        ),
+        migrations.AddIndex(
+            model_name="pegging",
+            index=models.Index(fields=["demand", "seq"], name="out_pegging_demand_idx"),
+        ),
+        migrations.AddIndex(
+            model_name="pegging",
+            index=models.Index(fields=["operationplan"], name="out_pegging_opplan_idx"),
+        ),
+        migrations.RunPython(grant_read_access),
+        # The pegging is no longer stored in the plan field of the demands
+        migrations.RunSQL(
+            "update demand set plan = plan - 'pegging' where plan ? 'pegging'",
+            migrations.RunSQL.noop,
+        ),
+    ]
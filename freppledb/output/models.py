@@ -16,7 +16,7 @@
 #
 
 from django.utils.translation import gettext_lazy as _
-from django.db import models
+from django.db import connections, models, transaction, DEFAULT_DB_ALIAS
 
 
 class Problem(models.Model):
@@ -86,3 +86,333 @@ class ResourceSummary(models.Model):
         )  # No need to translate these since only used internally
         verbose_name_plural = "resource summaries"
         default_permissions = []
+
+
+class ResourceBucketSummary(models.Model):
+    """
+    Resource plan aggregated per time bucket, for every bucket granularity.
+    It is computed from the out_resourceplan table after the plan export.
+    """
+
+    resource = models.CharField(_("resource"), max_length=300)
+    bucket = models.CharField(_("bucket"), max_length=300)
+    startdate = models.DateTimeField(_("startdate"))
+    available = models.DecimalField(
+        _("available"), max_digits=20, decimal_places=8, null=True
+    )
+    unavailable = models.DecimalField(
+        _("unavailable"), max_digits=20, decimal_places=8, null=True
+    )
+    setup = models.DecimalField(_("setup"), max_digits=20, decimal_places=8, null=True)
+    load = models.DecimalField(_("load"), max_digits=20, decimal_places=8, null=True)
+
+    @classmethod
+    def rebuild(cls, database=DEFAULT_DB_ALIAS):
+        with transaction.atomic(using=database):
+            with connections[database].cursor() as cursor:
+                cursor.execute("truncate table out_resourceplan_bucket")
+                cursor.execute(
+                    """
+                    insert into out_resourceplan_bucket
+                      (resource, bucket, startdate, available, unavailable, setup, load)
+                    select
+                      out_resourceplan.resource, d.bucket_id, d.startdate,
+                      sum(out_resourceplan.available), sum(out_resourceplan.unavailable),
+                      sum(out_resourceplan.setup), sum(out_resourceplan.load)
+                    from out_resourceplan
+                    cross join common_bucket
+                    inner join common_bucketdetail d
+                      on d.bucket_id = common_bucket.name
+                      and d.startdate = (
+                        select max(startdate)
+                        from common_bucketdetail d0
+                        where d0.bucket_id = common_bucket.name
+                        and d0.startdate <= out_resourceplan.startdate
+                        )
+                      and d.enddate > out_resourceplan.startdate
+                    group by out_resourceplan.resource, d.bucket_id, d.startdate
+                    """
+                )
+
+    @classmethod
+    def refresh(cls, database=DEFAULT_DB_ALIAS):
+        """
+        Builds the summary when it is missing, eg after the time buckets
+        were regenerated, and clears it when the resource plan was erased.
+        """
+        with connections[database].cursor() as cursor:
+            cursor.execute(
+                """
+                select
+                  exists (select 1 from out_resourceplan),
+                  exists (select 1 from out_resourceplan_bucket)
+                """
+            )
+            source, summary = cursor.fetchone()
+            if source and not summary:
+                cls.rebuild(database)
+            elif summary and not source:
+                cursor.execute("truncate table out_resourceplan_bucket")
+
+    class Meta:
+        db_table = "out_resourceplan_bucket"
+        ordering = ["resource", "bucket", "startdate"]
+        unique_together = (("resource", "bucket", "startdate"),)
+        verbose_name = (
+            "resource bucket summary"
+        )  # No need to translate these since only used internally
+        verbose_name_plural = "resource bucket summaries"
+        default_permissions = []
+
+
+class BufferBucketSummary(models.Model):
+    """
+    Material flows and work in progress of each buffer aggregated per time
+    bucket, for every bucket granularity.
+    It is computed after the plan export, and refreshed for the buffers of
+    the operationplans that are edited afterwards.
+    """
+
+    item = models.CharField(_("item"), max_length=300)
+    location = models.CharField(_("location"), max_length=300)
+    batch = models.CharField(_("batch"), max_length=300, null=True)
+    bucket = models.CharField(_("bucket"), max_length=300)
+    startdate = models.DateTimeField(_("startdate"))
+    work_in_progress_mo = models.DecimalField(max_digits=20, decimal_places=8)
+    on_order_po = models.DecimalField(max_digits=20, decimal_places=8)
+    in_transit_do = models.DecimalField(max_digits=20, decimal_places=8)
+    total_in_progress = models.DecimalField(max_digits=20, decimal_places=8)
+    consumed = models.DecimalField(max_digits=20, decimal_places=8)
+    consumed_mo = models.DecimalField(max_digits=20, decimal_places=8)
+    consumed_do = models.DecimalField(max_digits=20, decimal_places=8)
+    consumed_so = models.DecimalField(max_digits=20, decimal_places=8)
+    produced = models.DecimalField(max_digits=20, decimal_places=8)
+    produced_mo = models.DecimalField(max_digits=20, decimal_places=8)
+    produced_do = models.DecimalField(max_digits=20, decimal_places=8)
+    produced_po = models.DecimalField(max_digits=20, decimal_places=8)
+
+    # Every material flow is counted in the bucket of its date, and the
+    # material produced by an operationplan is counted as in progress at the
+    # end of each bucket between its start and end date.
+    aggregate_sql = """
+        select
+          item_id, location_id, batch, bucket_id, startdate,
+          sum(case when wip and type = 'MO' then quantity else 0 end),
+          sum(case when wip and type = 'PO' then quantity else 0 end),
+          sum(case when wip and type = 'DO' then quantity else 0 end),
+          sum(case when wip then quantity else 0 end),
+          sum(case when not wip and quantity < 0 then -quantity else 0 end),
+          sum(case when not wip and quantity < 0 and type = 'MO' then -quantity else 0 end),
+          sum(case when not wip and quantity < 0 and type = 'DO' then -quantity else 0 end),
+          sum(case when not wip and quantity < 0 and type = 'DLVR' then -quantity else 0 end),
+          sum(case when not wip and quantity > 0 then quantity else 0 end),
+          sum(case when not wip and quantity > 0 and type = 'MO' then quantity else 0 end),
+          sum(case when not wip and quantity > 0 and type = 'DO' then quantity else 0 end),
+          sum(case when not wip and quantity > 0 and type = 'PO' then quantity else 0 end)
+        from (
+          select
+            opm.item_id, opm.location_id, operationplan.batch, operationplan.type,
+            d.bucket_id, d.startdate, opm.quantity, false as wip
+          from operationplanmaterial opm
+          inner join operationplan
+            on operationplan.reference = opm.operationplan_id
+          cross join common_bucket
+          inner join common_bucketdetail d
+            on d.bucket_id = common_bucket.name
+            and d.startdate = (
+              select max(startdate)
+              from common_bucketdetail d0
+              where d0.bucket_id = common_bucket.name
+              and d0.startdate <= opm.flowdate
+              )
+            and d.enddate > opm.flowdate
+          %s
+          union all
+          select
+            opm.item_id, opm.location_id, operationplan.batch, operationplan.type,
+            d.bucket_id, d.startdate, opm.quantity, true as wip
+          from operationplanmaterial opm
+          inner join operationplan
+            on operationplan.reference = opm.operationplan_id
+          cross join common_bucket
+          inner join common_bucketdetail d
+            on d.bucket_id = common_bucket.name
+            and d.startdate >= coalesce((
+              select max(startdate)
+              from common_bucketdetail d0
+              where d0.bucket_id = common_bucket.name
+              and d0.startdate <= operationplan.startdate
+              ), '-infinity')
+            and d.startdate < operationplan.enddate
+            and d.enddate > operationplan.startdate
+            and d.enddate <= operationplan.enddate
+          where opm.quantity > 0 %s
+        ) flows
+        group by item_id, location_id, batch, bucket_id, startdate
+        """
+
+    fields_sql = """
+        item, location, batch, bucket, startdate,
+        work_in_progress_mo, on_order_po, in_transit_do, total_in_progress,
+        consumed, consumed_mo, consumed_do, consumed_so,
+        produced, produced_mo, produced_do, produced_po
+        """
+
+    @classmethod
+    def rebuild(cls, database=DEFAULT_DB_ALIAS):
+        with transaction.atomic(using=database):
+            with connections[database].cursor() as cursor:
+                cursor.execute(
+                    "truncate table out_buffer_bucket, out_buffer_bucket_refresh"
+                )
+                cursor.execute(
+                    "insert into out_buffer_bucket (%s) %s"
+                    % (cls.fields_sql, cls.aggregate_sql % ("", ""))
+                )
+
+    @classmethod
+    def refresh(cls, database=DEFAULT_DB_ALIAS):
+        """
+        Recomputes the summary of the buffers marked for refresh.
+        The summary is completely built when it is missing, eg after the time
+        buckets were regenerated, and cleared when the plan was erased.
+        """
+        with connections[database].cursor() as cursor:
+            cursor.execute(
+                """
+                select
+                  exists (select 1 from operationplanmaterial),
+                  exists (select 1 from out_buffer_bucket)
+                """
+            )
+            source, summary = cursor.fetchone()
+            if source and not summary:
+                cls.rebuild(database)
+                return
+            elif not source:
+                if summary:
+                    cursor.execute(
+                        "truncate table out_buffer_bucket, out_buffer_bucket_refresh"
+                    )
+                return
+            filter = """
+              and exists (
+                select 1 from dirty
+                where dirty.item = opm.item_id and dirty.location = opm.location_id
+                )
+              """
+            cursor.execute(
+                """
+                with dirty as (
+                  delete from out_buffer_bucket_refresh
+                  returning item, location
+                  ),
+                obsolete as (
+                  delete from out_buffer_bucket
+                  using dirty
+                  where out_buffer_bucket.item = dirty.item
+                  and out_buffer_bucket.location = dirty.location
+                  )
+                insert into out_buffer_bucket (%s) %s
+                """
+                % (
+                    cls.fields_sql,
+                    cls.aggregate_sql % ("where true %s" % filter, filter),
+                )
+            )
+
+    class Meta:
+        db_table = "out_buffer_bucket"
+        ordering = ["item", "location", "bucket", "startdate"]
+        indexes = [
+            models.Index(
+                fields=["item", "location", "bucket", "startdate"],
+                name="out_buffer_bucket_idx",
+            )
+        ]
+        verbose_name = (
+            "buffer bucket summary"
+        )  # No need to translate these since only used internally
+        verbose_name_plural = "buffer bucket summaries"
+        default_permissions = []
+
+
+class BufferBucketRefresh(models.Model):
+    """
+    Buffers for which the bucket summary needs to be recomputed.
+    """
+
+    item = models.CharField(_("item"), max_length=300)
+    location = models.CharField(_("location"), max_length=300)
+
+    @staticmethod
+    def markOperationPlans(references, database=DEFAULT_DB_ALIAS):
+        with connections[database].cursor() as cursor:
+            cursor.execute(
+                """
+                insert into out_buffer_bucket_refresh (item, location)
+                select distinct item_id, location_id
+                from operationplanmaterial
+                where operationplan_id = any(%s)
+                on conflict do nothing
+                """,
+                (list(references),),
+            )
+
+    @classmethod
+    def markOperationPlanOnCommit(cls, reference, database=DEFAULT_DB_ALIAS):
+        """
+        Marks the buffers of an operationplan when the current transaction
+        commits. All operationplans saved in a transaction are marked with a
+        single statement.
+        """
+        connection = connections[database]
+        if not connection.in_atomic_block:
+            cls.markOperationPlans([reference], database)
+            return
+        flush = getattr(connection, "buffersummary_flush", None)
+        if flush is None or not any(f is flush for sids, f in connection.run_on_commit):
+            pending = set()
+
+            def flush():
+                cls.markOperationPlans(pending, database)
+
+            flush.pending = pending
+            connection.buffersummary_flush = flush
+            transaction.on_commit(flush, using=database)
+        flush.pending.add(reference)
+
+    class Meta:
+        db_table = "out_buffer_bucket_refresh"
+        unique_together = (("item", "location"),)
+        verbose_name = (
+            "buffer bucket refresh"
+        )  # No need to translate these since only used internally
+        verbose_name_plural = "buffer bucket refreshes"
+        default_permissions = []
+
+
+class Pegging(models.Model):
+    """
+    Operationplans used to satisfy each demand, exported with the plan.
+    The seq field keeps the order of the pegging path of the demand.
+    """
+
+    demand = models.CharField(_("demand"), max_length=300)
+    operationplan = models.CharField(_("operationplan"), max_length=300)
+    seq = models.IntegerField(_("sequence"))
+    level = models.IntegerField(_("level"))
+    quantity = models.DecimalField(_("quantity"), max_digits=20, decimal_places=8)
+
+    class Meta:
+        db_table = "out_pegging"
+        ordering = ["demand", "seq"]
+        indexes = [
+            models.Index(fields=["demand", "seq"], name="out_pegging_demand_idx"),
+            models.Index(fields=["operationplan"], name="out_pegging_opplan_idx"),
+        ]
+        verbose_name = (
+            "pegging"
+        )  # No need to translate these since only used internally
+        verbose_name_plural = "peggings"
+        default_permissions = []
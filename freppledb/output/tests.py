@@ -15,10 +15,31 @@
 # License along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 
+from datetime import datetime, timedelta
+import json
+import logging
+import random
+from time import time
+
+from django.core import management
+from django.core.cache import cache
+from django.db import connection, transaction
+from django.db.models import F
 from django.http import StreamingHttpResponse
-from django.test import TestCase
+from django.test import TestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext
 
 from freppledb.common.tests import checkResponse
+from freppledb.execute.models import PlanVersion
+from freppledb.input.models import Item, OperationPlan, OperationPlanMaterial
+from freppledb.output.commands import ExportOperationPlans
+from freppledb.output.models import (
+    BufferBucketSummary,
+    ResourceBucketSummary,
+    ResourceSummary,
+)
+
+logger = logging.getLogger(__name__)
 
 
 class OutputTest(TestCase):
@@ -205,3 +226,245 @@ class OutputTest(TestCase):
                 "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
             )
         )
+
+    # Dashboard widgets
+    def test_widget_cache(self):
+        cache.clear()
+        queries = []
+        for i in range(3):
+            if i == 2:
+                # A new version of the data
+                with connection.cursor() as cursor:
+                    cursor.execute("select nextval('execute_planversion_seq')")
+                PlanVersion.invalidate()
+            with CaptureQueriesContext(connection) as ctx:
+                response = self.client.get("/widget/late_orders/?limit=20")
+                self.assertEqual(response.status_code, 200)
+            if i == 0:
+                content = response.content
+            else:
+                self.assertEqual(response.content, content)
+            queries.append(
+                [q for q in ctx.captured_queries if "out_problem" in q["sql"]]
+            )
+        # The second request is served from the cache
+        self.assertEqual(len(queries[0]), 1)
+        self.assertEqual(len(queries[1]), 0)
+        self.assertEqual(len(queries[2]), 1)
+
+
+class BucketSummaryTest(TransactionTestCase):
+    """
+    Compares the bucket summaries used by the inventory and resource reports
+    with the same aggregates computed from the detailed plan.
+    """
+
+    fixtures = ["demo"]
+
+    def setUp(self):
+        management.call_command("createbuckets", verbosity=0)
+        for po in OperationPlan.objects.all().filter(type="PO"):
+            OperationPlanMaterial.objects.create(
+                operationplan=po,
+                item_id=po.item_id,
+                location_id=po.location_id,
+                quantity=po.quantity,
+                flowdate=po.enddate,
+            )
+            OperationPlanMaterial.objects.create(
+                operationplan=po,
+                item_id=po.item_id,
+                location_id=po.location_id,
+                quantity=-po.quantity / 2,
+                flowdate=po.enddate + timedelta(days=40),
+            )
+        for day in range(60):
+            ResourceSummary.objects.create(
+                resource="pack in factory 1",
+                startdate=datetime(2014, 1, 1) + timedelta(days=day),
+                available=8,
+                unavailable=0,
+                setup=day % 2,
+                load=day % 7,
+                free=8 - day % 7,
+            )
+
+    def assertBufferSummary(self):
+        BufferBucketSummary.refresh()
+        with connection.cursor() as cursor:
+            cursor.execute(
+                """
+                with detail as (
+                  select opm.item_id, opm.location_id, d.bucket_id, d.startdate,
+                    sum(case when opm.flowdate >= d.startdate and opm.flowdate < d.enddate
+                      and opm.quantity < 0 then -opm.quantity else 0 end) consumed,
+                    sum(case when opm.flowdate >= d.startdate and opm.flowdate < d.enddate
+                      and opm.quantity > 0 then opm.quantity else 0 end) produced,
+                    sum(case when operationplan.startdate < d.enddate
+                      and operationplan.enddate >= d.enddate
+                      and opm.quantity > 0 then opm.quantity else 0 end) in_progress
+                  from operationplanmaterial opm
+                  inner join operationplan
+                    on operationplan.reference = opm.operationplan_id
+                  cross join common_bucketdetail d
+                  group by opm.item_id, opm.location_id, d.bucket_id, d.startdate
+                  ),
+                summary as (
+                  select item, location, bucket, startdate,
+                    sum(consumed), sum(produced), sum(total_in_progress)
+                  from out_buffer_bucket
+                  group by item, location, bucket, startdate
+                  )
+                select count(*) from (
+                  (select * from detail
+                   where consumed <> 0 or produced <> 0 or in_progress <> 0
+                   except select * from summary)
+                  union all
+                  (select * from summary
+                   except select * from detail)
+                ) differences
+                """
+            )
+            self.assertEqual(cursor.fetchone()[0], 0)
+
+    def assertResourceSummary(self):
+        ResourceBucketSummary.refresh()
+        with connection.cursor() as cursor:
+            cursor.execute(
+                """
+                with detail as (
+                  select out_resourceplan.resource, d.bucket_id, d.startdate,
+                    sum(available), sum(unavailable), sum(setup), sum(load)
+                  from out_resourceplan
+                  inner join common_bucketdetail d
+                    on out_resourceplan.startdate >= d.startdate
+                    and out_resourceplan.startdate < d.enddate
+                  group by out_resourceplan.resource, d.bucket_id, d.startdate
+                  ),
+                summary as (
+                  select resource, bucket, startdate, available, unavailable, setup, load
+                  from out_resourceplan_bucket
+                  )
+                select count(*) from (
+                  (select * from detail except select * from summary)
+                  union all
+                  (select * from summary except select * from detail)
+                ) differences
+                """
+            )
+            self.assertEqual(cursor.fetchone()[0], 0)
+
+    def test_bucket_summary(self):
+        self.assertBufferSummary()
+        self.assertResourceSummary()
+        self.assertTrue(BufferBucketSummary.objects.exists())
+        self.assertTrue(ResourceBucketSummary.objects.exists())
+
+        # Edit an operationplan and its material flows
+        po = OperationPlan.objects.get(reference="PO 0001")
+        OperationPlanMaterial.objects.filter(operationplan=po).update(
+            quantity=F("quantity") * 3, flowdate=F("flowdate") + timedelta(days=10)
+        )
+        po.quantity = po.quantity * 3
+        po.save()
+        self.assertBufferSummary()
+
+        # Move the material flows of an operationplan to another buffer
+        with transaction.atomic():
+            po = OperationPlan.objects.get(reference="PO 0003")
+            po.item = Item.objects.exclude(name=po.item_id).first()
+            po.save()
+            OperationPlanMaterial.objects.filter(operationplan=po).update(item=po.item)
+        self.assertBufferSummary()
+
+        # Delete an operationplan
+        OperationPlan.objects.get(reference="PO 0002").delete()
+        self.assertBufferSummary()
+
+        # Erase the purchase orders with the empty command
+        management.call_command("empty", models="input.purchaseorder")
+        self.assertFalse(BufferBucketSummary.objects.exists())
+        self.assertFalse(ResourceBucketSummary.objects.exists())
+        self.assertBufferSummary()
+        self.assertResourceSummary()
+
+
+class ExportCopyTest(TestCase):
+    """
+    Compares the binary and text COPY paths used by the plan export
+    on a generated set of operationplans.
+    """
+
+    size = 20000
+
+    def getData(self):
+        rnd = random.Random(1)
+        now = datetime(2020, 1, 1)
+        for i in range(self.size):
+            start = now + timedelta(minutes=rnd.randint(0, 500000))
+            yield (
+                "operation \\ %s" % (i % 100),
+                rnd.choice(["MO", "PO", "DO", "DLVR"]),
+                rnd.choice(["proposed", "confirmed", None]),
+                round(rnd.uniform(0, 1000), 8),
+                start,
+                start + timedelta(hours=rnd.randint(1, 100)),
+                round(rnd.uniform(-10, 10), 8),
+                rnd.randint(0, 86400 * 10),
+                json.dumps({"pegging": {"demand %s" % i: round(rnd.random(), 8)}}),
+                None,
+                now,
+                None,
+                None,
+                "item \u00e9 %s" % (i % 1000),
+                None,
+                None,
+                "location %s" % (i % 10),
+                None,
+                "demand %s" % i if i % 3 else None,
+                now if i % 3 else None,
+                rnd.choice([None, round(rnd.uniform(0, 100), 8)]),
+                "ref %s" % i,
+                None,
+            )
+
+    def export(self, cursor, tablename, binary):
+        ExportOperationPlans.createTempTable(cursor, tablename)
+        start = time()
+        ExportOperationPlans.copyToTempTable(
+            cursor, self.getData(), tablename=tablename, binary=binary
+        )
+        return time() - start
+
+    def test_binary_copy(self):
+        with connection.cursor() as cursor:
+            text = self.export(cursor, "tmp_text", binary=False)
+            binary = self.export(cursor, "tmp_binary", binary=True)
+            logger.info(
+                "Copying %s operationplans: text %.3fs, binary %.3fs"
+                % (self.size, text, binary)
+            )
+            cursor.execute(
+                """
+                select count(*) from (
+                  (select name, type, status, quantity, startdate, enddate, criticality,
+                     delay, plan::text, item_id, demand_id, due, color, reference
+                   from tmp_text
+                   except
+                   select name, type, status, quantity, startdate, enddate, criticality,
+                     delay, plan::text, item_id, demand_id, due, color, reference
+                   from tmp_binary)
+                  union all
+                  (select name, type, status, quantity, startdate, enddate, criticality,
+                     delay, plan::text, item_id, demand_id, due, color, reference
+                   from tmp_binary
+                   except
+                   select name, type, status, quantity, startdate, enddate, criticality,
+                     delay, plan::text, item_id, demand_id, due, color, reference
+                   from tmp_text)
+                ) d
+                """
+            )
+            self.assertEqual(cursor.fetchone()[0], 0)
+            cursor.execute("select count(*) from tmp_binary")
+            self.assertEqual(cursor.fetchone()[0], self.size)
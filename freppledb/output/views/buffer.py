@@ -25,6 +25,7 @@ from django.utils.translation import gettext_lazy as _
 
 from freppledb.boot import getAttributeFields
 from freppledb.input.models import Buffer, Item, Location, OperationPlanMaterial
+from freppledb.output.models import BufferBucketSummary
 from freppledb.common.report import (
     GridPivot,
     GridFieldText,
@@ -319,6 +320,9 @@ class OverviewReport(GridPivot):
             with_col_aliases=False
         )
 
+        # Assure the bucket summary is up to date
+        BufferBucketSummary.refresh(database=request.database)
+
         # Execute the actual query
         query = """
            select
@@ -402,6 +406,31 @@ class OverviewReport(GridPivot):
             where t.safetystock is not null
             order by priority
             limit 1) safetystock,
+            -- Buckets within the reporting horizon are read from the bucket
+            -- summary, the first bucket is computed from the detailed plan
+            case when d.startdate >= %%s then
+            (select jsonb_build_object(
+               'work_in_progress_mo', sum(work_in_progress_mo),
+               'on_order_po', sum(on_order_po),
+               'in_transit_do', sum(in_transit_do),
+               'total_in_progress', sum(total_in_progress),
+               'consumed', sum(consumed),
+               'consumedMO', sum(consumed_mo),
+               'consumedDO', sum(consumed_do),
+               'consumedSO', sum(consumed_so),
+               'produced', sum(produced),
+               'producedMO', sum(produced_mo),
+               'producedDO', sum(produced_do),
+               'producedPO', sum(produced_po)
+               )
+             from out_buffer_bucket
+             where out_buffer_bucket.item = item.name
+               and out_buffer_bucket.location = location.name
+               and out_buffer_bucket.bucket = %%s
+               and out_buffer_bucket.startdate = d.startdate
+               and (item.type is distinct from 'make to order' or out_buffer_bucket.batch is not distinct from opplanmat.opplan_batch)
+            )
+            else
             (select jsonb_build_object(
                'work_in_progress_mo', sum(case when (startdate < d.enddate and enddate >= d.enddate) and opm.quantity > 0 and operationplan.type = 'MO' then opm.quantity else 0 end),
                'on_order_po', sum(case when (startdate < d.enddate and enddate >= d.enddate) and opm.quantity > 0 and operationplan.type = 'PO' then opm.quantity else 0 end),
@@ -424,7 +453,7 @@ class OverviewReport(GridPivot):
              where opm.item_id = item.name
                and opm.location_id = location.name
                and (item.type is distinct from 'make to order' or operationplan.batch is not distinct from opplanmat.opplan_batch)
-           ) ongoing
+           ) end ongoing
            from
            (%s) opplanmat
            inner join item on item.name = opplanmat.item_id
@@ -476,6 +505,7 @@ class OverviewReport(GridPivot):
                     request.report_startdate,
                     request.report_startdate,  # safetystock
                 )
+                + (request.report_startdate, request.report_bucket)
                 + (request.report_startdate,) * 9
                 + baseparams  # ongoing
                 + (  # opplanmat
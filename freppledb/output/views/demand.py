@@ -25,8 +25,9 @@ from django.utils.translation import gettext_lazy as _
 from django.utils.encoding import force_text
 
 from freppledb.boot import getAttributeFields
-from freppledb.input.models import Demand, Item
+from freppledb.input.models import Item
 from freppledb.input.models import ManufacturingOrder, PurchaseOrder, DistributionOrder
+from freppledb.output.models import Pegging
 from freppledb.common.report import GridPivot, GridFieldText
 from freppledb.common.report import GridFieldCurrency, GridFieldLastModified
 
@@ -259,12 +260,12 @@ def OperationPlans(request):
     so_list = request.GET.getlist("demand")
 
     # Collect operationplans associated with the sales order(s)
-    id_list = []
-    for dm in (
-        Demand.objects.all().using(request.database).filter(pk__in=so_list).only("plan")
-    ):
-        for op in dm.plan["pegging"]:
-            id_list.append(op["opplan"])
+    id_list = list(
+        Pegging.objects.all()
+        .using(request.database)
+        .filter(demand__in=so_list)
+        .values_list("operationplan", flat=True)
+    )
 
     # Collect details on the operationplans
     result = []
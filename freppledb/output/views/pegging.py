@@ -122,18 +122,14 @@ class ReportByDemand(GridReport):
         cursor = connections[request.database].cursor()
         cursor.execute(
             """
-            with dmd as (
-                select
-                  due,
-                  cast(jsonb_array_elements(plan->'pegging')->>'opplan' as varchar) opplan
-                from demand
-                where name = %s
-                )
-            select min(dmd.due), min(startdate), max(enddate)
-            from dmd
+            select min(demand.due), min(startdate), max(enddate)
+            from demand
+            inner join out_pegging
+            on out_pegging.demand = demand.name
             inner join operationplan
-            on dmd.opplan = operationplan.reference
+            on out_pegging.operationplan = operationplan.reference
             and type <> 'STCK'
+            where demand.name = %s
             """,
             (args[0]),
         )
@@ -179,9 +175,7 @@ class ReportByDemand(GridReport):
             request.report_enddate - request.report_startdate
         ).total_seconds() / 10000
         try:
-            current = parse(
-                Parameter.objects.using(request.database).get(name="currentdate").value
-            )
+            current = parse(Parameter.getValue("currentdate", request.database))
         except Exception:
             current = datetime.now()
             current = current.replace(microsecond=0)
@@ -197,16 +191,16 @@ class ReportByDemand(GridReport):
               quantity as required_quantity,
               sum(quantity) as quantity
             from (select
-              row_number() over () as rownum, opplan, due, lvl, quantity
-            from (select
-              due,
-              cast(jsonb_array_elements(plan->'pegging')->>'opplan' as varchar) as opplan,
-              cast(jsonb_array_elements(plan->'pegging')->>'level' as integer) as lvl,
-              cast(jsonb_array_elements(plan->'pegging')->>'quantity' as numeric) as quantity
+              out_pegging.seq + 1 as rownum,
+              out_pegging.operationplan as opplan,
+              demand.due,
+              out_pegging.level as lvl,
+              out_pegging.quantity
               from demand
-              where name = %s
+              inner join out_pegging
+                on out_pegging.demand = demand.name
+              where demand.name = %s
               ) d1
-              ) d2
             group by opplan, quantity
             )
           select
@@ -26,6 +26,7 @@ from freppledb.input.models import Resource, Location
 from freppledb.common.models import Parameter
 from freppledb.common.report import GridPivot, GridFieldCurrency, GridFieldDuration
 from freppledb.common.report import GridFieldNumber, GridFieldText, GridFieldBool
+from freppledb.output.models import ResourceBucketSummary
 
 
 class OverviewReport(GridPivot):
@@ -254,12 +255,10 @@ class OverviewReport(GridPivot):
     @classmethod
     def getUnits(reportclass, request):
         try:
-            units = Parameter.objects.using(request.database).get(
-                name="loading_time_units"
-            )
-            if units.value == "hours":
+            units = Parameter.getValue("loading_time_units", request.database)
+            if units == "hours":
                 return (1.0, _("hours"))
-            elif units.value == "weeks":
+            elif units == "weeks":
                 return (168, _("weeks"))
             else:
                 return (24, _("days"))
@@ -278,6 +277,9 @@ class OverviewReport(GridPivot):
         # Assure the item hierarchy is up to date
         Resource.rebuildHierarchy(database=basequery.db)
 
+        # Assure the bucket summary is available
+        ResourceBucketSummary.refresh(database=basequery.db)
+
         # Execute the query
         query = """
       select res.name, res.description, res.category, res.subcategory,
@@ -301,13 +303,25 @@ class OverviewReport(GridPivot):
                    from common_bucketdetail
                    where bucket_id = '%s' and enddate > '%s' and startdate < '%s'
                    ) d
-      -- Utilization info
-      left join out_resourceplan
-      on res.name = out_resourceplan.resource
-      and d.startdate <= out_resourceplan.startdate
-      and d.enddate > out_resourceplan.startdate
-      and out_resourceplan.startdate >= '%s'
-      and out_resourceplan.startdate < '%s'
+      -- Utilization info, from the bucket summary for the buckets within the
+      -- reporting horizon and from the detailed plan for the other buckets
+      left join lateral (
+        select available, unavailable, load, setup
+        from out_resourceplan_bucket
+        where out_resourceplan_bucket.resource = res.name
+        and out_resourceplan_bucket.bucket = '%s'
+        and out_resourceplan_bucket.startdate = d.startdate
+        and d.startdate >= '%s' and d.enddate <= '%s'
+        union all
+        select available, unavailable, load, setup
+        from out_resourceplan
+        where out_resourceplan.resource = res.name
+        and d.startdate <= out_resourceplan.startdate
+        and d.enddate > out_resourceplan.startdate
+        and out_resourceplan.startdate >= '%s'
+        and out_resourceplan.startdate < '%s'
+        and not (d.startdate >= '%s' and d.enddate <= '%s')
+        ) out_resourceplan on true
       -- Grouping and sorting
       group by res.name, res.description, res.category, res.subcategory,
         res.type, res.maximum, res.maximum_calendar_id, res.available_id, res.cost, res.maxearly,
@@ -326,6 +340,11 @@ class OverviewReport(GridPivot):
             request.report_bucket,
             request.report_startdate,
             request.report_enddate,
+            request.report_bucket,
+            request.report_startdate,
+            request.report_enddate,
+            request.report_startdate,
+            request.report_enddate,
             request.report_startdate,
             request.report_enddate,
             reportclass.attr_sql,
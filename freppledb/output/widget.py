@@ -323,7 +323,7 @@ class ManufacturingOrderWidget(Widget):
         except Exception:
             db = DEFAULT_DB_ALIAS
         try:
-            current = parse(Parameter.objects.using(db).get(name="currentdate").value)
+            current = parse(Parameter.getValue("currentdate", db))
         except Exception:
             current = date.today()
         request.database = db
@@ -595,7 +595,7 @@ class DistributionOrderWidget(Widget):
         except Exception:
             db = DEFAULT_DB_ALIAS
         try:
-            current = parse(Parameter.objects.using(db).get(name="currentdate").value)
+            current = parse(Parameter.getValue("currentdate", db))
         except Exception:
             current = date.today()
         request.database = db
@@ -878,7 +878,7 @@ class PurchaseOrderWidget(Widget):
         except Exception:
             db = DEFAULT_DB_ALIAS
         try:
-            current = parse(Parameter.objects.using(db).get(name="currentdate").value)
+            current = parse(Parameter.getValue("currentdate", db))
         except Exception:
             current = date.today()
         request.database = db
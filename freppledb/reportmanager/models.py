@@ -15,12 +15,11 @@
 # License along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 
-from django.conf import settings
 from django.db import models, DEFAULT_DB_ALIAS
 from django.utils.translation import gettext as _
 
 from freppledb.common.models import AuditModel, User, MultiDBManager
-from freppledb.common.report import create_connection
+from freppledb.common.report import SQLRoleConnectionPool
 
 
 class SQLReport(AuditModel):
@@ -51,13 +50,8 @@ class SQLReport(AuditModel):
             db = getattr(_thread_locals, "database", DEFAULT_DB_ALIAS)
         SQLColumn.objects.filter(report=self).using(db).delete()
         if self.sql:
-            conn = None
-            try:
-                conn = create_connection(db)
+            with SQLRoleConnectionPool.connection(db) as conn:
                 with conn.cursor() as cursor:
-                    sqlrole = settings.DATABASES[db].get("SQL_ROLE", "report_role")
-                    if sqlrole:
-                        cursor.execute("set role %s" % (sqlrole,))
                     # The query is wrapped in a dummy filter, to avoid executing the
                     # inner real query. It still generates the list of all columns.
                     cursor.execute("select * from (%s) as Q where false" % self.sql)
@@ -83,9 +77,6 @@ class SQLReport(AuditModel):
                             report=self, sequence=seq, name=f[0], format=fmt
                         ).save(using=db)
                         seq += 1
-            finally:
-                if conn:
-                    conn.close()
 
     def save(self, *args, **kwargs):
         super().save(*args, **kwargs)
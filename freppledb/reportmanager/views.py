@@ -16,6 +16,7 @@
 #
 
 from datetime import timedelta, date
+import hashlib
 import json
 import logging
 import sqlparse
@@ -23,6 +24,7 @@ import sqlparse
 from django.conf import settings
 from django.contrib.auth.decorators import permission_required
 from django.contrib import messages
+from django.core.cache import cache
 from django.db import connections
 from django.db.models import Q
 from django.http import (
@@ -40,8 +42,9 @@ from django.utils.encoding import smart_str
 from django.utils.translation import gettext as _
 
 from freppledb.common.models import User
+from freppledb.execute.models import PlanVersion
 from freppledb.common.report import (
-    create_connection,
+    SQLRoleConnectionPool,
     GridReport,
     GridFieldText,
     GridFieldLastModified,
@@ -408,82 +411,109 @@ class ReportManager(GridReport):
             q_filters[0] = " and ".join(q_filters[0])
         return q_filters
 
+    @classmethod
+    def _get_cache_key(cls, request, *args):
+        """
+        Returns a cache key for a query on the report. It includes the
+        version of the data, so results become obsolete when a task such
+        as a plan run finishes.
+        """
+        return "reportmanager_%s_%s" % (
+            request.database,
+            hashlib.md5(
+                (
+                    "%s%s%s%r%r"
+                    % (
+                        PlanVersion.getVersion(request.database),
+                        request.report.id,
+                        request.report.sql,
+                        request.filter,
+                        args,
+                    )
+                ).encode("utf-8")
+            ).hexdigest(),
+        )
+
     @classmethod
     def data_query(cls, request, *args, page=None, **kwargs):
         # Main query that will return all data records.
         # It implements filtering, paging and sorting.
-        conn = None
         if not hasattr(request, "report"):
             request.report = (
                 SQLReport.objects.all().using(request.database).get(pk=args[0])
             )
         if request.report and request.report.sql:
-            try:
-                conn = create_connection(request.database)
-                with conn.cursor() as cursor:
-                    sqlrole = settings.DATABASES[request.database].get(
-                        "SQL_ROLE", "report_role"
-                    )
-                    if sqlrole:
-                        cursor.execute("set role %s" % (sqlrole,))
-                    if not hasattr(request, "filter"):
-                        request.filter = cls.getFilter(request, *args, **kwargs)
-                    cursor.execute(
-                        "select * from (%s) t_subquery %s order by %s %s %s"
-                        % (
-                            request.report.sql.replace("%", "%%"),
-                            "where %s" % request.filter[0] if request.filter[0] else "",
-                            cls._apply_sort_index(request),
-                            ("offset %s" % ((page - 1) * request.pagesize + 1))
-                            if page and page > 1
-                            else "",
-                            "limit %s" % request.pagesize if page else "",
-                        ),
-                        request.filter[1],
+            if not hasattr(request, "filter"):
+                request.filter = cls.getFilter(request, *args, **kwargs)
+            sort = cls._apply_sort_index(request)
+            query = "select * from (%s) t_subquery %s order by %s %s %s" % (
+                request.report.sql.replace("%", "%%"),
+                "where %s" % request.filter[0] if request.filter[0] else "",
+                sort,
+                ("offset %s" % ((page - 1) * request.pagesize + 1))
+                if page and page > 1
+                else "",
+                "limit %s" % request.pagesize if page else "",
+            )
+            names = [f.name for f in request.rows]
+            if page:
+                # A page of the report is cached
+                key = cls._get_cache_key(request, sort, page, request.pagesize)
+                results = cache.get(key, None)
+                if results is None:
+                    with SQLRoleConnectionPool.connection(request.database) as conn:
+                        with conn.cursor() as cursor:
+                            cursor.execute(query, request.filter[1])
+                            results = cursor.fetchall()
+                    cache.set(
+                        key,
+                        results,
+                        timeout=getattr(settings, "SQL_REPORT_CACHE_TIMEOUT", 300),
                     )
-                    for rec in cursor.fetchall():
-                        result = {}
-                        idx = 0
-                        for f in request.rows:
-                            result[f.name] = rec[idx]
-                            idx += 1
-                        yield result
-            finally:
-                if conn:
-                    conn.close()
+                for rec in results:
+                    yield dict(zip(names, rec))
+            else:
+                # An export of all records is streamed with a server-side cursor
+                with SQLRoleConnectionPool.connection(request.database) as conn:
+                    with conn.cursor(name="reportmanager") as cursor:
+                        cursor.itersize = 2000
+                        cursor.execute(query, request.filter[1])
+                        for rec in cursor:
+                            yield dict(zip(names, rec))
 
     @classmethod
     def count_query(cls, request, *args, **kwargs):
         # Query that returns the number of records in the report.
         # It implements filtering, but no paging or sorting.
-        conn = None
         if not hasattr(request, "report"):
             request.report = (
                 SQLReport.objects.all().using(request.database).get(pk=args[0])
             )
         if request.report and request.report.sql:
-            try:
-                conn = create_connection(request.database)
-                with conn.cursor() as cursor:
-                    sqlrole = settings.DATABASES[request.database].get(
-                        "SQL_ROLE", "report_role"
-                    )
-                    if sqlrole:
-                        cursor.execute("set role %s" % (sqlrole,))
-                    if not hasattr(request, "filter"):
-                        request.filter = cls.getFilter(request, *args, **kwargs)
-                    cursor.execute(
-                        "select count(*) from (%s) t_subquery %s"
-                        % (
-                            request.report.sql.replace("%", "%%"),
-                            "where %s" % request.filter[0] if request.filter[0] else "",
-                        ),
-                        request.filter[1],
-                    )
-                    return cursor.fetchone()[0]
-            finally:
-                if conn:
-                    conn.close()
+            if not hasattr(request, "filter"):
+                request.filter = cls.getFilter(request, *args, **kwargs)
+            key = cls._get_cache_key(request, "count")
+            count = cache.get(key, None)
+            if count is None:
+                with SQLRoleConnectionPool.connection(request.database) as conn:
+                    with conn.cursor() as cursor:
+                        cursor.execute(
+                            "select count(*) from (%s) t_subquery %s"
+                            % (
+                                request.report.sql.replace("%", "%%"),
+                                "where %s" % request.filter[0]
+                                if request.filter[0]
+                                else "",
+                            ),
+                            request.filter[1],
+                        )
+                        count = cursor.fetchone()[0]
+                cache.set(
+                    key,
+                    count,
+                    timeout=getattr(settings, "SQL_REPORT_CACHE_TIMEOUT", 300),
+                )
+            return count
         else:
             return 0
 
@@ -33,10 +33,12 @@
 #include <xercesc/framework/MemBufInputSource.hpp>
 #include <xercesc/framework/StdInInputSource.hpp>
 #include <xercesc/framework/URLInputSource.hpp>
+#include <xercesc/sax/InputSource.hpp>
 #include <xercesc/sax2/Attributes.hpp>
 #include <xercesc/sax2/DefaultHandler.hpp>
 #include <xercesc/sax2/SAX2XMLReader.hpp>
 #include <xercesc/sax2/XMLReaderFactory.hpp>
+#include <xercesc/util/BinInputStream.hpp>
 #include <xercesc/util/PlatformUtils.hpp>
 #include <xercesc/util/TransService.hpp>
 #include <xercesc/util/XMLException.hpp>
@@ -256,6 +258,27 @@ class XMLInputString : public XMLInput {
   const string data;
 };
 
+/* This class reads XML data from a Python file-like object.
+ *
+ * The data is pulled in chunks from the read() method of the object while
+ * the parsing progresses. The complete document is never kept in memory,
+ * and the parsing can start before all data has been received.
+ */
+class XMLInputStream : public XMLInput {
+ public:
+  /* Constructor. The argument is a Python object with a read(size) method
+   * returning bytes. The class doesn't own a reference to the object: the
+   * code calling the parser keeps it alive. */
+  XMLInputStream(PyObject* s) : stream(s){};
+
+  /* Parse the data from the stream. */
+  void parse(Object*, bool = false);
+
+ private:
+  /* Python object providing the data. */
+  PyObject* stream;
+};
+
 /* This class reads XML data from a file system.
  *
  * The filename argument can be the name of a file or a directory.
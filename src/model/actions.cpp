@@ -76,28 +76,48 @@ PyObject *readXMLfile(PyObject *self, PyObject *args) {
 // READ XML INPUT STRING
 //
 
+template <class T>
+static void parseXMLInput(T &p, PyObject *userexit, int validate,
+                          int validate_only, int loglevel) {
+  if (userexit) p.setUserExit(userexit);
+  if (loglevel) p.setLogLevel(1);
+  if (validate_only != 0)
+    p.parse(nullptr, true);
+  else
+    p.parse(&Plan::instance(), validate != 0);
+}
+
 PyObject *readXMLdata(PyObject *self, PyObject *args) {
   // Pick up arguments
-  char *data;
+  // The data is either a string or a file-like object with a read method.
+  PyObject *input;
   int validate(1), validate_only(0), loglevel(0);
   PyObject *userexit = nullptr;
-  int ok = PyArg_ParseTuple(args, "s|iiiO:readXMLdata", &data, &validate,
+  int ok = PyArg_ParseTuple(args, "O|iiiO:readXMLdata", &input, &validate,
                             &validate_only, &loglevel, &userexit);
   if (!ok) return nullptr;
+  const char *data = nullptr;
+  if (PyUnicode_Check(input)) {
+    data = PyUnicode_AsUTF8(input);
+    if (!data) return nullptr;
+  } else if (!PyObject_HasAttrString(input, "read")) {
+    PyErr_SetString(PythonDataException,
+                    "readXMLdata expects a string or a file-like object");
+    return nullptr;
+  }
 
   // Free Python interpreter for other threads
   Py_BEGIN_ALLOW_THREADS;
 
   // Execute and catch exceptions
   try {
-    if (!data) throw DataException("No input data");
-    XMLInputString p(data);
-    if (userexit) p.setUserExit(userexit);
-    if (loglevel) p.setLogLevel(1);
-    if (validate_only != 0)
-      p.parse(nullptr, true);
-    else
-      p.parse(&Plan::instance(), validate != 0);
+    if (data) {
+      XMLInputString p(data);
+      parseXMLInput(p, userexit, validate, validate_only, loglevel);
+    } else {
+      XMLInputStream p(input);
+      parseXMLInput(p, userexit, validate, validate_only, loglevel);
+    }
   } catch (...) {
     Py_BLOCK_THREADS;
     PythonType::evalException();
@@ -118,7 +118,8 @@ void LibraryModel::initialize() {
       "Removes the plan data from memory, and optionally the static info too.");
   PythonInterpreter::registerGlobalMethod(
       "readXMLdata", readXMLdata, METH_VARARGS,
-      "Processes a XML string passed as argument.");
+      "Processes XML data from a string or a file-like object passed as "
+      "argument.");
   PythonInterpreter::registerGlobalMethod("readXMLfile", readXMLfile,
                                           METH_VARARGS, "Read an XML file.");
   PythonInterpreter::registerGlobalMethod("saveXMLfile", saveXMLfile,
@@ -930,6 +930,61 @@ void Keyword::printTags() {
     logger << i->second->getName() << "   " << i->second->dw << endl;
 }
 
+/* Xerces input stream reading from a Python file-like object.
+ * The parser runs without holding the Python global interpreter lock, which
+ * we acquire again to read every chunk.
+ */
+class PythonBinInputStream : public xercesc::BinInputStream {
+ public:
+  PythonBinInputStream(PyObject* s) : stream(s) {}
+
+  XMLFilePos curPos() const { return pos; }
+
+  XMLSize_t readBytes(XMLByte* const toFill, const XMLSize_t maxToRead) {
+    PyGILState_STATE pythonstate = PyGILState_Ensure();
+    PyObject* data = PyObject_CallMethod(stream, "read", "n",
+                                         static_cast<Py_ssize_t>(maxToRead));
+    char* buffer;
+    Py_ssize_t size;
+    if (!data || PyBytes_AsStringAndSize(data, &buffer, &size) == -1 ||
+        static_cast<XMLSize_t>(size) > maxToRead) {
+      Py_XDECREF(data);
+      if (PyErr_Occurred()) PyErr_PrintEx(0);
+      PyGILState_Release(pythonstate);
+      throw RuntimeException("Error reading XML data stream");
+    }
+    memcpy(toFill, buffer, size);
+    Py_DECREF(data);
+    PyGILState_Release(pythonstate);
+    pos += size;
+    return size;
+  }
+
+  const XMLCh* getContentType() const { return nullptr; }
+
+ private:
+  PyObject* stream;
+  XMLFilePos pos = 0;
+};
+
+class PythonInputSource : public xercesc::InputSource {
+ public:
+  PythonInputSource(PyObject* s) : stream(s) {}
+
+  xercesc::BinInputStream* makeStream() const {
+    return new PythonBinInputStream(stream);
+  }
+
+ private:
+  PyObject* stream;
+};
+
+void XMLInputStream::parse(Object* pRoot, bool validate) {
+  if (!stream) throw DataException("Missing input stream");
+  PythonInputSource in(stream);
+  XMLInput::parse(in, pRoot, validate);
+}
+
 void XMLInputFile::parse(Object* pRoot, bool validate) {
   // Check if string has been set
   if (filename.empty()) throw DataException("Missing input file or directory");